@@ -10,13 +10,10 @@ import os
 import math
 import yaml
 import glob
-import json
 
 import numpy as np
-from copy import deepcopy
 import cv2
 import random
-from PIL import Image
 from collections import defaultdict
 
 import torch
@@ -27,6 +24,24 @@ from torchvision import transforms as T
 import albumentations as A
 
 from dataset.albu import IsotropicResize
+from dataset.dataset_index import FramePathList, load_index, select_frames
+from dataset.frame_cache import FrameCache
+from dataset.landmark_store import LandmarkStore
+from dataset.quarantine import load_quarantined_frames
+from dataset.shared_cache import build_shared_cache
+
+
+def stack_batch(tensors):
+    """
+    Stacks the tensors of a batch, directly into shared memory in a DataLoader worker as the default
+    collate does, so the batch is not copied again to be sent to the main process.
+    """
+    out = None
+    if data.get_worker_info() is not None:
+        numel = sum(tensor.numel() for tensor in tensors)
+        storage = tensors[0]._typed_storage()._new_shared(numel, device=tensors[0].device)
+        out = tensors[0].new(storage).resize_(len(tensors), *tensors[0].shape)
+    return torch.stack(tensors, dim=0, out=out)
 
 
 class DeepfakeAbstractBaseDataset(data.Dataset):
@@ -58,11 +73,12 @@ class DeepfakeAbstractBaseDataset(data.Dataset):
         if mode == 'train':
             dataset_list = config['train_dataset']
             # Training data should be collected together for training
-            image_list, label_list = [], []
+            image_lists, label_lists = [], []
             for one_data in dataset_list:
                 tmp_image, tmp_label = self.collect_img_and_label_for_one_dataset(one_data)
-                image_list.extend(tmp_image)
-                label_list.extend(tmp_label)
+                image_lists.append(tmp_image)
+                label_lists.append(tmp_label)
+            image_list, label_list = FramePathList.concatenate(image_lists), np.concatenate(label_lists)
         elif mode == 'test':
             one_data = config['test_dataset']
             # Test dataset should be evaluated separately. So collect only one dataset each time
@@ -80,6 +96,17 @@ class DeepfakeAbstractBaseDataset(data.Dataset):
         }
         
         self.transform = self.init_data_aug_method()
+
+        # Optional cache of the decoded frames at the configured resolution
+        self.frame_cache = None
+        if config.get('frame_cache_folder'):
+            self.frame_cache = FrameCache(config['frame_cache_folder'], config['resolution'])
+        # Optional cache of the decoded frames in shared memory, shared by the DataLoader workers
+        self.shared_cache = build_shared_cache(config)
+        # Optional memory-mapped store of the landmarks, instead of the per-frame .npy files
+        self.landmark_store = None
+        if config.get('landmark_store_folder'):
+            self.landmark_store = LandmarkStore(config['landmark_store_folder'])
         
     def init_data_aug_method(self):
         trans = A.Compose([           
@@ -109,26 +136,24 @@ class DeepfakeAbstractBaseDataset(data.Dataset):
             dataset_name (str): A list containing one dataset information. e.g., 'FF-F2F'
 
         Returns:
-            list: A list of image paths.
-            list: A list of labels.
+            FramePathList: A list of image paths.
+            np.ndarray: A list of labels.
         
         Raises:
             ValueError: If image paths or labels are not found.
             NotImplementedError: If the dataset is not implemented yet.
         """
-        # Initialize the label and frame path lists
-        label_list = []
-        frame_path_list = []
-
-        # Try to get the dataset information from the JSON file
+        # Try to get the dataset index, compiled from the JSON file on first use
+        json_path = os.path.join(self.config['dataset_json_folder'], dataset_name + '.json')
         try:
-            with open(os.path.join(self.config['dataset_json_folder'], dataset_name + '.json'), 'r') as f:
-                dataset_info = json.load(f)
+            dataset_index = load_index(json_path)
         except Exception as e:
             print(e)
             raise ValueError(f'dataset {dataset_name} not exist!')
+        # The frames found unreadable by dataset/quarantine.py, if it was run
+        quarantined_frames = load_quarantined_frames(json_path)
 
-        # If JSON file exists, do the following data collection
+        # If the index exists, do the following data collection
         # FIXME: ugly, need to be modified here.
         cp = None
         if dataset_name == 'FaceForensics++_c40':
@@ -146,39 +171,18 @@ class DeepfakeAbstractBaseDataset(data.Dataset):
         elif dataset_name == 'FF-NT_c40':
             dataset_name = 'FF-NT'
             cp = 'c40'
-        # Get the information for the current dataset
-        for label in dataset_info[dataset_name]:
-            sub_dataset_info = dataset_info[dataset_name][label][self.mode]
-            # Special case for FaceForensics++ and DeepFakeDetection, choose the compression type
-            if cp == None and dataset_name in ['FF-DF', 'FF-F2F', 'FF-FS', 'FF-NT', 'FaceForensics++','DeepFakeDetection','FaceShifter']:
-                sub_dataset_info = sub_dataset_info[self.compression]
-            elif cp == 'c40' and dataset_name in ['FF-DF', 'FF-F2F', 'FF-FS', 'FF-NT', 'FaceForensics++','DeepFakeDetection','FaceShifter']:
-                sub_dataset_info = sub_dataset_info['c40']
-            # Iterate over the videos in the dataset
-            for video_name, video_info in sub_dataset_info.items():
-                # Get the label and frame paths for the current video
-                if video_info['label'] not in self.config['label_dict']:
-                    raise ValueError(f'Label {video_info["label"]} is not found in the configuration file.')
-                label = self.config['label_dict'][video_info['label']]
-                frame_paths = video_info['frames']
-
-                # Select self.frame_num frames evenly distributed throughout the video
-                total_frames = len(frame_paths)
-                if self.frame_num < total_frames:
-                    step = total_frames // self.frame_num
-                    selected_frames = [frame_paths[i] for i in range(0, total_frames, step)][:self.frame_num]
-                    # Append the label and frame paths to the lists according the number of frames
-                    label_list.extend([label]*len(selected_frames))
-                    frame_path_list.extend(selected_frames)
-                else:
-                    label_list.extend([label]*total_frames)
-                    frame_path_list.extend(frame_paths)
-            
-        # Shuffle the label and frame path lists in the same order
-        shuffled = list(zip(label_list, frame_path_list))
-        random.shuffle(shuffled)
-        label_list, frame_path_list = zip(*shuffled)
-        
+        # Special case for FaceForensics++ and DeepFakeDetection, choose the compression type
+        compression = ''
+        if cp == None and dataset_name in ['FF-DF', 'FF-F2F', 'FF-FS', 'FF-NT', 'FaceForensics++','DeepFakeDetection','FaceShifter']:
+            compression = self.compression
+        elif cp == 'c40' and dataset_name in ['FF-DF', 'FF-F2F', 'FF-FS', 'FF-NT', 'FaceForensics++','DeepFakeDetection','FaceShifter']:
+            compression = 'c40'
+
+        # Select self.frame_num frames evenly distributed throughout each video, shuffled
+        frame_path_list, label_list = select_frames(
+            dataset_index, dataset_name, self.mode, compression, self.frame_num, self.config['label_dict'],
+            excluded=quarantined_frames)
+
         return frame_path_list, label_list
 
      
@@ -190,20 +194,47 @@ class DeepfakeAbstractBaseDataset(data.Dataset):
             file_path: A string indicating the path to the image file.
 
         Returns:
-            An Image object containing the loaded and resized image.
+            A numpy array of uint8 containing the loaded and resized RGB image.
 
         Raises:
             ValueError: If the loaded image is None.
         """
         size = self.config['resolution']
+        # Share the decoded frames between the DataLoader workers, if enabled
+        if self.shared_cache is not None:
+            img = self.shared_cache.get_or_load(f'rgb:{size}:{file_path}', lambda: self.read_rgb(file_path))
+        else:
+            img = self.read_rgb(file_path)
+        return np.asarray(img, dtype=np.uint8)
+
+    def read_rgb(self, file_path):
+        """
+        Decode an RGB image and resize it to the specified resolution, or read it from the frame cache.
+
+        Args:
+            file_path: A string indicating the path to the image file.
+
+        Returns:
+            A numpy array containing the loaded and resized image.
+        """
+        size = self.config['resolution']
+        # Serve the frame already decoded and resized from the frame cache, if enabled
+        if self.frame_cache is not None:
+            try:
+                img = self.frame_cache.get(file_path)
+            except Exception as e:
+                # Decode the frame directly when its video cannot be cached
+                print(f"Frame cache unavailable for {file_path}: {e}")
+                img = None
+            if img is not None:
+                return img
         assert os.path.exists(file_path), f"{file_path} does not exist"
         img = cv2.imread(file_path)
         if img is None: 
             raise ValueError('Loaded image is None: {}'.format(file_path))
 
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img = cv2.resize(img, (size, size), interpolation=cv2.INTER_CUBIC)
-        return Image.fromarray(np.array(img, dtype=np.uint8))
+        return cv2.resize(img, (size, size), interpolation=cv2.INTER_CUBIC)
 
     def load_mask(self, file_path):
         """
@@ -222,15 +253,28 @@ class DeepfakeAbstractBaseDataset(data.Dataset):
         if file_path is None:
             return np.zeros((size, size, 1))
         if os.path.exists(file_path):
-            mask = cv2.imread(file_path, 0)
+            if self.shared_cache is not None:
+                mask = self.shared_cache.get_or_load(f'mask:{size}:{file_path}', lambda: self.read_mask(file_path))
+            else:
+                mask = self.read_mask(file_path)
             if mask is None:
                 mask = np.zeros((size, size))
-            mask = cv2.resize(mask, (size, size))/255
+            mask = mask/255
             mask = np.expand_dims(mask, axis=2)
             return np.float32(mask)
         else:
             return np.zeros((size, size, 1))
 
+    def read_mask(self, file_path):
+        """
+        Decode a mask image and resize it to the specified resolution, None if it cannot be decoded.
+        """
+        size = self.config['resolution']
+        mask = cv2.imread(file_path, 0)
+        if mask is None:
+            return None
+        return cv2.resize(mask, (size, size))
+
     def load_landmark(self, file_path):
         """
         Load 2D facial landmarks from a file path.
@@ -246,6 +290,10 @@ class DeepfakeAbstractBaseDataset(data.Dataset):
         """
         if file_path is None:
             return np.zeros((81, 2))
+        if self.landmark_store is not None:
+            landmark = self.landmark_store.get(file_path)
+            if landmark is not None:
+                return landmark
         if os.path.exists(file_path):
             landmark = np.load(file_path)
             return np.float32(landmark)
@@ -256,7 +304,7 @@ class DeepfakeAbstractBaseDataset(data.Dataset):
         """
         Convert an image to a PyTorch tensor.
         """
-        return T.ToTensor()(img)
+        return T.functional.to_tensor(img)
 
     def normalize(self, img):
         """
@@ -264,8 +312,7 @@ class DeepfakeAbstractBaseDataset(data.Dataset):
         """
         mean = self.config['mean']
         std = self.config['std']
-        normalize = T.Normalize(mean=mean, std=std)
-        return normalize(img)
+        return T.functional.normalize(img, mean=mean, std=std)
 
     def data_aug(self, img, landmark=None, mask=None):
         """
@@ -327,10 +374,10 @@ class DeepfakeAbstractBaseDataset(data.Dataset):
         try:
             image = self.load_rgb(image_path)
         except Exception as e:
-            # Skip this image and return the first one
+            # Skip this image and return a random one, run dataset/quarantine.py to exclude it from the index
             print(f"Error loading image at index {index}: {e}")
-            return self.__getitem__(0)
-        image = np.array(image)  # Convert to numpy array for data augmentation
+            return self.__getitem__(random.randrange(len(self)))
+        image = np.asarray(image)  # Already a numpy array, no copy for data augmentation
         
         # Load mask and landmark (if needed)
         if self.config['with_mask']:
@@ -342,14 +389,38 @@ class DeepfakeAbstractBaseDataset(data.Dataset):
         else:
             landmarks = None
 
+        return self.transform_sample(image, label, landmarks, mask)
+
+    def transform_sample(self, image, label, landmarks=None, mask=None):
+        """
+        Augments, converts to tensors and normalizes a loaded data point.
+
+        Args:
+            image (np.ndarray): The RGB image.
+            label (int): The label.
+            landmarks (np.ndarray): The landmarks, None when the config has no `with_landmark`.
+            mask (np.ndarray): The mask, None when the config has no `with_mask`.
+
+        Returns:
+            A tuple containing the image tensor, the label tensor, the landmark tensor,
+            and the mask tensor.
+        """
+        use_data_augmentation = self.mode=='train' and self.config['use_data_augmentation']
+        # Leave the augmentation to `BatchAugmentation` on the collated batch
+        batch_augmentation = use_data_augmentation and self.config.get('batch_augmentation')
+
         # Do Data Augmentation
-        if self.mode=='train' and self.config['use_data_augmentation']:
+        if use_data_augmentation and not batch_augmentation:
             image_trans, landmarks_trans, mask_trans = self.data_aug(image, landmarks, mask)
         else:
-            image_trans, landmarks_trans, mask_trans = deepcopy(image), deepcopy(landmarks), deepcopy(mask)
+            # The loaded arrays are not shared, no need to copy them
+            image_trans, landmarks_trans, mask_trans = image, landmarks, mask
 
-        # To tensor and normalize
-        image_trans = self.normalize(self.to_tensor(image_trans))
+        # Keep the image in uint8 HWC, normalized per batch on the device, or convert to tensor and normalize
+        if batch_augmentation or self.config.get('uint8_batches'):
+            image_trans = torch.from_numpy(np.ascontiguousarray(image_trans, dtype=np.uint8))
+        else:
+            image_trans = self.normalize(self.to_tensor(image_trans))
         if self.config['with_landmark']:
             landmarks_trans = torch.from_numpy(landmarks)
         if self.config['with_mask']:
@@ -374,7 +445,7 @@ class DeepfakeAbstractBaseDataset(data.Dataset):
         images, labels, landmarks, masks = zip(*batch)
         
         # Stack the image, label, landmark, and mask tensors
-        images = torch.stack(images, dim=0)
+        images = stack_batch(images)
         labels = torch.LongTensor(labels)
         
         # Special case for landmarks and masks if they are None
@@ -0,0 +1,123 @@
+# description: Precomputed face alignments of the frames for FWABlendDataset.
+
+"""
+`FWABlendDataset.blend_images` runs the dlib face detection and the landmark prediction of `align` on every
+sample, every epoch, although the alignment of a frame never changes. The alignment store keeps, for every
+frame, the `face_cache` entry of its first face as `align` returns it:
+
+    <store_folder>/matrices.npy     float64 [N, 2, 3]    the umeyama transforms to the mean face
+    <store_folder>/points.npy       int32 [N, 81, 2]     the predicted landmarks, mapped by `get_2d_aligned_landmarks`
+    <store_folder>/num_faces.npy    int16 [N]            0 for the frames without face, so they are not detected again
+
+indexed by the frame paths as the landmark store. Frames missing from the store fall back to the live detection.
+"""
+
+import sys
+sys.path.append('.')
+
+import os
+import concurrent.futures
+
+import cv2
+import numpy as np
+
+from dataset.landmark_store import PathIndexedStore, save_path_indexed_store
+from dataset.dataset_index import all_frame_paths, load_index
+
+NUM_POINTS = 81
+
+
+class AlignmentStore(PathIndexedStore):
+    """
+    Read-only mapping from the frame paths to their `face_cache`, backed by the memory-mapped store.
+    """
+    array_names = ('matrices', 'points', 'num_faces')
+
+    def get(self, path):
+        """
+        Returns the `face_cache` of a frame, as `align`: a list with the [transform matrix, landmarks]
+        of its first face, empty without face. None if the frame is not in the store.
+        """
+        row = self.get_row(path)
+        if row is None:
+            return None
+        if self.arrays['num_faces'][row] == 0:
+            return []
+        return [[np.array(self.arrays['matrices'][row]), np.array(self.arrays['points'][row])]]
+
+
+def align_frame(frame_path):
+    """
+    Detects and aligns the faces of a frame as `FWABlendDataset.blend_images`.
+
+    Returns:
+        tuple: The transform matrix and the landmarks of the first face, None without face, and the number of faces.
+    """
+    # Imported here, the dlib models are loaded with the dataset module
+    from dataset.fwa_blend import align, face_detector, face_predictor
+    im = cv2.imread(frame_path)
+    if im is None:
+        return None, None, 0
+    face_cache = align(im, face_detector, face_predictor)
+    if len(face_cache) == 0:
+        return None, None, 0
+    trans_matrix, points = face_cache[0]
+    return trans_matrix, points, len(face_cache)
+
+
+def build_alignment_store(frame_paths, store_folder, num_workers=None, chunksize=64):
+    """
+    Aligns the frames missing from the store in parallel processes, and saves the store with all of them.
+
+    Args:
+        frame_paths (iterable): The frames.
+        store_folder (str): The store folder, updated when it exists.
+        num_workers (int): Number of processes.
+        chunksize (int): Number of frames sent to a process at once.
+
+    Returns:
+        int: The number of aligned frames.
+    """
+    paths, matrices, points, num_faces = [], [], [], []
+    # Keep the rows of the current store
+    if os.path.exists(os.path.join(store_folder, 'meta.json')):
+        store = AlignmentStore(store_folder)
+        paths = list(store.keys())
+        matrices = list(np.asarray(store.arrays['matrices']))
+        points = list(np.asarray(store.arrays['points']))
+        num_faces = list(np.asarray(store.arrays['num_faces']))
+    stored = set(paths)
+    todo = sorted(set(frame_paths) - stored)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for frame_path, (trans_matrix, face_points, count) in zip(todo, executor.map(align_frame, todo, chunksize=chunksize)):
+            paths.append(frame_path)
+            matrices.append(np.zeros((2, 3)) if trans_matrix is None else trans_matrix)
+            points.append(np.zeros((NUM_POINTS, 2), dtype=np.int32) if face_points is None else face_points)
+            num_faces.append(count)
+
+    save_path_indexed_store(store_folder, paths, {
+        'matrices': np.array(matrices, dtype=np.float64).reshape(-1, 2, 3),
+        'points': np.array(points, dtype=np.int32).reshape(-1, NUM_POINTS, 2),
+        'num_faces': np.array(num_faces, dtype=np.int16),
+    })
+    return len(todo)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Precompute the face alignments of the training frames for FWA.')
+    parser.add_argument('--dataset_json_folder', type=str, default='./preprocessing/dataset_json')
+    parser.add_argument('--datasets', type=str, nargs='+', default=['FaceForensics++'])
+    parser.add_argument('--split', type=str, default='train')
+    parser.add_argument('--store_folder', type=str, default='./preprocessing/alignment_store')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    frame_paths = set()
+    for dataset_name in args.datasets:
+        index = load_index(os.path.join(args.dataset_json_folder, dataset_name + '.json'))
+        frame_paths.update(all_frame_paths(index, split=args.split))
+    num_aligned = build_alignment_store(frame_paths, args.store_folder, args.workers)
+    print(f"Aligned {num_aligned} new frames of {len(frame_paths)} in {args.store_folder}")
@@ -0,0 +1,339 @@
+# description: Batched data augmentation of collated uint8 images, as vectorized torch ops.
+
+"""
+`init_data_aug_method` builds an albumentations pipeline applied to one image at a time in the DataLoader
+workers. `BatchAugmentation` applies the same transforms, with per-sample random parameters drawn from the
+same `data_aug` config keys, to a whole uint8 batch [B, H, W, 3] after collation, on the CPU or on the GPU:
+
+- HorizontalFlip(flip_prob) and Rotate(rotate_limit, rotate_prob) with reflected borders, also applied to the masks;
+- GaussianBlur(blur_limit, blur_prob) with the OpenCV sigma of every kernel size;
+- IsotropicResize to the resolution, a no-op for the frames already resized by `load_rgb`;
+- one of RandomBrightnessContrast(brightness_limit, contrast_limit), FancyPCA and HueSaturationValue with p=0.5;
+- ImageCompression(quality_lower, quality_upper) with p=0.5, simulated by the quantization of the 8x8 DCT
+  blocks of 4:2:0 YCbCr with the quality-scaled standard JPEG tables.
+
+The images are then normalized with the config `mean` and `std` by `normalize_batch`, which also
+normalizes the uint8 batches of the `uint8_batches` option. As with `data_aug`, the landmarks are not transformed.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+# Standard JPEG quantization tables (ITU-T T.81, Annex K)
+JPEG_LUMA_TABLE = [
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99,
+]
+JPEG_CHROMA_TABLE = [
+    17, 18, 24, 47, 99, 99, 99, 99, 18, 21, 26, 66, 99, 99, 99, 99,
+    24, 26, 56, 99, 99, 99, 99, 99, 47, 66, 99, 99, 99, 99, 99, 99,
+] + [99] * 32
+
+
+def uniform(low, high, size, device):
+    """
+    Draws `size` uniform samples in [low, high].
+    """
+    return torch.rand(size, device=device) * (high - low) + low
+
+
+def dct_matrix(device):
+    """
+    Returns the orthonormal 8x8 DCT-II matrix.
+    """
+    n = torch.arange(8, dtype=torch.float32, device=device)
+    matrix = torch.cos((2 * n[None, :] + 1) * n[:, None] * math.pi / 16) * math.sqrt(2 / 8)
+    matrix[0] /= math.sqrt(2)
+    return matrix
+
+
+def quality_tables(table, quality):
+    """
+    Scales a quantization table by the libjpeg rule of every quality [B].
+
+    Returns:
+        torch.Tensor: The tables [B, 8, 8].
+    """
+    quality = quality.clamp(1, 100)
+    scale = torch.where(quality < 50, 5000 / quality, 200 - 2 * quality)
+    table = torch.tensor(table, dtype=torch.float32, device=quality.device).view(1, 8, 8)
+    return ((table * scale.view(-1, 1, 1) + 50) // 100).clamp(1, 255)
+
+
+def rgb_to_hsv(images):
+    """
+    Converts RGB images [B, 3, H, W] in [0, 1] to HSV, with the hue in [0, 1).
+    """
+    r, g, b = images.unbind(1)
+    max_c, _ = images.max(1)
+    min_c, _ = images.min(1)
+    delta = max_c - min_c
+    safe_delta = torch.where(delta > 0, delta, torch.ones_like(delta))
+    hue = torch.where(max_c == r, (g - b) / safe_delta,
+                      torch.where(max_c == g, (b - r) / safe_delta + 2, (r - g) / safe_delta + 4))
+    hue = torch.where(delta > 0, hue / 6 % 1, torch.zeros_like(hue))
+    saturation = torch.where(max_c > 0, delta / torch.where(max_c > 0, max_c, torch.ones_like(max_c)),
+                             torch.zeros_like(max_c))
+    return torch.stack([hue, saturation, max_c], 1)
+
+
+def hsv_to_rgb(images):
+    """
+    Converts HSV images [B, 3, H, W], with the hue in [0, 1), to RGB.
+    """
+    hue, saturation, value = images.unbind(1)
+    # Distance of every channel to its hue sector, as in the CSS reference conversion
+    k = (torch.tensor([5, 3, 1], dtype=images.dtype, device=images.device).view(1, 3, 1, 1) + hue[:, None] * 6) % 6
+    weight = torch.minimum(k, 4 - k).clamp(0, 1)
+    return value[:, None] - value[:, None] * saturation[:, None] * weight
+
+
+def normalize_batch(images, mean, std, channels_last=False):
+    """
+    Converts a collated uint8 batch to normalized float32 in a single fused multiply-add.
+
+    Args:
+        images (torch.Tensor): The RGB images [B, H, W, 3] of uint8, or [B, 3, H, W] in [0, 255].
+        mean (list): The normalization mean of every channel, for images in [0, 1].
+        std (list): The normalization std of every channel, for images in [0, 1].
+        channels_last (bool): Whether to return the images in the channels_last memory format.
+
+    Returns:
+        torch.Tensor: The normalized images [B, 3, H, W].
+    """
+    if images.dtype == torch.uint8:
+        # The permuted HWC batch already has the channels_last strides, kept by the conversion
+        images = images.permute(0, 3, 1, 2)
+    images = images.float()
+    std = torch.tensor(std, dtype=torch.float32, device=images.device).view(1, 3, 1, 1)
+    mean = torch.tensor(mean, dtype=torch.float32, device=images.device).view(1, 3, 1, 1)
+    # (x / 255 - mean) / std as x * scale + shift
+    images = torch.addcmul(-mean / std, images, 1 / (255 * std))
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    return images.contiguous(memory_format=memory_format)
+
+
+class BatchAugmentation:
+    """
+    The `init_data_aug_method` transforms applied to collated uint8 batches, followed by the normalization.
+    """
+    def __init__(self, config):
+        aug_config = config['data_aug']
+        self.resolution = config['resolution']
+        self.flip_prob = aug_config['flip_prob']
+        self.rotate_prob = aug_config['rotate_prob']
+        self.rotate_limit = aug_config['rotate_limit']
+        self.blur_prob = aug_config['blur_prob']
+        self.blur_limit = aug_config['blur_limit']
+        self.brightness_limit = aug_config['brightness_limit']
+        self.contrast_limit = aug_config['contrast_limit']
+        self.quality_lower = aug_config['quality_lower']
+        self.quality_upper = aug_config['quality_upper']
+        self.mean = config['mean']
+        self.std = config['std']
+        self.channels_last = config.get('channels_last', False)
+
+    def __call__(self, images, masks=None):
+        """
+        Augments and normalizes a batch.
+
+        Args:
+            images (torch.Tensor): The RGB images [B, H, W, 3] of uint8.
+            masks (torch.Tensor): The masks [B, H, W, 1], or None.
+
+        Returns:
+            torch.Tensor: The normalized images [B, 3, resolution, resolution] of float32.
+            torch.Tensor: The augmented masks [B, H, W, 1], or None.
+        """
+        x = images.permute(0, 3, 1, 2).float()
+        if masks is not None:
+            masks = masks.permute(0, 3, 1, 2).float()
+        x, masks = self.flip(x, masks)
+        x, masks = self.rotate(x, masks)
+        x = self.blur(x)
+        x = self.resize(x)
+        x = self.color(x)
+        x = self.compress(x)
+        if masks is not None:
+            masks = masks.permute(0, 2, 3, 1).contiguous()
+        return self.normalize(x), masks
+
+    def normalize(self, x):
+        """
+        Scales images [B, 3, H, W] in [0, 255] to [0, 1] and normalizes them.
+        """
+        return normalize_batch(x, self.mean, self.std, self.channels_last)
+
+    def flip(self, x, masks):
+        """
+        HorizontalFlip of every sample with probability `flip_prob`.
+        """
+        flip = (torch.rand(len(x), device=x.device) < self.flip_prob).view(-1, 1, 1, 1)
+        x = torch.where(flip, x.flip(-1), x)
+        if masks is not None:
+            masks = torch.where(flip, masks.flip(-1), masks)
+        return x, masks
+
+    def rotate(self, x, masks):
+        """
+        Rotate of every sample with probability `rotate_prob` by an angle in `rotate_limit`,
+        around the image center with reflected borders.
+        """
+        selected = torch.nonzero(torch.rand(len(x), device=x.device) < self.rotate_prob).flatten()
+        if len(selected) == 0:
+            return x, masks
+        angle = uniform(*self.rotate_limit, len(selected), x.device) * math.pi / 180
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        height, width = x.shape[-2:]
+        # Output to input sampling grid in normalized coordinates, corrected for the aspect ratio
+        theta = torch.zeros(len(selected), 2, 3, device=x.device)
+        theta[:, 0, 0], theta[:, 0, 1] = cos, -sin * height / width
+        theta[:, 1, 0], theta[:, 1, 1] = sin * width / height, cos
+        grid = F.affine_grid(theta, (len(selected), 1, height, width), align_corners=False)
+        x = x.clone()
+        x[selected] = F.grid_sample(x[selected], grid, mode='bilinear', padding_mode='reflection', align_corners=False)
+        if masks is not None:
+            masks = masks.clone()
+            masks[selected] = F.grid_sample(masks[selected], grid, mode='nearest', padding_mode='reflection',
+                                            align_corners=False)
+        return x, masks
+
+    def blur(self, x):
+        """
+        GaussianBlur of every sample with probability `blur_prob`, by an odd kernel size in `blur_limit`.
+        The samples sharing a kernel size are convolved together with a separable depthwise kernel.
+        """
+        applied = torch.rand(len(x), device=x.device) < self.blur_prob
+        sizes = torch.arange(self.blur_limit[0] | 1, self.blur_limit[1] + 1, 2, device=x.device)
+        kernel_sizes = sizes[torch.randint(len(sizes), (len(x),), device=x.device)]
+        x = x.clone()
+        for ksize in sizes.tolist():
+            selected = torch.nonzero(applied & (kernel_sizes == ksize)).flatten()
+            if len(selected) == 0:
+                continue
+            # Sigma of cv2.getGaussianKernel for a kernel size, as GaussianBlur with sigma 0
+            sigma = 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+            offsets = torch.arange(ksize, dtype=x.dtype, device=x.device) - ksize // 2
+            kernel = torch.exp(-offsets ** 2 / (2 * sigma ** 2))
+            kernel = (kernel / kernel.sum()).repeat(3, 1)
+            pad = ksize // 2
+            # Reflect padding is BORDER_REFLECT_101, the default border of cv2.GaussianBlur
+            blurred = F.pad(x[selected], (pad, pad, pad, pad), mode='reflect')
+            blurred = F.conv2d(blurred, kernel.view(3, 1, 1, ksize), groups=3)
+            blurred = F.conv2d(blurred, kernel.view(3, 1, ksize, 1), groups=3)
+            x[selected] = blurred
+        return x
+
+    def resize(self, x):
+        """
+        IsotropicResize to the resolution, one interpolation for the whole batch.
+        """
+        height, width = x.shape[-2:]
+        if max(height, width) == self.resolution:
+            return x
+        scale = self.resolution / max(height, width)
+        size = (int(height * scale), int(width * scale))
+        if scale < 1:
+            mode = 'area' if torch.rand(1).item() < 2 / 3 else 'bilinear'
+        else:
+            mode = 'bicubic' if torch.rand(1).item() < 1 / 3 else 'bilinear'
+        x = F.interpolate(x, size=size, mode=mode, **({} if mode == 'area' else {'align_corners': False}))
+        return x.clamp(0, 255)
+
+    def color(self, x):
+        """
+        One of RandomBrightnessContrast, FancyPCA and HueSaturationValue with probability 0.5 per sample.
+        """
+        choice = torch.randint(6, (len(x),), device=x.device)
+        for transform, selected in ((self.brightness_contrast, choice == 0), (self.fancy_pca, choice == 1),
+                                    (self.hue_saturation_value, choice == 2)):
+            selected = torch.nonzero(selected).flatten()
+            if len(selected) > 0:
+                x = x.clone()
+                x[selected] = transform(x[selected]).clamp(0, 255)
+        return x
+
+    def brightness_contrast(self, x):
+        """
+        RandomBrightnessContrast: contrast factor 1 + c and brightness offset b times 255.
+        """
+        alpha = 1 + uniform(*self.contrast_limit, len(x), x.device).view(-1, 1, 1, 1)
+        beta = uniform(*self.brightness_limit, len(x), x.device).view(-1, 1, 1, 1) * 255
+        return x * alpha + beta
+
+    def fancy_pca(self, x, alpha=0.1):
+        """
+        FancyPCA: adds the principal components of the pixel colors of every image, weighted by random eigenvalues.
+        """
+        pixels = x.flatten(2) / 255
+        centered = pixels - pixels.mean(2, keepdim=True)
+        covariance = centered @ centered.transpose(1, 2) / (pixels.shape[2] - 1)
+        eig_vals, eig_vecs = torch.linalg.eigh(covariance)
+        weights = torch.randn(len(x), 3, device=x.device) * alpha * eig_vals
+        shift = (eig_vecs @ weights.unsqueeze(2)).view(-1, 3, 1, 1)
+        return x + shift * 255
+
+    def hue_saturation_value(self, x, hue_shift_limit=20, sat_shift_limit=30, val_shift_limit=20):
+        """
+        HueSaturationValue with the default limits of albumentations, in OpenCV units:
+        the hue in [0, 180) and the saturation and value in [0, 255].
+        """
+        hsv = rgb_to_hsv(x / 255)
+        hue = uniform(-hue_shift_limit, hue_shift_limit, len(x), x.device).view(-1, 1, 1) / 180
+        saturation = uniform(-sat_shift_limit, sat_shift_limit, len(x), x.device).view(-1, 1, 1) / 255
+        value = uniform(-val_shift_limit, val_shift_limit, len(x), x.device).view(-1, 1, 1) / 255
+        hsv = torch.stack([(hsv[:, 0] + hue) % 1, (hsv[:, 1] + saturation).clamp(0, 1),
+                           (hsv[:, 2] + value).clamp(0, 1)], 1)
+        return hsv_to_rgb(hsv) * 255
+
+    def compress(self, x):
+        """
+        ImageCompression with probability 0.5 per sample, by a quality in [quality_lower, quality_upper].
+        """
+        selected = torch.nonzero(torch.rand(len(x), device=x.device) < 0.5).flatten()
+        if len(selected) == 0:
+            return x
+        quality = torch.randint(self.quality_lower, self.quality_upper + 1, (len(selected),), device=x.device).float()
+        x = x.clone()
+        x[selected] = self.jpeg(x[selected].round(), quality)
+        return x
+
+    def jpeg(self, x, quality):
+        """
+        Simulates the JPEG compression of images [B, 3, H, W] in [0, 255] at the qualities [B]:
+        4:2:0 chroma subsampling and quantization of the 8x8 DCT blocks.
+        """
+        height, width = x.shape[-2:]
+        # Pad to whole 16x16 macroblocks by repeating the borders, as the encoders do
+        pad_h, pad_w = -height % 16, -width % 16
+        x = F.pad(x, (0, pad_w, 0, pad_h), mode='replicate')
+
+        # RGB to YCbCr (JFIF), centered on 0
+        r, g, b = x.unbind(1)
+        y = 0.299 * r + 0.587 * g + 0.114 * b - 128
+        cb = -0.168736 * r - 0.331264 * g + 0.5 * b
+        cr = 0.5 * r - 0.418688 * g - 0.081312 * b
+        chroma = F.avg_pool2d(torch.stack([cb, cr], 1), 2)
+
+        dct = dct_matrix(x.device)
+        luma_tables = quality_tables(JPEG_LUMA_TABLE, quality)
+        chroma_tables = quality_tables(JPEG_CHROMA_TABLE, quality)
+
+        def quantize(planes, tables):
+            # planes [B, C, H, W] to blocks [B, C, H/8, W/8, 8, 8], quantized in the DCT domain
+            b, c, h, w = planes.shape
+            blocks = planes.view(b, c, h // 8, 8, w // 8, 8).permute(0, 1, 2, 4, 3, 5)
+            coefficients = dct @ blocks @ dct.T
+            tables = tables.view(b, 1, 1, 1, 8, 8)
+            blocks = dct.T @ (torch.round(coefficients / tables) * tables) @ dct
+            return blocks.permute(0, 1, 2, 4, 3, 5).reshape(b, c, h, w)
+
+        y = quantize(y.unsqueeze(1), luma_tables)[:, 0] + 128
+        chroma = F.interpolate(quantize(chroma, chroma_tables), scale_factor=2, mode='bilinear', align_corners=False)
+        cb, cr = chroma.unbind(1)
+        x = torch.stack([y + 1.402 * cr, y - 0.344136 * cb - 0.714136 * cr, y + 1.772 * cb], 1)
+        return x[..., :height, :width].round().clamp(0, 255)
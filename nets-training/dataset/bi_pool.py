@@ -0,0 +1,253 @@
+# description: Pool of blended images (BI) generated offline for Face X-ray, refreshed in rolling shards.
+
+"""
+Every `FFBlendDataset` sample reads two frames and runs the whole blending pipeline, far more CPU than the
+forward pass. The generator runs the same pipeline in parallel processes and saves the samples into a pool
+of fixed-size shards:
+
+    <pool_folder>/shard-00000/blended.npy       uint8 [N, H, W, 3]    the blended images, BGR
+    <pool_folder>/shard-00000/boundaries.npy    float16 [N, H, W]     the blending boundaries
+    <pool_folder>/shard-00000/backgrounds.npy   uint8 [N, H, W, 3]    the real background frames, BGR
+    <pool_folder>/shard-00000/labels.npy        int64 [N]             the labels of the backgrounds
+    <pool_folder>/shard-00000/meta.json         number of samples and generation of the shard
+
+With `--refresh`, the generator keeps running next to the training and regenerates the oldest shard in turn,
+so the pool keeps changing while a training step only reads one sample. `BIPool` memory-maps the shards and
+reloads the regenerated ones every `reload_interval` seconds.
+"""
+
+import sys
+sys.path.append('.')
+
+import os
+import json
+import time
+import random
+import shutil
+import concurrent.futures
+
+import cv2
+import numpy as np
+
+from dataset.dataset_index import save_index
+
+SHARD_PREFIX = 'shard-'
+ARRAY_NAMES = ('blended', 'boundaries', 'backgrounds', 'labels')
+
+
+def get_shard_path(pool_folder, shard_id):
+    """
+    Returns the folder of a shard of the pool.
+    """
+    return os.path.join(pool_folder, f'{SHARD_PREFIX}{shard_id:05d}')
+
+
+def read_shard_meta(shard_path):
+    """
+    Returns the meta of a shard, None while it is being replaced.
+    """
+    try:
+        with open(os.path.join(shard_path, 'meta.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class BIPool:
+    """
+    Read-only view of the memory-mapped shards of a pool, reloading the regenerated shards.
+    """
+    def __init__(self, pool_folder, reload_interval=60):
+        """
+        Args:
+            pool_folder (str): The pool folder.
+            reload_interval (float): Seconds between two checks of the regenerated shards.
+        """
+        self.pool_folder = pool_folder
+        self.reload_interval = reload_interval
+        # Shard folder: (creation time, arrays)
+        self.shards = {}
+        self.reload()
+        if len(self) == 0:
+            raise ValueError(f"The BI pool {pool_folder} is empty, generate it with dataset/bi_pool.py.")
+
+    def reload(self):
+        """
+        Maps the new and regenerated shards. A shard being replaced keeps its previous arrays until it is complete,
+        including while its folder is missing between the two renames of the swap, so removing shards from the
+        pool needs a new `BIPool`.
+        """
+        # The mapped arrays stay readable after their files are removed
+        shards = dict(self.shards)
+        for name in os.listdir(self.pool_folder):
+            # Skip the temporary folders of the shards being written
+            if not name.startswith(SHARD_PREFIX) or not name[len(SHARD_PREFIX):].isdigit():
+                continue
+            shard_path = os.path.join(self.pool_folder, name)
+            meta = read_shard_meta(shard_path)
+            if meta is None or (name in self.shards and self.shards[name][0] == meta['created']):
+                continue
+            try:
+                arrays = {key: np.load(os.path.join(shard_path, f'{key}.npy'), mmap_mode='r') for key in ARRAY_NAMES}
+            except (OSError, ValueError):
+                continue
+            shards[name] = (meta['created'], arrays)
+        self.shards = shards
+        self.names = sorted(self.shards)
+        self.offsets = np.cumsum([0] + [len(self.shards[name][1]['labels']) for name in self.names])
+        self.last_reload = time.monotonic()
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def get(self, index):
+        """
+        Returns a copy of a sample of the pool, the index wrapping around the current number of samples.
+
+        Returns:
+            tuple: The blended image, its boundary (float64), the background image and its label.
+        """
+        if time.monotonic() - self.last_reload > self.reload_interval:
+            self.reload()
+        index = index % len(self)
+        shard = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        arrays = self.shards[self.names[shard]][1]
+        row = index - self.offsets[shard]
+        return (np.array(arrays['blended'][row]), np.array(arrays['boundaries'][row], dtype=np.float64),
+                np.array(arrays['backgrounds'][row]), int(arrays['labels'][row]))
+
+
+# The blending dataset of a generator process
+_dataset = None
+
+
+def init_worker(config):
+    """
+    Builds the blending dataset of a generator process, generating live samples.
+    """
+    global _dataset
+    from dataset.ff_blend import FFBlendDataset
+    # The frames are read once, and the generator must not read the pool it writes
+    config = dict(config, bi_pool_folder=None, shared_cache_bytes=None)
+    _dataset = FFBlendDataset(config)
+
+
+def generate_samples(seed, num_samples, resolution, max_failures=None):
+    """
+    Generates samples from random background frames in a generator process.
+
+    Args:
+        seed (int): The seed of the samples.
+        num_samples (int): Number of samples.
+        resolution (int): Size of the saved images.
+        max_failures (int): Number of failed samples before giving up, `num_samples` by default.
+
+    Returns:
+        tuple: The stacked blended images, boundaries, backgrounds and labels.
+    """
+    random.seed(seed)
+    np.random.seed(seed % (1 << 32))
+    max_failures = num_samples if max_failures is None else max_failures
+    samples = []
+    failures = 0
+    while len(samples) < num_samples:
+        try:
+            blended, boundary, background, label = _dataset.generate_sample(random.randrange(len(_dataset)))
+        except Exception as e:
+            # The live dataset fails on the same samples, skip them, unless the config itself is broken
+            failures += 1
+            if failures > max_failures:
+                raise RuntimeError(f"{failures} failed samples out of {len(samples) + failures}") from e
+            print(f"Skipped a sample: {e}")
+            continue
+        if blended.shape[:2] != (resolution, resolution):
+            blended = cv2.resize(blended, (resolution, resolution), interpolation=cv2.INTER_CUBIC)
+            boundary = cv2.resize(boundary, (resolution, resolution), interpolation=cv2.INTER_LINEAR)
+            background = cv2.resize(background, (resolution, resolution), interpolation=cv2.INTER_CUBIC)
+        samples.append((blended, boundary, background, label))
+    blended, boundaries, backgrounds, labels = zip(*samples)
+    return (np.stack(blended).astype(np.uint8), np.stack(boundaries).astype(np.float16),
+            np.stack(backgrounds).astype(np.uint8), np.array(labels, dtype=np.int64))
+
+
+def generate_shard(executor, pool_folder, shard_id, generation, shard_size, resolution, seed=0, chunk_size=32):
+    """
+    Generates a shard in the processes of the executor and swaps it in place of the previous one.
+
+    Args:
+        executor (concurrent.futures.Executor): The generator processes, initialized by `init_worker`.
+        pool_folder (str): The pool folder.
+        shard_id (int): The shard to generate.
+        generation (int): The generation of the shard, which also seeds its samples.
+        shard_size (int): Number of samples of the shard.
+        resolution (int): Size of the saved images.
+        seed (int): The seed of the pool.
+        chunk_size (int): Number of samples generated by a task.
+    """
+    sizes = [min(chunk_size, shard_size - start) for start in range(0, shard_size, chunk_size)]
+    seeds = [hash((seed, generation, shard_id, chunk)) & 0x7FFFFFFF for chunk in range(len(sizes))]
+    chunks = list(executor.map(generate_samples, seeds, sizes, [resolution] * len(sizes)))
+    arrays = {key: np.concatenate([chunk[i] for chunk in chunks]) for i, key in enumerate(ARRAY_NAMES)}
+    meta = {'num_samples': shard_size, 'generation': generation, 'created': time.time()}
+    shard_path = get_shard_path(pool_folder, shard_id)
+    new_path, old_path = f'{shard_path}.new{os.getpid()}', f'{shard_path}.old{os.getpid()}'
+    save_index(new_path, meta, arrays)
+    # Swap the complete shard in with two renames, the shard folder is only missing in between
+    if os.path.isdir(shard_path):
+        os.rename(shard_path, old_path)
+    os.rename(new_path, shard_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def generate_pool(config, pool_folder, num_shards, shard_size, num_workers=None, refresh=False, seed=0):
+    """
+    Generates the missing shards of a pool, then regenerates the oldest shard in turn when refreshing.
+
+    Args:
+        config (dict): The training config of `FFBlendDataset`.
+        pool_folder (str): The pool folder.
+        num_shards (int): Number of shards of the pool.
+        shard_size (int): Number of samples of a shard.
+        num_workers (int): Number of generator processes.
+        refresh (bool): Whether to keep regenerating the shards, until interrupted.
+        seed (int): The seed of the pool.
+    """
+    os.makedirs(pool_folder, exist_ok=True)
+    resolution = config['resolution']
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker,
+                                                initargs=(config,)) as executor:
+        generations = {}
+        for shard_id in range(num_shards):
+            meta = read_shard_meta(get_shard_path(pool_folder, shard_id))
+            if meta is None or meta['num_samples'] != shard_size:
+                generate_shard(executor, pool_folder, shard_id, 0, shard_size, resolution, seed)
+                print(f"Generated shard {shard_id} of {num_shards}")
+                meta = {'generation': 0}
+            generations[shard_id] = meta['generation']
+
+        # Rolling refresh, the shard of the oldest generation first
+        while refresh:
+            shard_id = min(generations, key=lambda shard_id: (generations[shard_id], shard_id))
+            generations[shard_id] = max(generations.values()) + 1
+            start = time.perf_counter()
+            generate_shard(executor, pool_folder, shard_id, generations[shard_id], shard_size, resolution, seed)
+            print(f"Refreshed shard {shard_id} (generation {generations[shard_id]}) in {time.perf_counter() - start:.0f}s")
+
+
+if __name__ == '__main__':
+    import argparse
+    import yaml
+
+    parser = argparse.ArgumentParser(description='Generate the pool of blended images for Face X-ray.')
+    parser.add_argument('--detector_path', type=str, default='./config/detector/facexray.yaml')
+    parser.add_argument('--pool_folder', type=str, default='./preprocessing/bi_pool')
+    parser.add_argument('--num_shards', type=int, default=64)
+    parser.add_argument('--shard_size', type=int, default=1024, help='number of samples of a shard')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--refresh', action='store_true', help='keep regenerating the oldest shard, next to the training')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.detector_path, 'r') as f:
+        config = yaml.safe_load(f)
+    generate_pool(config, args.pool_folder, args.num_shards, args.shard_size, args.workers, args.refresh, args.seed)
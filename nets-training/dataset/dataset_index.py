@@ -0,0 +1,314 @@
+# description: Compiled binary index of the dataset JSON files.
+
+"""
+The `<dataset>.json` files list the path of every frame for every split and compression level, and
+parsing them takes seconds per dataset, in every process. The index compiled from a JSON file keeps:
+
+- the interned video folders (`prefixes`) and frame file names (`names`), shared by all the groups;
+- for each (dataset, split, compression) group, numpy arrays of the video folder, label and frame
+  offsets of every video, and the file name id of every frame.
+
+The arrays are saved as `.npy` files in `<dataset>.index/` next to the JSON file and memory-mapped at load,
+so a dataset is built from a few small arrays instead of hundreds of thousands of Python strings.
+"""
+
+import os
+import json
+import shutil
+import random
+
+import numpy as np
+
+# Bumped when the layout of the index changes, so the old indexes are compiled again
+INDEX_VERSION = 1
+
+
+class FramePathList:
+    """
+    A read-only list of frame paths, stored as ids into the interned video folders and file names.
+    Paths are built on access, so DataLoader workers share the numpy arrays instead of copying strings.
+    """
+    def __init__(self, prefixes, names, prefix_ids, name_ids):
+        self.prefixes = prefixes
+        self.names = names
+        self.prefix_ids = prefix_ids
+        self.name_ids = name_ids
+
+    @classmethod
+    def concatenate(cls, path_lists):
+        """
+        Concatenates several lists, each with its own tables of folders and file names.
+        """
+        prefixes, names, prefix_ids, name_ids = [], [], [], []
+        for path_list in path_lists:
+            prefix_ids.append(path_list.prefix_ids + len(prefixes))
+            name_ids.append(path_list.name_ids + len(names))
+            prefixes.extend(path_list.prefixes)
+            names.extend(path_list.names)
+        return cls(prefixes, names, np.concatenate(prefix_ids), np.concatenate(name_ids))
+
+    def __len__(self):
+        return len(self.prefix_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return os.path.join(self.prefixes[self.prefix_ids[index]], self.names[self.name_ids[index]])
+
+    def __iter__(self):
+        for prefix_id, name_id in zip(self.prefix_ids, self.name_ids):
+            yield os.path.join(self.prefixes[prefix_id], self.names[name_id])
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(list(self), dtype=dtype)
+
+
+def get_index_path(json_path):
+    """
+    Returns the folder of the index compiled from a JSON file.
+    """
+    return os.path.splitext(json_path)[0] + '.index'
+
+
+def iter_groups(dataset_info):
+    """
+    Groups the videos of a dataset JSON by (dataset, split, compression), in the order of the JSON.
+    Datasets without compression levels use the compression ''.
+
+    Returns:
+        dict_items: The group keys and the lists of (video name, video info) of every label.
+    """
+    groups = {}
+    for dataset_name, labels in dataset_info.items():
+        for label, splits in labels.items():
+            for split, split_info in splits.items():
+                # Either {compression: {video: info}} or directly {video: info}
+                if any(isinstance(info, dict) and 'frames' in info for info in split_info.values()):
+                    compressions = {'': split_info}
+                else:
+                    compressions = split_info
+                for compression, videos in compressions.items():
+                    groups.setdefault((dataset_name, split, compression), []).extend(videos.items())
+    return groups.items()
+
+
+def compile_index(json_path, index_path=None):
+    """
+    Compiles the index of a dataset JSON file.
+
+    Args:
+        json_path (str): The dataset JSON file.
+        index_path (str): The output folder, next to the JSON file by default. None skips saving.
+
+    Returns:
+        dict: The index, as returned by `load_index`.
+    """
+    with open(json_path, 'r') as f:
+        dataset_info = json.load(f)
+
+    prefixes, prefix_ids = [], {}
+    names, name_ids = [], {}
+    labels, label_ids = [], {}
+    groups, arrays = {}, {}
+
+    def intern(value, table, ids):
+        if value not in ids:
+            ids[value] = len(table)
+            table.append(value)
+        return ids[value]
+
+    for group_id, ((dataset_name, split, compression), videos) in enumerate(iter_groups(dataset_info)):
+        video_prefix, video_label, frame_offsets, frame_name = [], [], [0], []
+        for video_name, video_info in videos:
+            frames = video_info['frames']
+            # All the frames of a video share its folder, otherwise keep the JSON paths as they are
+            folder = os.path.dirname(frames[0]) if frames else ''
+            if not all(os.path.join(folder, os.path.basename(frame)) == frame for frame in frames):
+                folder = ''
+            video_prefix.append(intern(folder, prefixes, prefix_ids))
+            video_label.append(intern(video_info['label'], labels, label_ids))
+            for frame in frames:
+                frame_name.append(intern(os.path.basename(frame) if folder else frame, names, name_ids))
+            frame_offsets.append(len(frame_name))
+        key = f'group{group_id}'
+        groups[f'{dataset_name}/{split}/{compression}'] = key
+        arrays[f'{key}_video_prefix'] = np.array(video_prefix, dtype=np.int32)
+        arrays[f'{key}_video_label'] = np.array(video_label, dtype=np.int32)
+        arrays[f'{key}_frame_offsets'] = np.array(frame_offsets, dtype=np.int64)
+        arrays[f'{key}_frame_name'] = np.array(frame_name, dtype=np.int32)
+
+    stat = os.stat(json_path)
+    meta = {
+        'version': INDEX_VERSION,
+        'source_mtime_ns': stat.st_mtime_ns,
+        'source_size': stat.st_size,
+        'prefixes': prefixes,
+        'names': names,
+        'labels': labels,
+        'groups': groups,
+    }
+
+    if index_path is not None:
+        save_index(index_path, meta, arrays)
+    return {'meta': meta, 'arrays': arrays}
+
+
+def save_index(index_path, meta, arrays):
+    """
+    Saves an index into a temporary folder renamed once complete, so a concurrent reader never sees a partial index.
+    """
+    tmp_path = f'{index_path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    for key, array in arrays.items():
+        np.save(os.path.join(tmp_path, f'{key}.npy'), array)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.isdir(index_path):
+        shutil.rmtree(index_path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, index_path)
+    except OSError:
+        # Another process saved the same index in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def is_index_valid(index_path, json_path):
+    """
+    Checks whether the index exists and was compiled from the current JSON file.
+    """
+    meta_path = os.path.join(index_path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    stat = os.stat(json_path)
+    return meta.get('version') == INDEX_VERSION and meta['source_mtime_ns'] == stat.st_mtime_ns \
+        and meta['source_size'] == stat.st_size
+
+
+def load_index(json_path):
+    """
+    Loads the index of a dataset JSON file, compiling it first when it is missing or out of date.
+
+    Args:
+        json_path (str): The dataset JSON file.
+
+    Returns:
+        dict: 'meta' with the interned tables and the groups, and 'arrays' with the memory-mapped arrays.
+    """
+    index_path = get_index_path(json_path)
+    if not is_index_valid(index_path, json_path):
+        try:
+            return compile_index(json_path, index_path)
+        except OSError as e:
+            # Read-only dataset folder: use the index in memory
+            print(f"Could not save the index of {json_path}: {e}")
+            return compile_index(json_path, None)
+
+    with open(os.path.join(index_path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    arrays = {}
+    for key in meta['groups'].values():
+        for field in ['video_prefix', 'video_label', 'frame_offsets', 'frame_name']:
+            arrays[f'{key}_{field}'] = np.load(os.path.join(index_path, f'{key}_{field}.npy'), mmap_mode='r')
+    return {'meta': meta, 'arrays': arrays}
+
+
+def all_frame_paths(index, split=None):
+    """
+    Returns the frames of every group of an index, a frame listed in several groups once per group.
+
+    Args:
+        index (dict): The index returned by `load_index`.
+        split (str): Only the groups of this split, all the groups by default.
+
+    Returns:
+        FramePathList: The frame paths.
+    """
+    meta, arrays = index['meta'], index['arrays']
+    path_lists = []
+    for group, key in meta['groups'].items():
+        if split is not None and group.split('/')[1] != split:
+            continue
+        offsets = np.asarray(arrays[f'{key}_frame_offsets'])
+        prefix_ids = np.repeat(np.asarray(arrays[f'{key}_video_prefix']), np.diff(offsets))
+        path_lists.append(FramePathList(meta['prefixes'], meta['names'], prefix_ids, np.asarray(arrays[f'{key}_frame_name'])))
+    return FramePathList(meta['prefixes'], meta['names'],
+                         np.concatenate([path_list.prefix_ids for path_list in path_lists] or [np.zeros(0, np.int32)]),
+                         np.concatenate([path_list.name_ids for path_list in path_lists] or [np.zeros(0, np.int32)]))
+
+
+def select_frames(index, dataset_name, split, compression, frame_num, label_dict, excluded=None):
+    """
+    Selects `frame_num` frames evenly distributed throughout every video of a group and shuffles them,
+    as `DeepfakeAbstractBaseDataset.collect_img_and_label_for_one_dataset` does with the JSON file.
+
+    Args:
+        index (dict): The index returned by `load_index`.
+        dataset_name (str): The dataset, the top-level key of the JSON file.
+        split (str): 'train', 'val' or 'test'.
+        compression (str): The compression level, '' for the datasets without compression levels.
+        frame_num (int): The number of frames per video.
+        label_dict (dict): The mapping from the label names to the label ids.
+        excluded (set): The frame paths to leave out, e.g. the quarantined frames.
+
+    Returns:
+        FramePathList: The frame paths.
+        np.ndarray: The labels.
+    """
+    meta, arrays = index['meta'], index['arrays']
+    key = meta['groups'].get(f'{dataset_name}/{split}/{compression}')
+    if key is None:
+        raise KeyError(f'{dataset_name}/{split}/{compression} is not in the index')
+
+    # Only the labels of the videos of the group need to be in the configuration file
+    video_labels = np.asarray(arrays[f'{key}_video_label'])
+    label_ids = np.full(len(meta['labels']), -1, dtype=np.int64)
+    for label_id in np.unique(video_labels):
+        label = meta['labels'][label_id]
+        if label not in label_dict:
+            raise ValueError(f'Label {label} is not found in the configuration file.')
+        label_ids[label_id] = label_dict[label]
+
+    offsets = np.asarray(arrays[f'{key}_frame_offsets'])
+    starts, total_frames = offsets[:-1], np.diff(offsets)
+    # Videos longer than frame_num keep every step-th frame, the others keep all their frames
+    counts = np.where(total_frames > frame_num, frame_num, total_frames)
+    steps = np.where(total_frames > frame_num, total_frames // max(frame_num, 1), 1)
+    video_ids = np.repeat(np.arange(len(counts)), counts)
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    frame_ids = starts[video_ids] + positions * steps[video_ids]
+
+    # Shuffle the frames, following the seed of the `random` module as before
+    order = np.random.default_rng(random.getrandbits(32)).permutation(len(frame_ids))
+    video_ids, frame_ids = video_ids[order], frame_ids[order]
+
+    image_list = FramePathList(meta['prefixes'], meta['names'],
+                               np.asarray(arrays[f'{key}_video_prefix'])[video_ids],
+                               np.asarray(arrays[f'{key}_frame_name'])[frame_ids])
+    label_list = label_ids[video_labels[video_ids]]
+
+    if excluded:
+        # Only build the paths of the frames of the videos with excluded frames
+        excluded_folders = {os.path.dirname(path) for path in excluded}
+        excluded_prefixes = [i for i, prefix in enumerate(meta['prefixes']) if prefix in excluded_folders or not prefix]
+        keep = np.ones(len(image_list), dtype=bool)
+        for i in np.flatnonzero(np.isin(image_list.prefix_ids, excluded_prefixes)):
+            keep[i] = image_list[i] not in excluded
+        image_list = FramePathList(meta['prefixes'], meta['names'], image_list.prefix_ids[keep], image_list.name_ids[keep])
+        label_list = label_list[keep]
+    return image_list, label_list
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Compile the index of the dataset JSON files.')
+    parser.add_argument('--dataset_json_folder', type=str, default='./preprocessing/dataset_json')
+    parser.add_argument('--datasets', type=str, nargs='+', default=None, help='the datasets to compile, all by default')
+    args = parser.parse_args()
+    datasets = args.datasets or [os.path.splitext(file)[0] for file in sorted(os.listdir(args.dataset_json_folder))
+                                 if file.endswith('.json') and file != 'scan_cache.json']
+    for dataset_name in datasets:
+        json_path = os.path.join(args.dataset_json_folder, dataset_name + '.json')
+        compile_index(json_path, get_index_path(json_path))
+        print(f"Compiled the index of {dataset_name}")
@@ -31,10 +31,14 @@ from dataset.utils.face_align import get_align_mat_new
 from dataset.utils.color_transfer import color_transfer
 from dataset.utils.faceswap_utils import blendImages as alpha_blend_fea
 from dataset.utils.faceswap_utils import AlphaBlend as alpha_blend
+from dataset.utils.faceswap_utils import featherBlend
 from dataset.utils.face_aug import aug_one_im, change_res
 from dataset.utils.image_ae import get_pretraiend_ae
 from dataset.utils.warp import warp_mask
 from dataset.utils import faceswap
+from dataset.shared_cache import build_shared_cache, imread_cached
+from dataset.landmark_store import LandmarkStore
+from dataset.bi_pool import BIPool
 from scipy.ndimage.filters import gaussian_filter
 
 
@@ -56,6 +60,27 @@ class RandomDownScale(A.core.transforms_interface.ImageOnlyTransform):
 
 class FFBlendDataset(data.Dataset):
     def __init__(self, config=None):
+        self.transforms = T.Compose([
+            # T.GaussianBlur(kernel_size=3, sigma=(0.1, 2.0)),
+            # T.ColorJitter(hue=.05, saturation=.05),
+            # T.RandomHorizontalFlip(),
+            # T.RandomRotation(20, resample=Image.BILINEAR),
+            T.ToTensor(),
+            T.Normalize(mean=[0.5, 0.5, 0.5],
+                        std=[0.5, 0.5, 0.5])
+        ])
+        # Sample the blended images pre-generated by dataset/bi_pool.py, if configured
+        self.bi_pool = None
+        if config and config.get('bi_pool_folder'):
+            self.bi_pool = BIPool(config['bi_pool_folder'], config.get('bi_pool_reload_interval', 60))
+            # The sampler needs a fixed length, the pool wraps around the indices
+            self.num_samples = config.get('bi_pool_epoch_size') or len(self.bi_pool)
+            self.imid_list = None
+            self.data_dict = {
+                'imid_list': self.imid_list
+            }
+            return
+
         # Check if the dictionary has already been created
         if os.path.exists('training/lib/nearest_face_info.pkl'):
             with open('training/lib/nearest_face_info.pkl', 'rb') as f:
@@ -63,24 +88,23 @@ class FFBlendDataset(data.Dataset):
         else:
             raise ValueError(f"Need to run the dataset/generate_xray_nearest.py before training the face xray.")
         self.face_info = face_info
+        # Read the landmarks from the memory-mapped store when configured, shared by the DataLoader workers
+        if config and config.get('landmark_store_folder'):
+            landmark_dict = LandmarkStore(config['landmark_store_folder'])
         # Check if the dictionary has already been created
-        if os.path.exists('training/lib/landmark_dict_ffall.pkl'):
+        elif os.path.exists('training/lib/landmark_dict_ffall.pkl'):
             with open('training/lib/landmark_dict_ffall.pkl', 'rb') as f:
                 landmark_dict = pickle.load(f)
+        else:
+            raise ValueError(f"Need to build the landmark store with dataset/landmark_store.py, or the landmark_dict_ffall.pkl.")
         self.landmark_dict = landmark_dict
         self.imid_list = self.get_training_imglist()
-        self.transforms = T.Compose([
-            # T.GaussianBlur(kernel_size=3, sigma=(0.1, 2.0)),
-            # T.ColorJitter(hue=.05, saturation=.05),
-            # T.RandomHorizontalFlip(),
-            # T.RandomRotation(20, resample=Image.BILINEAR),
-            T.ToTensor(),
-            T.Normalize(mean=[0.5, 0.5, 0.5],
-                        std=[0.5, 0.5, 0.5])
-        ])
+        self.num_samples = len(self.imid_list)
         self.data_dict = {
             'imid_list': self.imid_list
         }
+        # Optional cache of the decoded frames in shared memory, shared by the DataLoader workers
+        self.shared_cache = build_shared_cache(config)
 
     # def data_aug(self, im):
     #     """
@@ -142,12 +166,12 @@ class FFBlendDataset(data.Dataset):
         """
         Load foreground and background images and face shapes.
         """
-        fg_im = cv2.imread(imid_fg.replace('landmarks', 'frames').replace('npy', 'png'))
+        fg_im = imread_cached(self.shared_cache, imid_fg.replace('landmarks', 'frames').replace('npy', 'png'))
         fg_im = np.array(self.data_aug(fg_im))
         fg_shape = self.landmark_dict[imid_fg]
         fg_shape = np.array(fg_shape, dtype=np.int32)
 
-        bg_im = cv2.imread(imid_bg.replace('landmarks', 'frames').replace('npy', 'png'))
+        bg_im = imread_cached(self.shared_cache, imid_bg.replace('landmarks', 'frames').replace('npy', 'png'))
         bg_im = np.array(self.data_aug(bg_im))
         bg_shape = self.landmark_dict[imid_bg]
         bg_shape = np.array(bg_shape, dtype=np.int32)
@@ -232,40 +256,13 @@ class FFBlendDataset(data.Dataset):
         """
         Blend foreground and background images together.
         """
-        # normalize the mask to have values between 0 and 1
-        b_mask = bg_mask / 255.
-
-        # Add an extra dimension and repeat the mask to match the number of channels in color_corrected_fg and bg_im
-        b_mask = np.repeat(b_mask[:, :, np.newaxis], 3, axis=2)
-
-        # Compute the alpha blending
-        maskIndices = np.where(b_mask != 0)
-        maskPts = np.hstack((maskIndices[1][:, np.newaxis], maskIndices[0][:, np.newaxis]))
+        # Feathered alpha blending inside the mask, vectorized with a distance transform
+        blended_image = featherBlend(color_corrected_fg, bg_im, bg_mask, featherAmount)
 
         # FIXME: deal with the bugs of empty maskpts
-        if maskPts.size == 0:
+        if blended_image is None:
             print(f"No non-zero values found in bg_mask for blending. Skipping this image.")
             return color_corrected_fg  # or handle this situation differently according to the needs
-
-        faceSize = np.max(maskPts, axis=0) - np.min(maskPts, axis=0)
-        featherAmount = featherAmount * np.max(faceSize)
-
-        hull = cv2.convexHull(maskPts)
-        dists = np.zeros(maskPts.shape[0])
-        for i in range(maskPts.shape[0]):
-            dists[i] = cv2.pointPolygonTest(hull, (int(maskPts[i, 0]), int(maskPts[i, 1])), True)
-
-        weights = np.clip(dists / featherAmount, 0, 1)
-
-        # Perform the blending operation
-        color_corrected_fg = color_corrected_fg.astype(float)
-        bg_im = bg_im.astype(float)
-        blended_image = np.copy(bg_im)
-        blended_image[maskIndices[0], maskIndices[1]] = weights[:, np.newaxis] * color_corrected_fg[maskIndices[0], maskIndices[1]] + (1 - weights[:, np.newaxis]) * bg_im[maskIndices[0], maskIndices[1]]
-        
-        # Convert the blended image to 8-bit unsigned integers
-        blended_image = np.clip(blended_image, 0, 255)
-        blended_image = blended_image.astype(np.uint8)
         return blended_image
 
 
@@ -361,14 +358,28 @@ class FFBlendDataset(data.Dataset):
         cv2.imwrite(save_path, canvas)
     
 
-    def __getitem__(self, index):
+    def generate_sample(self, index):
         """
-        Get an item from the dataset by index.
+        Runs the blending pipeline on the frame of an index as the background.
+
+        Returns:
+            tuple: The blended image, its boundary, the background image and its label.
         """
         one_lmk_path = self.imid_list[index]
         label = 1 if one_lmk_path.split('/')[6]=='manipulated_sequences' else 0
         imid_fg, imid_bg = self.get_fg_bg(one_lmk_path)
         manipulate_img, boundary, imid_bg = self.process_images(imid_fg, imid_bg, index)
+        return manipulate_img, boundary, imid_bg, label
+
+
+    def __getitem__(self, index):
+        """
+        Get an item from the dataset by index.
+        """
+        if self.bi_pool is not None:
+            manipulate_img, boundary, imid_bg, label = self.bi_pool.get(index)
+        else:
+            manipulate_img, boundary, imid_bg, label = self.generate_sample(index)
 
         manipulate_img = self.post_proc(manipulate_img)
         imid_bg = self.post_proc(imid_bg)
@@ -424,7 +435,7 @@ class FFBlendDataset(data.Dataset):
         """
         Get the length of the dataset.
         """
-        return len(self.imid_list)
+        return self.num_samples
 
 
 if __name__ == "__main__":
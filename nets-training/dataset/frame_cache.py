@@ -0,0 +1,202 @@
+# description: On-disk cache of the decoded frames, resized to the training resolution.
+
+"""
+`load_rgb` decodes, converts and resizes the same frames every epoch. The cache stores, for each video
+folder and resolution, the frames already converted to RGB and resized as `load_rgb` does, in one
+`.npy` array [num_frames, resolution, resolution, 3] of uint8 memory-mapped at read:
+
+    <cache_folder>/<resolution>/<sha1 of the video folder>.npy     the frames
+    <cache_folder>/<resolution>/<sha1 of the video folder>.json    the frame names, the unreadable frames and the checksum
+
+The checksum covers the name, size and mtime of every source frame, so a video is cached again as soon
+as one of its frames is added, removed or rewritten.
+"""
+
+import sys
+sys.path.append('.')
+
+import os
+import json
+import hashlib
+import concurrent.futures
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+# Extensions of the frames stored in the video folders
+FRAME_EXTENSIONS = ('.png', '.jpg')
+
+
+def read_resized_rgb(file_path, size):
+    """
+    Reads a frame in RGB and resizes it exactly as `DeepfakeAbstractBaseDataset.load_rgb`.
+    """
+    img = cv2.imread(file_path)
+    if img is None:
+        raise ValueError('Loaded image is None: {}'.format(file_path))
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return cv2.resize(img, (size, size), interpolation=cv2.INTER_CUBIC)
+
+
+def list_frames(video_dir):
+    """
+    Returns the sorted names of the frames of a video folder.
+    """
+    return sorted(name for name in os.listdir(video_dir) if name.endswith(FRAME_EXTENSIONS))
+
+
+def compute_checksum(video_dir, names):
+    """
+    Computes the checksum of the frames of a video folder from their names, sizes and mtimes.
+    """
+    checksum = hashlib.sha1()
+    for name in names:
+        stat = os.stat(os.path.join(video_dir, name))
+        checksum.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return checksum.hexdigest()
+
+
+class FrameCache:
+    """
+    The decoded-frame cache of one resolution. Videos are cached on first access, or beforehand with `build_all`.
+    """
+    def __init__(self, cache_folder, resolution, max_open=256):
+        """
+        Args:
+            cache_folder (str): The root folder of the cache.
+            resolution (int): The side of the cached frames.
+            max_open (int): Number of memory-mapped videos kept open per process.
+        """
+        self.cache_folder = os.path.join(cache_folder, str(resolution))
+        self.resolution = resolution
+        self.max_open = max_open
+        # Open videos, least recently used first, and the videos whose checksum was verified by this process
+        self.videos = OrderedDict()
+        self.verified = set()
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+    def get_cache_path(self, video_dir):
+        """
+        Returns the path of the cache of a video folder, without extension.
+        """
+        return os.path.join(self.cache_folder, hashlib.sha1(os.path.abspath(video_dir).encode()).hexdigest())
+
+    def build(self, video_dir):
+        """
+        Decodes, converts and resizes all the frames of a video folder into its cache. The unreadable frames
+        are left out and recorded with their error, so the other frames of the video are still cached.
+
+        Returns:
+            str: The checksum of the cached frames.
+        """
+        all_names = list_frames(video_dir)
+        checksum = compute_checksum(video_dir, all_names)
+        names, failed = [], {}
+        frames = np.zeros((len(all_names), self.resolution, self.resolution, 3), dtype=np.uint8)
+        for name in all_names:
+            try:
+                frames[len(names)] = read_resized_rgb(os.path.join(video_dir, name), self.resolution)
+            except (ValueError, cv2.error) as e:
+                failed[name] = str(e)
+                continue
+            names.append(name)
+        frames = frames[:len(names)]
+
+        # Write under temporary names then rename, DataLoader workers may build the same video concurrently
+        cache_path = self.get_cache_path(video_dir)
+        tmp_path = f'{cache_path}.tmp{os.getpid()}'
+        np.save(tmp_path + '.npy', frames)
+        with open(tmp_path + '.json', 'w') as f:
+            json.dump({'video_dir': video_dir, 'names': names, 'failed': failed, 'checksum': checksum}, f)
+        os.replace(tmp_path + '.npy', cache_path + '.npy')
+        os.replace(tmp_path + '.json', cache_path + '.json')
+        return checksum
+
+    def is_valid(self, video_dir):
+        """
+        Checks whether the cache of a video folder exists and matches its current frames.
+        """
+        cache_path = self.get_cache_path(video_dir)
+        if not os.path.exists(cache_path + '.json') or not os.path.exists(cache_path + '.npy'):
+            return False
+        with open(cache_path + '.json', 'r') as f:
+            meta = json.load(f)
+        return meta['checksum'] == compute_checksum(video_dir, list_frames(video_dir))
+
+    def open(self, video_dir):
+        """
+        Memory-maps the cache of a video folder, building it first when it is missing or out of date.
+
+        Returns:
+            tuple: The frames [num_frames, resolution, resolution, 3] and the row of every frame name.
+        """
+        if video_dir in self.videos:
+            self.videos.move_to_end(video_dir)
+            return self.videos[video_dir]
+        if video_dir not in self.verified:
+            if not self.is_valid(video_dir):
+                self.build(video_dir)
+            self.verified.add(video_dir)
+
+        cache_path = self.get_cache_path(video_dir)
+        with open(cache_path + '.json', 'r') as f:
+            names = json.load(f)['names']
+        video = (np.load(cache_path + '.npy', mmap_mode='r'), {name: i for i, name in enumerate(names)})
+        self.videos[video_dir] = video
+        # Every memory map holds a file descriptor, keep a bounded number open
+        if len(self.videos) > self.max_open:
+            self.videos.popitem(last=False)
+        return video
+
+    def get(self, file_path):
+        """
+        Returns a cached frame.
+
+        Args:
+            file_path (str): The path of the source frame.
+
+        Returns:
+            np.ndarray: The RGB frame [resolution, resolution, 3] of uint8, None if the frame is not in its folder
+                or could not be decoded.
+        """
+        video_dir, name = os.path.split(file_path)
+        frames, rows = self.open(video_dir)
+        if name not in rows:
+            return None
+        return np.array(frames[rows[name]])
+
+    def build_all(self, video_dirs, num_workers=None):
+        """
+        Caches every video folder that is missing or out of date, in parallel processes.
+
+        Returns:
+            int: The number of cached videos.
+        """
+        video_dirs = sorted(set(video_dirs))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            valid = list(executor.map(self.is_valid, video_dirs, chunksize=16))
+            todo = [video_dir for video_dir, is_valid in zip(video_dirs, valid) if not is_valid]
+            list(executor.map(self.build, todo, chunksize=4))
+        return len(todo)
+
+
+if __name__ == '__main__':
+    import argparse
+    from dataset.dataset_index import load_index
+
+    parser = argparse.ArgumentParser(description='Cache the resized frames of the datasets.')
+    parser.add_argument('--dataset_json_folder', type=str, default='./preprocessing/dataset_json')
+    parser.add_argument('--datasets', type=str, nargs='+', default=['FF-F2F', 'FF-DF', 'FF-FS', 'FF-NT'])
+    parser.add_argument('--cache_folder', type=str, default='./preprocessing/frame_cache')
+    parser.add_argument('--resolution', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    # Every video folder of the datasets, whatever the split and the compression
+    video_dirs = set()
+    for dataset_name in args.datasets:
+        index = load_index(os.path.join(args.dataset_json_folder, dataset_name + '.json'))
+        video_dirs.update(prefix for prefix in index['meta']['prefixes'] if prefix)
+    frame_cache = FrameCache(args.cache_folder, args.resolution)
+    print(f"Cached {frame_cache.build_all(video_dirs, num_workers=args.workers)} of {len(video_dirs)} videos")
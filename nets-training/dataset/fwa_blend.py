@@ -42,6 +42,8 @@ from scipy.ndimage.filters import gaussian_filter
 from skimage.transform import AffineTransform, warp
 
 from dataset.abstract_dataset import DeepfakeAbstractBaseDataset
+from dataset.shared_cache import imread_cached
+from dataset.alignment_store import AlignmentStore
 
 
 # Define face detector and predictor models
@@ -328,6 +330,10 @@ class FWABlendDataset(DeepfakeAbstractBaseDataset):
                         std=config['std'])
         ])
         self.resolution = config['resolution']
+        # Precomputed alignments of dataset/alignment_store.py, if configured
+        self.alignment_store = None
+        if config.get('alignment_store_folder'):
+            self.alignment_store = AlignmentStore(config['alignment_store_folder'])
 
 
     def blended_aug(self, im):
@@ -363,10 +369,12 @@ class FWABlendDataset(DeepfakeAbstractBaseDataset):
 
 
     def blend_images(self, img_path):
-        im = cv2.imread(img_path)
+        im = imread_cached(self.shared_cache, img_path)
 
-        # Get the alignment of the head
-        face_cache = align(im, face_detector, face_predictor)
+        # Get the alignment of the head, detected live for the frames missing from the store
+        face_cache = self.alignment_store.get(img_path) if self.alignment_store is not None else None
+        if face_cache is None:
+            face_cache = align(im, face_detector, face_predictor)
 
         # Get the aligned face and landmarks
         aligned_im_head, aligned_shape = get_aligned_face_and_landmarks(im, face_cache)
@@ -408,7 +416,7 @@ class FWABlendDataset(DeepfakeAbstractBaseDataset):
         blended_im, mask = self.blend_images(img_path)
 
         # Prepare images and titles for the combined image
-        imid_fg = cv2.imread(img_path)
+        imid_fg = imread_cached(self.shared_cache, img_path)
         imid_fg = np.array(self.data_aug(imid_fg))
 
         if blended_im is None or mask is None:
@@ -8,14 +8,19 @@ Alternatively, you can utilize the pre-generated pkl files available in our GitH
 '''
 
 import os
+import sys
+sys.path.append('.')
 import json
 import pickle
+import hashlib
 import numpy as np
 import heapq
-import random
 from tqdm import tqdm
 from scipy.spatial import KDTree
 
+from dataset.landmark_store import (LandmarkStore, PathIndexedStore, build_landmark_store, hash_path,
+                                    save_path_indexed_store, to_landmark_path)
+
 
 def load_landmark(file_path):
     """
@@ -65,72 +70,196 @@ def get_landmark_dict(dataset_folder):
     return landmark_dict
 
 
-def get_nearest_faces_fixed_pair(landmark_info, num_neighbors):
-    '''
-    Using KDTree to find the nearest faces for each image (Much faster!!)
-    '''
-    random.seed(1024)  # Fix the random seed for reproducibility
+def get_landmark_store(dataset_folder, store_folder):
+    """
+    Loads the landmark store of the FF-real c23 frames, building it first from the per-frame files.
+    Frames without landmark file are left out, instead of getting zero landmarks as in `get_landmark_dict`.
+    """
+    if not os.path.exists(os.path.join(store_folder, 'meta.json')):
+        metadata_path = os.path.join(dataset_folder, "FaceForensics++.json")
+        with open(metadata_path, "r") as f:
+            metadata = json.load(f)
+        ff_real_data = metadata['FaceForensics++']['FF-real']
+        landmark_paths = [
+            to_landmark_path(frame_path)
+            for mode, value in ff_real_data.items()
+            for video_name, video_info in value['c23'].items()
+            for frame_path in video_info['frames']
+        ]
+        build_landmark_store(landmark_paths, store_folder)
+    return LandmarkStore(store_folder)
+
+
+def get_landmarks_array(landmark_info):
+    """
+    Returns the flattened landmarks [N, 162] of a landmark dict or store, in the order of its keys.
+    """
+    if isinstance(landmark_info, LandmarkStore):
+        return np.asarray(landmark_info.landmarks).reshape(len(landmark_info), -1)
+    return np.array([lmk.flatten() for lmk in landmark_info.values()])
 
-    # Check if the dictionary has already been created
-    if os.path.exists('nearest_face_info.pkl'):
-        with open('nearest_face_info.pkl', 'rb') as f:
-            return pickle.load(f)
 
-    landmarks_array = np.array([lmk.flatten() for lmk in landmark_info.values()])
-    landmark_ids = list(landmark_info.keys())
+def landmark_set_hash(paths, landmarks):
+    """
+    Hashes a set of landmark paths and their landmarks, whatever their order.
+    """
+    key_hashes = np.array([hash_path(path) for path in paths], dtype=np.int64)
+    order = np.argsort(key_hashes, kind='stable')
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(key_hashes[order].tobytes())
+    digest.update(np.ascontiguousarray(landmarks[order], dtype=np.float32).tobytes())
+    return digest.hexdigest()
 
-    # Build a KDTree using the flattened landmarks
-    tree = KDTree(landmarks_array)
 
-    nearest_faces = {}
-    for idx, this_lmk in tqdm(enumerate(landmarks_array), total=len(landmarks_array)):
-        # Query the KDTree for the nearest neighbors (excluding itself)
-        dists, indices = tree.query(this_lmk, k=num_neighbors + 1)
-        # Randomly pick one from the nearest N neighbors (excluding itself)
-        picked_idx = random.choice(indices[1:])
-        nearest_faces[landmark_ids[idx]] = landmark_ids[picked_idx]
+class NeighborIndex(PathIndexedStore):
+    """
+    The nearest faces of every landmark path, persisted with the landmark set it was built from.
+    The neighbours are rows of the index, sorted by distance.
+    """
+    array_names = ('landmarks', 'neighbors', 'distances')
 
-    # Save the dictionary to a pickle file
-    with open('nearest_face_info.pkl', 'wb') as f:
-        pickle.dump(nearest_faces, f)
+    def to_dict(self):
+        """
+        Returns the dict from every landmark path to its nearest landmark paths, as `FFBlendDataset` loads it.
+        """
+        paths = list(self.keys())
+        return {paths[row]: [paths[i] for i in neighbors] for row, neighbors in enumerate(self.arrays['neighbors'])}
 
-    return nearest_faces
 
+def query_neighbors(tree, points, num_neighbors, rows=None, workers=-1, chunk_size=65536):
+    """
+    Queries the nearest neighbours of the points in batches, each one in parallel threads.
 
-def get_nearest_faces(landmark_info, num_neighbors):
-    '''
-    Using KDTree to find the nearest faces for each image (Much faster!!)
-    '''
-    random.seed(1024)  # Fix the random seed for reproducibility
+    Args:
+        tree (KDTree): The tree of the candidate landmarks.
+        points (np.ndarray): The query landmarks [N, D].
+        num_neighbors (int): Number of neighbours of every point.
+        rows (np.ndarray): The rows of the points in the tree, excluded from their own neighbours.
+        workers (int): Number of threads of a query, -1 for all the cores.
+        chunk_size (int): Number of points of a query, bounding the memory of the results.
+
+    Returns:
+        tuple: The distances (float32) and the rows (int32) of the neighbours [N, num_neighbors].
+    """
+    # A list of k always returns [N, k] arrays, even for a single neighbour
+    k = np.arange(1, num_neighbors + (rows is not None) + 1)
+    all_dists, all_indices = [], []
+    for start in range(0, len(points), chunk_size):
+        dists, indices = tree.query(points[start:start + chunk_size], k=k, workers=workers)
+        if rows is not None:
+            # Drop the point itself, or the farthest neighbour when duplicates ranked it out
+            keep = indices != rows[start:start + chunk_size, None]
+            keep[keep.all(axis=1), -1] = False
+            dists = dists[keep].reshape(len(keep), -1)
+            indices = indices[keep].reshape(len(keep), -1)
+        all_dists.append(dists.astype(np.float32))
+        all_indices.append(indices.astype(np.int32))
+    if not all_dists:
+        return np.zeros((0, len(k) - (rows is not None)), np.float32), np.zeros((0, len(k) - (rows is not None)), np.int32)
+    return np.concatenate(all_dists), np.concatenate(all_indices)
 
-    # Check if the dictionary has already been created
-    if os.path.exists('nearest_face_info_new.pkl'):
-        with open('nearest_face_info_new.pkl', 'rb') as f:
-            return pickle.load(f)
 
-    landmarks_array = np.array([lmk.flatten() for lmk in landmark_info.values()])
-    landmark_ids = list(landmark_info.keys())
+def build_neighbor_index(landmark_info, index_folder, num_neighbors, workers=-1):
+    """
+    Loads the neighbour index of a landmark dict or store, building or updating it first when needed.
 
-    # Build a KDTree using the flattened landmarks
-    tree = KDTree(landmarks_array)
+    The index is reused when it was built from the same landmark set. When the landmark set only gained
+    new paths (e.g. new videos), the new paths are queried against all the landmarks and the neighbours of
+    the indexed ones are merged with the new paths, instead of rebuilding the index.
 
-    nearest_faces = {}
-    for idx, this_lmk in tqdm(enumerate(landmarks_array), total=len(landmarks_array)):
-        # Query the KDTree for the nearest neighbors (excluding itself)
-        dists, indices = tree.query(this_lmk, k=num_neighbors + 1)
-        # Store the nearest N neighbors (excluding itself)
-        nearest_faces[landmark_ids[idx]] = [landmark_ids[i] for i in indices[1:]]
+    Args:
+        landmark_info: The landmark dict or `LandmarkStore`.
+        index_folder (str): The folder of the index.
+        num_neighbors (int): Number of neighbours of every path.
+        workers (int): Number of threads of the queries, -1 for all the cores.
 
-    # Save the dictionary to a pickle file
-    with open('nearest_face_info_new.pkl', 'wb') as f:
-        pickle.dump(nearest_faces, f)
+    Returns:
+        NeighborIndex: The index.
+    """
+    paths = list(landmark_info.keys())
+    landmarks = get_landmarks_array(landmark_info).astype(np.float32)
+    landmark_hash = landmark_set_hash(paths, landmarks)
+    num_neighbors = min(num_neighbors, len(paths) - 1)
+
+    index = None
+    if os.path.exists(os.path.join(index_folder, 'meta.json')):
+        index = NeighborIndex(index_folder)
+        if index.meta['num_neighbors'] != num_neighbors:
+            index = None
+        elif index.meta['landmark_hash'] == landmark_hash:
+            return index
+
+    new_rows = np.arange(len(paths))
+    if index is not None:
+        # Incremental only if the indexed paths are all still there, with the same landmarks
+        rows = {path: row for row, path in enumerate(paths)}
+        indexed_rows = np.array([rows.get(path, -1) for path in index.keys()], dtype=np.int64)
+        if (indexed_rows >= 0).all() and np.array_equal(landmarks[indexed_rows], index.arrays['landmarks']):
+            new_rows = np.setdiff1d(new_rows, indexed_rows)
+        else:
+            index = None
+
+    if index is None:
+        tree = KDTree(landmarks)
+        distances, neighbors = query_neighbors(tree, landmarks, num_neighbors, np.arange(len(paths)), workers)
+    else:
+        # The indexed rows first, then the new ones
+        order = np.concatenate([indexed_rows, new_rows])
+        paths = [paths[row] for row in order]
+        landmarks = landmarks[order]
+        num_indexed = len(indexed_rows)
 
-    return nearest_faces
+        # The new paths among all the landmarks
+        new_distances, new_neighbors = query_neighbors(
+            KDTree(landmarks), landmarks[num_indexed:], num_neighbors, np.arange(num_indexed, len(paths)), workers)
+        # The new paths among the neighbours of the indexed ones, merged by distance
+        candidate_distances, candidate_neighbors = query_neighbors(
+            KDTree(landmarks[num_indexed:]), landmarks[:num_indexed], min(num_neighbors, len(new_rows)), None, workers)
+        candidate_distances = np.concatenate([np.asarray(index.arrays['distances']), candidate_distances], axis=1)
+        candidate_neighbors = np.concatenate([np.asarray(index.arrays['neighbors']), candidate_neighbors + num_indexed], axis=1)
+        closest = np.argsort(candidate_distances, axis=1, kind='stable')[:, :num_neighbors]
+        distances = np.concatenate([np.take_along_axis(candidate_distances, closest, axis=1), new_distances])
+        neighbors = np.concatenate([np.take_along_axis(candidate_neighbors, closest, axis=1), new_neighbors])
+
+    save_path_indexed_store(index_folder, paths, {
+        'landmarks': landmarks,
+        'neighbors': neighbors.astype(np.int32),
+        'distances': distances.astype(np.float32),
+    }, meta={'landmark_hash': landmark_hash, 'num_neighbors': num_neighbors})
+    return NeighborIndex(index_folder)
+
+
+def get_nearest_faces_fixed_pair(landmark_info, num_neighbors, index_folder):
+    '''
+    Randomly pick one of the nearest faces for each image
+    '''
+    index = build_neighbor_index(landmark_info, index_folder, num_neighbors)
+    paths = list(index.keys())
+    neighbors = np.asarray(index.arrays['neighbors'])
+
+    # Randomly pick one from the nearest N neighbors (excluding itself), with a fixed seed for reproducibility
+    rng = np.random.RandomState(1024)
+    picked = neighbors[np.arange(len(paths)), rng.randint(neighbors.shape[1], size=len(paths))]
+    return {path: paths[picked_idx] for path, picked_idx in zip(paths, picked)}
+
+
+def get_nearest_faces(landmark_info, num_neighbors, index_folder):
+    '''
+    Using KDTree to find the nearest faces for each image (Much faster!!)
+    '''
+    return build_neighbor_index(landmark_info, index_folder, num_neighbors).to_dict()
 
 # Load the landmark dictionary and obtain the landmark dict
 dataset_folder = "/home/zhiyuanyan/disfin/deepfake_benchmark/preprocessing/dataset_json/"
-landmark_info = get_landmark_dict(dataset_folder)
+landmark_store_folder = "/home/zhiyuanyan/disfin/deepfake_benchmark/preprocessing/landmark_store/"
+landmark_info = get_landmark_store(dataset_folder, landmark_store_folder)
 
-# Get the nearest faces for each image (in landmark_dict)
+# Get the nearest faces for each image (in landmark_dict), from the index next to the landmark store
 num_neighbors = 100
-nearest_faces_info = get_nearest_faces(landmark_info, num_neighbors)  # running time: about 20 mins
+index_folder = os.path.join(os.path.dirname(os.path.normpath(landmark_store_folder)), 'nearest_face_index')
+nearest_faces_info = get_nearest_faces(landmark_info, num_neighbors, index_folder)
+
+# Save the dictionary where FFBlendDataset loads it
+os.makedirs('training/lib', exist_ok=True)
+with open('training/lib/nearest_face_info.pkl', 'wb') as f:
+    pickle.dump(nearest_faces_info, f)
@@ -0,0 +1,211 @@
+# description: Memory-mapped store of the facial landmarks of all the frames.
+
+"""
+The landmarks are saved as one `.npy` file per frame, and pickled into large dicts for the blending datasets.
+The store keeps all of them in a single contiguous array, memory-mapped so the DataLoader workers share its pages:
+
+    <store_folder>/landmarks.npy     float32 [N, 81, 2]
+    <store_folder>/key_hashes.npy    sorted hashes of the landmark paths, and key_rows.npy their rows
+    <store_folder>/prefix_ids.npy    interned landmark paths of the rows, with name_ids.npy and meta.json
+
+A lookup is a binary search on the hashes followed by one slice of the array.
+"""
+
+import sys
+sys.path.append('.')
+
+import os
+import json
+import hashlib
+import concurrent.futures
+
+import numpy as np
+
+from dataset.dataset_index import FramePathList, all_frame_paths, load_index, save_index
+
+NUM_LANDMARKS = 81
+
+
+def hash_path(path):
+    """
+    Hashes a landmark path to an int64.
+    """
+    return int.from_bytes(hashlib.blake2b(path.encode(), digest_size=8).digest(), 'little', signed=True)
+
+
+def to_landmark_path(frame_path):
+    """
+    Returns the landmark file of a frame, as `DeepfakeAbstractBaseDataset.__getitem__`.
+    """
+    return frame_path.replace('frames', 'landmarks').replace('.png', '.npy')
+
+
+def read_landmark(path):
+    """
+    Reads a per-frame landmark file, None if it is missing.
+    """
+    if not os.path.exists(path):
+        return None
+    return np.float32(np.load(path))
+
+
+class PathIndexedStore:
+    """
+    Memory-mapped arrays with one row per path, looked up by the hash of the path.
+    """
+    # The arrays of the rows, saved as <name>.npy
+    array_names = ()
+
+    def __init__(self, store_folder):
+        self.store_folder = store_folder
+        with open(os.path.join(store_folder, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.arrays = {name: np.load(os.path.join(store_folder, f'{name}.npy'), mmap_mode='r') for name in self.array_names}
+        self.key_hashes = np.load(os.path.join(store_folder, 'key_hashes.npy'), mmap_mode='r')
+        self.key_rows = np.load(os.path.join(store_folder, 'key_rows.npy'), mmap_mode='r')
+        self.paths = FramePathList(self.meta['prefixes'], self.meta['names'],
+                                   np.load(os.path.join(store_folder, 'prefix_ids.npy'), mmap_mode='r'),
+                                   np.load(os.path.join(store_folder, 'name_ids.npy'), mmap_mode='r'))
+
+    def get_row(self, path):
+        """
+        Returns the row of a path, None if it is not in the store.
+        """
+        key_hash = hash_path(path)
+        i = np.searchsorted(self.key_hashes, key_hash)
+        if i < len(self.key_hashes) and self.key_hashes[i] == key_hash:
+            return int(self.key_rows[i])
+        return None
+
+    def __contains__(self, path):
+        return self.get_row(path) is not None
+
+    def __len__(self):
+        return len(self.key_hashes)
+
+    def keys(self):
+        """
+        Returns the paths, in the order of the rows.
+        """
+        return self.paths
+
+
+def save_path_indexed_store(store_folder, paths, arrays, meta=None):
+    """
+    Saves the arrays of the rows of paths as a store, replacing the previous one atomically.
+
+    Args:
+        store_folder (str): The output folder.
+        paths (list): The path of every row.
+        arrays (dict): The arrays, with one row per path.
+        meta (dict): Extra fields of meta.json.
+    """
+    # Intern the folders and file names of the paths, as the dataset index does
+    prefix_ids, name_ids = {}, {}
+    rows_prefix, rows_name = [], []
+    for path in paths:
+        folder, name = os.path.split(path)
+        rows_prefix.append(prefix_ids.setdefault(folder, len(prefix_ids)))
+        rows_name.append(name_ids.setdefault(name, len(name_ids)))
+
+    key_hashes = np.array([hash_path(path) for path in paths], dtype=np.int64)
+    order = np.argsort(key_hashes, kind='stable')
+    if len(np.unique(key_hashes)) != len(key_hashes):
+        raise ValueError('Duplicated paths in the store')
+    arrays = dict(arrays)
+    arrays.update({
+        'key_hashes': key_hashes[order],
+        'key_rows': order.astype(np.int64),
+        'prefix_ids': np.array(rows_prefix, dtype=np.int32),
+        'name_ids': np.array(rows_name, dtype=np.int32),
+    })
+    meta = dict(meta or {}, num_rows=len(paths), prefixes=list(prefix_ids), names=list(name_ids))
+    save_index(store_folder, meta, arrays)
+
+
+class LandmarkStore(PathIndexedStore):
+    """
+    Read-only mapping from the landmark paths to their landmarks [81, 2], backed by the memory-mapped store.
+    """
+    array_names = ('landmarks',)
+
+    def __init__(self, store_folder):
+        super().__init__(store_folder)
+        self.landmarks = self.arrays['landmarks']
+
+    def get(self, path, default=None):
+        """
+        Returns a copy of the landmarks of a path, `default` if it is not in the store.
+        """
+        row = self.get_row(path)
+        return default if row is None else np.array(self.landmarks[row])
+
+    def __getitem__(self, path):
+        row = self.get_row(path)
+        if row is None:
+            raise KeyError(path)
+        return np.array(self.landmarks[row])
+
+
+def save_landmark_store(store_folder, paths, landmarks):
+    """
+    Saves a store from the landmark paths and their landmarks [N, 81, 2].
+    """
+    save_path_indexed_store(store_folder, paths, {'landmarks': np.asarray(landmarks, dtype=np.float32)})
+
+
+def build_landmark_store(landmark_paths, store_folder, num_workers=16):
+    """
+    Builds a store from the per-frame landmark files. The missing files are skipped.
+
+    Args:
+        landmark_paths (iterable): The landmark files.
+        store_folder (str): The output folder.
+        num_workers (int): Number of threads reading the files.
+
+    Returns:
+        int: The number of stored landmarks.
+    """
+    landmark_paths = sorted(set(landmark_paths))
+    paths, landmarks = [], []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for path, landmark in zip(landmark_paths, executor.map(read_landmark, landmark_paths)):
+            if landmark is not None:
+                paths.append(path)
+                landmarks.append(landmark.reshape(NUM_LANDMARKS, 2))
+    save_landmark_store(store_folder, paths, np.stack(landmarks) if landmarks else np.zeros((0, NUM_LANDMARKS, 2)))
+    return len(paths)
+
+
+def build_landmark_store_from_dict(landmark_dict, store_folder):
+    """
+    Builds a store from a pickled landmark dict, e.g. `landmark_dict_ffall.pkl`.
+    """
+    paths = list(landmark_dict.keys())
+    landmarks = np.stack([np.asarray(landmark_dict[path], dtype=np.float32).reshape(NUM_LANDMARKS, 2) for path in paths])
+    save_landmark_store(store_folder, paths, landmarks)
+    return len(paths)
+
+
+if __name__ == '__main__':
+    import argparse
+    import pickle
+
+    parser = argparse.ArgumentParser(description='Build the landmark store from the per-frame files or a landmark pickle.')
+    parser.add_argument('--dataset_json_folder', type=str, default='./preprocessing/dataset_json')
+    parser.add_argument('--datasets', type=str, nargs='+', default=['FaceForensics++'])
+    parser.add_argument('--from_pickle', type=str, default=None, help='a pickled landmark dict, instead of the datasets')
+    parser.add_argument('--store_folder', type=str, default='./preprocessing/landmark_store')
+    args = parser.parse_args()
+
+    if args.from_pickle:
+        with open(args.from_pickle, 'rb') as f:
+            num_landmarks = build_landmark_store_from_dict(pickle.load(f), args.store_folder)
+    else:
+        # The landmark files of every frame of the datasets, whatever the split and the compression
+        landmark_paths = set()
+        for dataset_name in args.datasets:
+            index = load_index(os.path.join(args.dataset_json_folder, dataset_name + '.json'))
+            landmark_paths.update(to_landmark_path(frame) for frame in all_frame_paths(index))
+        num_landmarks = build_landmark_store(landmark_paths, args.store_folder)
+    print(f"Stored {num_landmarks} landmarks in {args.store_folder}")
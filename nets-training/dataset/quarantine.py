@@ -0,0 +1,196 @@
+# description: Validation pass of the indexed frames and quarantine list of the unreadable ones.
+
+"""
+A frame that cannot be decoded is only noticed by `__getitem__` during the training, every epoch. The validation
+pass decodes every frame of a dataset index once, in parallel processes, with its mask and landmark files when
+configured, and writes the unreadable ones to the quarantine list of the dataset:
+
+    <dataset_json_folder>/quarantine/<dataset>.json    {'videos': {video folder: {'signature', 'bad': {frame: reason}}}}
+
+The signature of a video covers the name, size and mtime of its checked files, so a new pass only decodes the
+videos added or changed since the last one. `DeepfakeAbstractBaseDataset` excludes the quarantined frames.
+"""
+
+import sys
+sys.path.append('.')
+
+import os
+import json
+import hashlib
+import concurrent.futures
+from collections import Counter
+
+import cv2
+import numpy as np
+
+from dataset.dataset_index import load_index, all_frame_paths
+
+
+def get_quarantine_path(json_path):
+    """
+    Returns the quarantine list of a dataset JSON file.
+    """
+    folder, file_name = os.path.split(json_path)
+    return os.path.join(folder, 'quarantine', file_name)
+
+
+def get_sample_paths(frame_path):
+    """
+    Returns the mask and landmark files of a frame, as `DeepfakeAbstractBaseDataset.__getitem__`.
+    """
+    return frame_path.replace('frames', 'masks'), frame_path.replace('frames', 'landmarks').replace('.png', '.npy')
+
+
+def compute_signature(frame_paths, with_mask, with_landmark):
+    """
+    Computes the signature of the files of a video from their names, sizes and mtimes.
+    """
+    signature = hashlib.sha1(f'{with_mask}:{with_landmark};'.encode())
+    for frame_path in frame_paths:
+        mask_path, landmark_path = get_sample_paths(frame_path)
+        for path, checked in ((frame_path, True), (mask_path, with_mask), (landmark_path, with_landmark)):
+            if not checked:
+                continue
+            try:
+                stat = os.stat(path)
+                signature.update(f'{path}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+            except OSError:
+                signature.update(f'{path}:missing;'.encode())
+    return signature.hexdigest()
+
+
+def validate_frame(frame_path, with_mask, with_landmark):
+    """
+    Decodes a frame, and its mask and landmark files when they exist, as the dataset loads them.
+
+    Returns:
+        str: The reason why the frame is unreadable, None if it is readable.
+    """
+    if not os.path.exists(frame_path):
+        return 'missing frame'
+    if cv2.imread(frame_path) is None:
+        return 'unreadable frame'
+    mask_path, landmark_path = get_sample_paths(frame_path)
+    # The dataset uses zeros for the missing masks and landmarks
+    if with_mask and os.path.exists(mask_path) and cv2.imread(mask_path, 0) is None:
+        return 'unreadable mask'
+    if with_landmark and os.path.exists(landmark_path):
+        try:
+            landmark = np.load(landmark_path)
+        except Exception:
+            return 'unreadable landmark'
+        if landmark.size != 81 * 2:
+            return 'invalid landmark'
+    return None
+
+
+def validate_video(video_dir, frame_paths, with_mask, with_landmark):
+    """
+    Validates the frames of a video.
+
+    Returns:
+        tuple: The video folder, its signature and the reasons of its unreadable frames.
+    """
+    signature = compute_signature(frame_paths, with_mask, with_landmark)
+    bad = {}
+    for frame_path in frame_paths:
+        reason = validate_frame(frame_path, with_mask, with_landmark)
+        if reason is not None:
+            bad[frame_path] = reason
+    return video_dir, signature, bad
+
+
+def load_quarantine(json_path):
+    """
+    Loads the quarantine list of a dataset JSON file.
+
+    Returns:
+        dict: The validated videos, empty if the dataset was never validated.
+    """
+    quarantine_path = get_quarantine_path(json_path)
+    if not os.path.exists(quarantine_path):
+        return {}
+    with open(quarantine_path, 'r') as f:
+        return json.load(f)['videos']
+
+
+def load_quarantined_frames(json_path):
+    """
+    Returns the set of the quarantined frame paths of a dataset JSON file.
+    """
+    return {frame_path for video in load_quarantine(json_path).values() for frame_path in video['bad']}
+
+
+def validate_dataset(json_path, with_mask=False, with_landmark=False, num_workers=None, incremental=True):
+    """
+    Validates the frames of a dataset index and writes its quarantine list.
+
+    Args:
+        json_path (str): The dataset JSON file.
+        with_mask (bool): Whether to also decode the masks.
+        with_landmark (bool): Whether to also load the landmarks.
+        num_workers (int): Number of processes.
+        incremental (bool): Whether to skip the videos whose files did not change since the last pass.
+
+    Returns:
+        dict: The number of videos, of frames, of validated videos and of quarantined frames per reason.
+    """
+    # Group the frames of every split and compression by video folder
+    videos = {}
+    for frame_path in all_frame_paths(load_index(json_path)):
+        videos.setdefault(os.path.dirname(frame_path), set()).add(frame_path)
+    videos = {video_dir: sorted(frame_paths) for video_dir, frame_paths in videos.items()}
+
+    previous = load_quarantine(json_path) if incremental else {}
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        # The signatures are computed in the processes too, stat calls are slow on network storage
+        signatures = executor.map(compute_signature, videos.values(), [with_mask] * len(videos),
+                                  [with_landmark] * len(videos), chunksize=16)
+        todo = []
+        for video_dir, signature in zip(videos, signatures):
+            if video_dir in previous and previous[video_dir]['signature'] == signature:
+                results[video_dir] = previous[video_dir]
+            else:
+                todo.append(video_dir)
+        futures = [executor.submit(validate_video, video_dir, videos[video_dir], with_mask, with_landmark)
+                   for video_dir in todo]
+        for future in concurrent.futures.as_completed(futures):
+            video_dir, signature, bad = future.result()
+            results[video_dir] = {'signature': signature, 'bad': bad}
+
+    # Write under a temporary name then rename, the training may read the list concurrently
+    quarantine_path = get_quarantine_path(json_path)
+    os.makedirs(os.path.dirname(quarantine_path), exist_ok=True)
+    tmp_path = f'{quarantine_path}.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump({'with_mask': with_mask, 'with_landmark': with_landmark, 'videos': results}, f)
+    os.replace(tmp_path, quarantine_path)
+
+    reasons = Counter(reason for video in results.values() for reason in video['bad'].values())
+    return {
+        'videos': len(videos),
+        'frames': sum(len(frame_paths) for frame_paths in videos.values()),
+        'validated_videos': len(todo),
+        'quarantined': dict(reasons),
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Validate the frames of the datasets and write their quarantine lists.')
+    parser.add_argument('--dataset_json_folder', type=str, default='./preprocessing/dataset_json')
+    parser.add_argument('--datasets', type=str, nargs='+', default=['FF-F2F', 'FF-DF', 'FF-FS', 'FF-NT'])
+    parser.add_argument('--with_mask', action='store_true', help='also decode the masks')
+    parser.add_argument('--with_landmark', action='store_true', help='also load the landmarks')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--full', action='store_true', help='validate all the videos, not only the changed ones')
+    args = parser.parse_args()
+
+    for dataset_name in args.datasets:
+        report = validate_dataset(os.path.join(args.dataset_json_folder, dataset_name + '.json'),
+                                  args.with_mask, args.with_landmark, args.workers, incremental=not args.full)
+        quarantined = ', '.join(f'{count} {reason}' for reason, count in sorted(report['quarantined'].items()))
+        print(f"{dataset_name}: {report['frames']} frames in {report['videos']} videos, "
+              f"{report['validated_videos']} videos validated, quarantined: {quarantined or 'none'}")
@@ -0,0 +1,72 @@
+# description: Shuffling sampler that can resume an epoch at the sample where the training stopped.
+
+"""
+Resuming a training by skipping the batches of the DataLoader still loads, decodes and augments every
+skipped sample. `ResumableSampler` draws the permutation of every epoch from (seed, epoch) only, so the
+checkpoint only needs the seed, the epoch and the number of samples already trained: the resumed DataLoader
+starts at that position of the same permutation, without loading the skipped samples.
+"""
+
+import torch
+from torch.utils.data import Sampler
+
+
+class ResumableSampler(Sampler):
+    """
+    Random permutation of the dataset seeded by (seed, epoch), starting at a position of the epoch.
+    """
+    def __init__(self, num_samples, seed=0, shuffle=True):
+        """
+        Args:
+            num_samples (int): The length of the dataset.
+            seed (int): The seed of the permutations.
+            shuffle (bool): Whether to shuffle, otherwise the samples are in order.
+        """
+        self.num_samples = num_samples
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        """
+        Sets the epoch of the next iteration. A new epoch starts at its first sample.
+        """
+        if epoch != self.epoch:
+            self.start = 0
+        self.epoch = epoch
+
+    def permutation(self):
+        """
+        Returns the order of the samples of the current epoch.
+        """
+        if not self.shuffle:
+            return torch.arange(self.num_samples)
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return torch.randperm(self.num_samples, generator=generator)
+
+    def __iter__(self):
+        return iter(self.permutation()[self.start:].tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def state_dict(self, position):
+        """
+        Returns the state to save in a checkpoint.
+
+        Args:
+            position (int): The number of samples of the current epoch already trained.
+        """
+        return {'seed': self.seed, 'epoch': self.epoch, 'position': position, 'num_samples': self.num_samples}
+
+    def load_state_dict(self, state):
+        """
+        Restores the state of a checkpoint, the next iteration starts at its position.
+        """
+        if state['num_samples'] != self.num_samples:
+            raise ValueError(f"The checkpoint sampled {state['num_samples']} samples, the dataset has {self.num_samples}")
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.start = min(state['position'], self.num_samples)
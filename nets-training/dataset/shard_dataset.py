@@ -0,0 +1,399 @@
+# description: Packed tar shards of frames, masks and landmarks, and the datasets reading them.
+
+"""
+Every sample of `DeepfakeAbstractBaseDataset` opens up to three small files, which is slow on network
+filesystems. The converter packs the selected frames of a (dataset, split, compression) into tar shards,
+one video never spanning two shards:
+
+    <shard_folder>/<dataset>/<split>/shard-00000.tar    {id}.png, {id}.mask.png, {id}.landmark.npy
+    <shard_folder>/<dataset>/<split>/meta.json          shards, compression, labels, path tables
+    <shard_folder>/<dataset>/<split>/*.npy              per-sample shard, offsets, sizes, labels and paths
+
+`ShardedDeepfakeDataset` reads the samples by offset for random access (evaluation), and
+`StreamingShardDataset` reads whole shards sequentially with a shard-level shuffle and a shuffle buffer (training).
+"""
+
+import sys
+sys.path.append('.')
+
+import os
+import io
+import json
+import random
+import tarfile
+import concurrent.futures
+
+import cv2
+import numpy as np
+from torch.utils import data
+
+from dataset.abstract_dataset import DeepfakeAbstractBaseDataset
+from dataset.dataset_index import FramePathList, load_index, select_frames
+
+# The files of a sample, in the order of the `offsets` and `sizes` columns
+SAMPLE_FIELDS = ['image', 'mask', 'landmark']
+
+
+def get_shard_dir(shard_folder, dataset_name, split):
+    """
+    Returns the folder of the shards of a (dataset, split).
+    """
+    return os.path.join(shard_folder, dataset_name, split)
+
+
+def get_member_name(sample_id, field, image_path):
+    """
+    Returns the name of a file of a sample inside its shard.
+    """
+    if field == 'image':
+        return f'{sample_id:09d}{os.path.splitext(image_path)[1]}'
+    return f'{sample_id:09d}.mask.png' if field == 'mask' else f'{sample_id:09d}.landmark.npy'
+
+
+def read_sample_files(image_path):
+    """
+    Reads the bytes of the frame, mask and landmark files of a sample, None for the missing ones.
+    The mask and landmark paths follow `DeepfakeAbstractBaseDataset.__getitem__`.
+    """
+    paths = {
+        'image': image_path,
+        'mask': image_path.replace('frames', 'masks'),
+        'landmark': image_path.replace('frames', 'landmarks').replace('.png', '.npy'),
+    }
+    files = {}
+    for field, path in paths.items():
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                files[field] = f.read()
+        else:
+            files[field] = None
+    return files
+
+
+def get_compression(dataset_name, compression):
+    """
+    Returns the compression level of the frames of a dataset, as `collect_img_and_label_for_one_dataset`:
+    'c40' for the '_c40' datasets, the configured one for the FF++ family and '' for the others.
+    """
+    if dataset_name.endswith('_c40'):
+        return 'c40'
+    if dataset_name in ['FF-DF', 'FF-F2F', 'FF-FS', 'FF-NT', 'FaceForensics++', 'DeepFakeDetection', 'FaceShifter']:
+        return compression
+    return ''
+
+
+def pack_shards(dataset_json_folder, dataset_name, split, compression, frame_num, shard_folder,
+                shard_size=1 << 30, num_workers=8):
+    """
+    Packs the frames, masks and landmarks of a (dataset, split, compression) of the `rearrange.py` layout into tar shards.
+
+    Args:
+        dataset_json_folder (str): The folder of the dataset JSON files.
+        dataset_name (str): The dataset, e.g. 'FF-F2F'.
+        split (str): 'train', 'val' or 'test'.
+        compression (str): The compression level, '' for the datasets without compression levels.
+        frame_num (int): The number of frames per video, as `frame_num` of the training config.
+        shard_folder (str): The root folder of the shards.
+        shard_size (int): The size in bytes after which a new shard is started, at a video boundary.
+        num_workers (int): Number of threads reading the source files.
+
+    Returns:
+        int: The number of packed samples.
+    """
+    index = load_index(os.path.join(dataset_json_folder, dataset_name + '.json'))
+    labels = index['meta']['labels']
+    # 'FF-F2F_c40.json' holds the 'FF-F2F' dataset, as in `collect_img_and_label_for_one_dataset`
+    image_list, label_list = select_frames(index, dataset_name.replace('_c40', ''), split, compression, frame_num,
+                                           {label: i for i, label in enumerate(labels)})
+    # Group the frames by video, in frame order
+    order = np.lexsort((image_list.name_ids, image_list.prefix_ids))
+    prefix_ids, name_ids, label_list = image_list.prefix_ids[order], image_list.name_ids[order], label_list[order]
+    image_list = FramePathList(image_list.prefixes, image_list.names, prefix_ids, name_ids)
+
+    shard_dir = get_shard_dir(shard_folder, dataset_name, split)
+    os.makedirs(shard_dir, exist_ok=True)
+    num_samples = len(image_list)
+    sample_shard = np.zeros(num_samples, dtype=np.int32)
+    offsets = np.full((num_samples, len(SAMPLE_FIELDS)), -1, dtype=np.int64)
+    sizes = np.zeros((num_samples, len(SAMPLE_FIELDS)), dtype=np.int64)
+
+    shards = []
+    tar, shard_bytes = None, 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # Read the small source files ahead, in order
+        for sample_id, files in enumerate(executor.map(read_sample_files, image_list)):
+            new_video = sample_id == 0 or prefix_ids[sample_id] != prefix_ids[sample_id - 1]
+            if tar is None or (new_video and shard_bytes >= shard_size):
+                if tar is not None:
+                    tar.close()
+                shards.append(f'shard-{len(shards):05d}.tar')
+                tar, shard_bytes = tarfile.open(os.path.join(shard_dir, shards[-1]), 'w'), 0
+            if files['image'] is None:
+                raise FileNotFoundError(f'{image_list[sample_id]} does not exist')
+            sample_shard[sample_id] = len(shards) - 1
+            for field_id, field in enumerate(SAMPLE_FIELDS):
+                if files[field] is None:
+                    continue
+                member = tarfile.TarInfo(get_member_name(sample_id, field, image_list[sample_id]))
+                member.size = len(files[field])
+                tar.addfile(member, io.BytesIO(files[field]))
+                shard_bytes += member.size
+                sizes[sample_id, field_id] = member.size
+    if tar is not None:
+        tar.close()
+
+    # Offsets of the file data inside the shards, for the random access
+    for shard_id, shard in enumerate(shards):
+        with tarfile.open(os.path.join(shard_dir, shard), 'r') as tar:
+            for member in tar.getmembers():
+                sample_id, field = parse_member_name(member.name)
+                offsets[sample_id, SAMPLE_FIELDS.index(field)] = member.offset_data
+
+    np.save(os.path.join(shard_dir, 'sample_shard.npy'), sample_shard)
+    np.save(os.path.join(shard_dir, 'offsets.npy'), offsets)
+    np.save(os.path.join(shard_dir, 'sizes.npy'), sizes)
+    np.save(os.path.join(shard_dir, 'labels.npy'), label_list.astype(np.int32))
+    np.save(os.path.join(shard_dir, 'prefix_ids.npy'), prefix_ids)
+    np.save(os.path.join(shard_dir, 'name_ids.npy'), name_ids)
+    with open(os.path.join(shard_dir, 'meta.json'), 'w') as f:
+        json.dump({'shards': shards, 'compression': compression, 'frame_num': frame_num, 'labels': labels,
+                   'prefixes': image_list.prefixes, 'names': image_list.names}, f)
+    return num_samples
+
+
+def parse_member_name(name):
+    """
+    Returns the sample id and the field of a file of a shard.
+    """
+    stem, ext = name.split('.', 1)
+    field = 'mask' if ext == 'mask.png' else 'landmark' if ext == 'landmark.npy' else 'image'
+    return int(stem), field
+
+
+class ShardReader:
+    """
+    The shards of a (dataset, split), with the random access by sample id.
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.sample_shard = np.load(os.path.join(shard_dir, 'sample_shard.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(shard_dir, 'offsets.npy'), mmap_mode='r')
+        self.sizes = np.load(os.path.join(shard_dir, 'sizes.npy'), mmap_mode='r')
+        self.labels = np.load(os.path.join(shard_dir, 'labels.npy'), mmap_mode='r')
+        self.image_list = FramePathList(self.meta['prefixes'], self.meta['names'],
+                                        np.load(os.path.join(shard_dir, 'prefix_ids.npy')),
+                                        np.load(os.path.join(shard_dir, 'name_ids.npy')))
+        # Open shard files of the current process, DataLoader workers open their own
+        self.files, self.pid = {}, None
+
+    def __len__(self):
+        return len(self.sample_shard)
+
+    def get_file(self, shard_id):
+        if self.pid != os.getpid():
+            self.files, self.pid = {}, os.getpid()
+        if shard_id not in self.files:
+            self.files[shard_id] = open(os.path.join(self.shard_dir, self.meta['shards'][shard_id]), 'rb')
+        return self.files[shard_id]
+
+    def read(self, sample_id):
+        """
+        Reads the files of a sample by offset.
+
+        Returns:
+            dict: The bytes of the 'image', 'mask' and 'landmark' files, None for the missing ones.
+        """
+        f = self.get_file(int(self.sample_shard[sample_id]))
+        files = {}
+        for field_id, field in enumerate(SAMPLE_FIELDS):
+            if self.offsets[sample_id, field_id] < 0:
+                files[field] = None
+                continue
+            f.seek(int(self.offsets[sample_id, field_id]))
+            files[field] = f.read(int(self.sizes[sample_id, field_id]))
+        return files
+
+    def iter_shard(self, shard_id):
+        """
+        Reads the samples of a shard sequentially.
+
+        Yields:
+            tuple: The sample id and the dict of the bytes of its files.
+        """
+        current_id, files = None, {}
+        with tarfile.open(os.path.join(self.shard_dir, self.meta['shards'][shard_id]), 'r|') as tar:
+            for member in tar:
+                sample_id, field = parse_member_name(member.name)
+                if sample_id != current_id:
+                    if current_id is not None:
+                        yield current_id, files
+                    current_id, files = sample_id, dict.fromkeys(SAMPLE_FIELDS)
+                files[field] = tar.extractfile(member).read()
+        if current_id is not None:
+            yield current_id, files
+
+
+class ShardedDeepfakeDataset(DeepfakeAbstractBaseDataset):
+    """
+    `DeepfakeAbstractBaseDataset` reading the samples from the packed shards by offset.
+    """
+    def __init__(self, config=None, mode='train'):
+        # The samples come from the shards instead of the dataset JSON files
+        self.config = config
+        self.mode = mode
+        self.compression = config['compression']
+        self.frame_num = config['frame_num'][mode]
+
+        if mode == 'train':
+            dataset_list = config['train_dataset']
+        elif mode == 'test':
+            dataset_list = [config['test_dataset']]
+        else:
+            raise NotImplementedError('Only train and test modes are supported.')
+
+        self.readers = []
+        image_lists, label_lists, reader_ids, sample_ids = [], [], [], []
+        for one_data in dataset_list:
+            reader = ShardReader(get_shard_dir(config['shard_folder'], one_data, mode))
+            if reader.meta['compression'] not in ('', self.compression) and not one_data.endswith('_c40'):
+                raise ValueError(f"The shards of {one_data} are {reader.meta['compression']}, not {self.compression}")
+            for label in reader.meta['labels']:
+                if label not in self.config['label_dict']:
+                    raise ValueError(f'Label {label} is not found in the configuration file.')
+            label_ids = np.array([self.config['label_dict'][label] for label in reader.meta['labels']], dtype=np.int64)
+            image_lists.append(reader.image_list)
+            label_lists.append(label_ids[reader.labels])
+            reader_ids.append(np.full(len(reader), len(self.readers), dtype=np.int32))
+            sample_ids.append(np.arange(len(reader), dtype=np.int64))
+            self.readers.append(reader)
+
+        self.image_list = FramePathList.concatenate(image_lists)
+        self.label_list = np.concatenate(label_lists)
+        self.reader_ids, self.sample_ids = np.concatenate(reader_ids), np.concatenate(sample_ids)
+        assert len(self.image_list) != 0, f"Collect nothing for {mode} mode!"
+
+        # Create a dictionary containing the image and label lists
+        self.data_dict = {
+            'image': self.image_list,
+            'label': self.label_list,
+        }
+
+        self.transform = self.init_data_aug_method()
+
+    def decode_sample(self, files, label):
+        """
+        Decodes the files of a sample like `load_rgb`, `load_mask` and `load_landmark`, then transforms it.
+        """
+        size = self.config['resolution']
+        image = cv2.imdecode(np.frombuffer(files['image'], np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError('Loaded image is None')
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image = cv2.resize(image, (size, size), interpolation=cv2.INTER_CUBIC)
+
+        mask, landmarks = None, None
+        if self.config['with_mask']:
+            mask = np.zeros((size, size, 1))
+            if files['mask'] is not None:
+                mask = cv2.imdecode(np.frombuffer(files['mask'], np.uint8), cv2.IMREAD_GRAYSCALE)
+                if mask is None:
+                    mask = np.zeros((size, size))
+                mask = np.float32(np.expand_dims(cv2.resize(mask, (size, size)) / 255, axis=2))
+        if self.config['with_landmark']:
+            landmarks = np.zeros((81, 2))
+            if files['landmark'] is not None:
+                landmarks = np.float32(np.load(io.BytesIO(files['landmark'])))
+        return self.transform_sample(image, label, landmarks, mask)
+
+    def __getitem__(self, index):
+        reader = self.readers[self.reader_ids[index]]
+        try:
+            return self.decode_sample(reader.read(int(self.sample_ids[index])), self.label_list[index])
+        except Exception as e:
+            # Skip this image and return a random one
+            print(f"Error loading image at index {index}: {e}")
+            return self.__getitem__(random.randrange(len(self)))
+
+
+class StreamingShardDataset(data.IterableDataset):
+    """
+    Streams the shards of a `ShardedDeepfakeDataset` sequentially for training. The shards are shuffled
+    every epoch and split between the DataLoader workers, and the samples go through a shuffle buffer.
+    """
+    def __init__(self, dataset, shuffle_buffer=2048, seed=0):
+        self.dataset = dataset
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.data_dict = dataset.data_dict
+        self.collate_fn = dataset.collate_fn
+
+    def set_epoch(self, epoch):
+        """
+        Sets the epoch, which seeds the shuffle of the shards. Called from the main process before each epoch.
+        """
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        shards = [(reader_id, shard_id) for reader_id, reader in enumerate(self.dataset.readers)
+                  for shard_id in range(len(reader.meta['shards']))]
+        rng.shuffle(shards)
+        worker_info = data.get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+            rng = random.Random(self.seed + self.epoch * 1000 + worker_info.id)
+
+        # Labels of the concatenated readers, by reader
+        label_offsets = np.cumsum([0] + [len(reader) for reader in self.dataset.readers])
+        buffer = []
+        for reader_id, shard_id in shards:
+            for sample_id, files in self.dataset.readers[reader_id].iter_shard(shard_id):
+                buffer.append((files, self.dataset.label_list[label_offsets[reader_id] + sample_id]))
+                if len(buffer) < self.shuffle_buffer:
+                    continue
+                # Yield a random sample of the full buffer
+                index = rng.randrange(len(buffer))
+                buffer[index], buffer[-1] = buffer[-1], buffer[index]
+                yield self.decode(*buffer.pop())
+        rng.shuffle(buffer)
+        for files, label in buffer:
+            yield self.decode(files, label)
+
+    def decode(self, files, label):
+        try:
+            return self.dataset.decode_sample(files, label)
+        except Exception as e:
+            # Skip the broken sample and return a random one of the dataset
+            print(f"Error decoding a sample: {e}")
+            return self.dataset[random.randrange(len(self.dataset))]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Pack the frames, masks and landmarks of datasets into tar shards.')
+    parser.add_argument('--dataset_json_folder', type=str, default='./preprocessing/dataset_json')
+    parser.add_argument('--shard_folder', type=str, default='./preprocessing/shards')
+    parser.add_argument('--datasets', type=str, nargs='+', default=['FF-F2F', 'FF-DF', 'FF-FS', 'FF-NT'])
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'test'])
+    parser.add_argument('--detector_path', type=str, default='./config/detector/efficientnetb4.yaml',
+                        help='training config giving the compression level')
+    parser.add_argument('--compression', type=str, default=None, help='overrides the compression level of the config')
+    parser.add_argument('--frame_num', type=int, default=32)
+    parser.add_argument('--shard_size', type=int, default=1 << 30, help='size of a shard in bytes')
+    args = parser.parse_args()
+    if args.compression is None:
+        import yaml
+        with open(args.detector_path, 'r') as f:
+            config_compression = yaml.safe_load(f)['compression']
+    for dataset_name in args.datasets:
+        compression = args.compression if args.compression is not None else get_compression(dataset_name, config_compression)
+        for split in args.splits:
+            num_samples = pack_shards(args.dataset_json_folder, dataset_name, split, compression,
+                                      args.frame_num, args.shard_folder, shard_size=args.shard_size)
+            print(f"Packed {num_samples} samples of {dataset_name} {split}")
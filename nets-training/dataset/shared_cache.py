@@ -0,0 +1,295 @@
+# description: Cache of decoded frames in POSIX shared memory, shared by the DataLoader workers.
+
+"""
+Every DataLoader worker decodes its frames independently, and the same frames are decoded again every
+epoch. `SharedFrameCache` keeps the decoded uint8 arrays in a single shared memory segment created by the
+main process and inherited by the workers:
+
+- the segment is split into fixed-size slots, arrays larger than a slot are not cached;
+- an open-addressing hash index in the same segment maps the key hashes to their slots;
+- a table holds the key hash, version, reference bit, size and shape of every slot;
+- a lock serializes the updates of the index and the table, which take O(1) expected time. The array copies
+  run outside the lock: a slot being written has an odd version, and a reader checks after its copy that the
+  version of the slot did not change, like a seqlock;
+- a clock hand sweeps the slots to evict one that was not referenced since its last pass.
+"""
+
+import os
+import atexit
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+# Counters of the stats, at the start of the segment
+STATS = ['hits', 'misses', 'inserts', 'evictions', 'bypassed', 'hand']
+# Fields of the table of every slot
+SLOT_FIELDS = ['key', 'version', 'referenced', 'nbytes', 'ndim', 'dim0', 'dim1', 'dim2']
+KEY, VERSION, REFERENCED, NBYTES, NDIM, DIM0 = range(6)
+NUM_FIELDS = len(SLOT_FIELDS)
+
+
+def hash_key(key):
+    """
+    Hashes a key to a non-zero int64, zero marks the empty slots and buckets.
+    """
+    value = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little', signed=True)
+    return value or 1
+
+
+class SharedFrameCache:
+    """
+    Cross-process cache of uint8 arrays with a byte budget and clock eviction.
+    """
+    def __init__(self, capacity_bytes, slot_bytes):
+        """
+        Args:
+            capacity_bytes (int): The byte budget of the cached arrays.
+            slot_bytes (int): The size of a slot, the largest array that can be cached.
+        """
+        self.slot_bytes = slot_bytes
+        self.num_slots = max(1, capacity_bytes // slot_bytes)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.segment_size())
+        self.lock = multiprocessing.Lock()
+        self.owner_pid = os.getpid()
+        self.attach()
+        self.stats_array[:] = 0
+        self.index_array[:] = 0
+        self.table_array[:] = 0
+        # The creator unlinks the segment when the training ends
+        atexit.register(self.close)
+
+    def layout(self):
+        """
+        Returns the number of buckets of the hash index and the offsets of the index, the table and the data.
+        """
+        # A power of two at least twice the number of slots, the probes stay short
+        num_buckets = 1 << (2 * self.num_slots - 1).bit_length()
+        index_offset = 8 * len(STATS)
+        table_offset = index_offset + 16 * num_buckets
+        data_offset = table_offset + 8 * NUM_FIELDS * self.num_slots
+        return num_buckets, index_offset, table_offset, data_offset
+
+    def segment_size(self):
+        return self.layout()[3] + self.num_slots * self.slot_bytes
+
+    def attach(self):
+        """
+        Creates the views over the shared memory segment.
+        """
+        buf = self.shm.buf
+        self.num_buckets, index_offset, table_offset, data_offset = self.layout()
+        self.bucket_mask = self.num_buckets - 1
+        # Flat int64 memoryviews for the element accesses of the hot path, numpy views for the bulk operations
+        self.stats_view = buf[:index_offset].cast('q')
+        self.index = buf[index_offset:table_offset].cast('q')
+        self.table = buf[table_offset:data_offset].cast('q')
+        self.stats_array = np.ndarray((len(STATS),), dtype=np.int64, buffer=buf)
+        self.index_array = np.ndarray((self.num_buckets, 2), dtype=np.int64, buffer=buf, offset=index_offset)
+        self.table_array = np.ndarray((self.num_slots, NUM_FIELDS), dtype=np.int64, buffer=buf, offset=table_offset)
+        self.data = np.ndarray((self.num_slots, self.slot_bytes), dtype=np.uint8, buffer=buf, offset=data_offset)
+
+    def __getstate__(self):
+        # Spawned DataLoader workers attach to the segment by name
+        return {'name': self.shm.name, 'slot_bytes': self.slot_bytes, 'num_slots': self.num_slots,
+                'lock': self.lock, 'owner_pid': self.owner_pid}
+
+    def __setstate__(self, state):
+        self.slot_bytes, self.num_slots = state['slot_bytes'], state['num_slots']
+        self.lock, self.owner_pid = state['lock'], state['owner_pid']
+        # The workers share the resource tracker of the main process, which unlinks the segment
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.attach()
+
+    def count(self, name):
+        self.stats_view[STATS.index(name)] += 1
+
+    def find_bucket(self, key_hash):
+        """
+        Returns the bucket of a key in the hash index, or the empty bucket ending its probe. Called with the lock held.
+        """
+        index, bucket = self.index, key_hash & self.bucket_mask
+        while index[2 * bucket] != key_hash and index[2 * bucket] != 0:
+            bucket = (bucket + 1) & self.bucket_mask
+        return bucket
+
+    def remove_bucket(self, bucket):
+        """
+        Removes a bucket of the hash index, shifting back the following entries of its probe. Called with the lock held.
+        """
+        index, mask = self.index, self.bucket_mask
+        other = bucket
+        while True:
+            other = (other + 1) & mask
+            key_hash = index[2 * other]
+            if key_hash == 0:
+                break
+            # The entry stays if its home bucket is in (bucket, other], cyclically
+            home = key_hash & mask
+            if (bucket < home <= other) if bucket <= other else (home > bucket or home <= other):
+                continue
+            index[2 * bucket], index[2 * bucket + 1] = key_hash, index[2 * other + 1]
+            bucket = other
+        index[2 * bucket] = index[2 * bucket + 1] = 0
+
+    def evict_slot(self):
+        """
+        Advances the clock hand to a slot not referenced since its last pass, and frees it. Called with the lock held.
+
+        Returns:
+            int: The slot, None if all the slots are being written.
+        """
+        table, hand = self.table, STATS.index('hand')
+        # Two sweeps clear all the reference bits
+        for _ in range(2 * self.num_slots):
+            slot = self.stats_view[hand]
+            self.stats_view[hand] = (slot + 1) % self.num_slots
+            row = slot * NUM_FIELDS
+            if table[row + VERSION] % 2:
+                continue
+            if table[row + REFERENCED]:
+                table[row + REFERENCED] = 0
+                continue
+            if table[row + KEY] != 0:
+                self.remove_bucket(self.find_bucket(table[row + KEY]))
+                table[row + KEY] = 0
+                self.count('evictions')
+            return slot
+        return None
+
+    def get(self, key):
+        """
+        Returns a copy of a cached array, None if it is not cached.
+        """
+        key_hash = hash_key(key)
+        table = self.table
+        with self.lock:
+            bucket = self.find_bucket(key_hash)
+            if self.index[2 * bucket] == 0:
+                self.count('misses')
+                return None
+            slot = self.index[2 * bucket + 1]
+            row = slot * NUM_FIELDS
+            version, nbytes, ndim = table[row + VERSION], table[row + NBYTES], table[row + NDIM]
+            shape = [table[row + DIM0 + i] for i in range(ndim)]
+            table[row + REFERENCED] = 1
+            self.count('hits')
+        array = self.data[slot, :nbytes].copy().reshape(shape)
+        # The slot was evicted and rewritten during the copy
+        if table[row + VERSION] != version or table[row + KEY] != key_hash:
+            with self.lock:
+                self.stats_view[STATS.index('hits')] -= 1
+                self.count('misses')
+            return None
+        return array
+
+    def put(self, key, array):
+        """
+        Caches an array, evicting a slot with the clock when the cache is full.
+        """
+        array = np.ascontiguousarray(array, dtype=np.uint8)
+        if array.nbytes > self.slot_bytes or array.ndim > 3:
+            with self.lock:
+                self.count('bypassed')
+            return
+        key_hash = hash_key(key)
+        table = self.table
+        with self.lock:
+            if self.index[2 * self.find_bucket(key_hash)] == key_hash:
+                return
+            slot = self.evict_slot()
+            if slot is None:
+                self.count('bypassed')
+                return
+            row = slot * NUM_FIELDS
+            # An odd version keeps the readers and the clock off the slot while it is written
+            table[row + VERSION] += 1
+        self.data[slot, :array.nbytes] = array.reshape(-1)
+        with self.lock:
+            bucket = self.find_bucket(key_hash)
+            if self.index[2 * bucket] == 0:
+                # Not inserted by another process in the meantime
+                table[row + NBYTES], table[row + NDIM] = array.nbytes, array.ndim
+                for i, dim in enumerate(list(array.shape) + [0] * (3 - array.ndim)):
+                    table[row + DIM0 + i] = dim
+                table[row + KEY] = key_hash
+                self.index[2 * bucket], self.index[2 * bucket + 1] = key_hash, slot
+                self.count('inserts')
+            table[row + REFERENCED] = 0
+            table[row + VERSION] += 1
+
+    def get_or_load(self, key, loader):
+        """
+        Returns a cached array, or loads and caches it.
+
+        Args:
+            key (str): The key of the array.
+            loader (callable): Loads the array when it is not cached, None results are not cached.
+        """
+        array = self.get(key)
+        if array is None:
+            array = loader()
+            if array is not None:
+                self.put(key, array)
+        return array
+
+    def stats(self):
+        """
+        Returns the hit rate, the resident bytes and the counters of the cache.
+        """
+        with self.lock:
+            counters = {name: int(value) for name, value in zip(STATS, self.stats_array)}
+            occupied = self.table_array[:, KEY] != 0
+            counters['resident_bytes'] = int(self.table_array[occupied, NBYTES].sum())
+            counters['resident_items'] = int(occupied.sum())
+        lookups = counters['hits'] + counters['misses']
+        counters['hit_rate'] = counters['hits'] / lookups if lookups else 0.0
+        counters['capacity_bytes'] = self.num_slots * self.slot_bytes
+        del counters['hand']
+        return counters
+
+    def close(self):
+        """
+        Detaches from the segment, and unlinks it in the creator process.
+        """
+        # Release the views before closing the memory map
+        for view in (getattr(self, name, None) for name in ('stats_view', 'index', 'table')):
+            if view is not None:
+                view.release()
+        self.stats_view = self.index = self.table = None
+        self.stats_array = self.index_array = self.table_array = self.data = None
+        try:
+            self.shm.close()
+            if os.getpid() == self.owner_pid:
+                self.shm.unlink()
+        except (FileNotFoundError, BufferError):
+            pass
+
+
+# The caches of this process by (capacity, slot size), so the training and test datasets share one budget
+shared_caches = {}
+
+
+def build_shared_cache(config):
+    """
+    Returns the shared frame cache of a training config, None when `shared_cache_bytes` is not set.
+    The slots fit a 256x256 (or resolution x resolution) RGB frame unless `shared_cache_slot_bytes` is set.
+    """
+    if not config or not config.get('shared_cache_bytes'):
+        return None
+    slot_bytes = config.get('shared_cache_slot_bytes') or 3 * max(config['resolution'], 256) ** 2
+    key = (int(config['shared_cache_bytes']), int(slot_bytes))
+    if key not in shared_caches:
+        shared_caches[key] = SharedFrameCache(*key)
+    return shared_caches[key]
+
+
+def imread_cached(cache, file_path):
+    """
+    `cv2.imread` through the shared cache, if any.
+    """
+    if cache is None:
+        return cv2.imread(file_path)
+    return cache.get_or_load(f'bgr:{file_path}', lambda: cv2.imread(file_path))
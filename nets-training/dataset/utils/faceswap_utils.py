@@ -15,6 +15,43 @@ def AlphaBlend(foreground, background, alpha):
 
     return outImage
 
+def featherBlend(src, dst, mask, featherAmount=0.2):
+    """
+    Blends src into dst inside the mask, the weight of src rising from 0 on the convex hull of the mask
+    to 1 at featherAmount times the face size inside it.
+
+    The distance of every pixel to the hull comes from a single distance transform of the rasterized hull,
+    and the blending runs in float32 on the bounding box of the mask only. It matches the per-pixel
+    cv2.pointPolygonTest version within a few gray levels.
+
+    Returns:
+        np.ndarray: The blended uint8 image, None if the mask is empty.
+    """
+    ys, xs = np.nonzero(mask)
+    if len(ys) == 0:
+        return None
+    x0, x1, y0, y1 = xs.min(), xs.max(), ys.min(), ys.max()
+    featherAmount = featherAmount * max(x1 - x0, y1 - y0)
+
+    # Rasterize the hull in the bounding box with a 1 pixel border, the distance transform measures
+    # the distance to the nearest pixel outside the hull, 1 pixel further than its edge
+    hull = cv2.convexHull(np.stack([xs - x0, ys - y0], axis=1).astype(np.int32))
+    hullMask = np.zeros((y1 - y0 + 3, x1 - x0 + 3), dtype=np.uint8)
+    cv2.fillConvexPoly(hullMask, hull + 1, 1)
+    dists = cv2.distanceTransform(hullMask, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)[1:-1, 1:-1] - 1
+    if featherAmount > 0:
+        weights = np.clip(dists / featherAmount, 0, 1)
+    else:
+        weights = (dists > 0).astype(np.float32)
+    weights[mask[y0:y1 + 1, x0:x1 + 1] == 0] = 0
+
+    src_box = src[y0:y1 + 1, x0:x1 + 1].astype(np.float32)
+    dst_box = dst[y0:y1 + 1, x0:x1 + 1].astype(np.float32)
+    composedImg = np.array(dst, dtype=np.uint8)
+    composedImg[y0:y1 + 1, x0:x1 + 1] = np.clip(dst_box + weights[..., np.newaxis] * (src_box - dst_box), 0, 255).astype(np.uint8)
+    return composedImg
+
+
 def blendImages(src, dst, mask, featherAmount=0.1):
     maskIndices = np.where(mask != 0)
     maskPts = np.hstack(
@@ -26,6 +26,7 @@ from dataset.abstract_dataset import DeepfakeAbstractBaseDataset
 from dataset.ff_blend import FFBlendDataset
 from dataset.fwa_blend import FWABlendDataset
 from dataset.pair_dataset import pairDataset
+from dataset.batch_aug import normalize_batch
 
 from trainer.trainer import Trainer
 from detectors import DETECTOR
@@ -94,8 +95,12 @@ def test_one_dataset(model, data_loader):
         data, label, mask, landmark = \
         data_dict['image'], data_dict['label'], data_dict['mask'], data_dict['landmark']
     
-        # move data to GPU
+        # move data to GPU, then normalize the uint8 batches there
         data_dict['image'], data_dict['label'] = data.to(device), label.to(device)
+        if data_dict['image'].dtype == torch.uint8:
+            config = data_loader.dataset.config
+            data_dict['image'] = normalize_batch(data_dict['image'], config['mean'], config['std'],
+                                                 config.get('channels_last', False))
         if mask is not None:
             data_dict['mask'] = mask.to(device)
         if landmark is not None:
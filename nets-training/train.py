@@ -30,6 +30,8 @@ from dataset.abstract_dataset import DeepfakeAbstractBaseDataset
 from dataset.ff_blend import FFBlendDataset
 from dataset.fwa_blend import FWABlendDataset
 from dataset.pair_dataset import pairDataset
+from dataset.shard_dataset import ShardedDeepfakeDataset, StreamingShardDataset
+from dataset.resumable_sampler import ResumableSampler
 
 from trainer.trainer import Trainer
 from detectors import DETECTOR
@@ -60,6 +62,20 @@ def init_seed(config):
 
 
 def prepare_training_data(config):
+  # Stream the packed shards if they are configured
+  if config.get('shard_folder'):
+      train_set = StreamingShardDataset(
+              ShardedDeepfakeDataset(config=config, mode='train'),
+              shuffle_buffer=config.get('shuffle_buffer', 2048),
+              seed=config['manualSeed'],
+          )
+      return torch.utils.data.DataLoader(
+          dataset=train_set,
+          batch_size=config['train_batchSize'],
+          num_workers=int(config['workers']),
+          collate_fn=train_set.collate_fn,
+          pin_memory=torch.cuda.is_available(),
+          )
   # Only use the blending dataset class in training
   train_set = DeepfakeAbstractBaseDataset(
               config=config,
@@ -69,9 +85,11 @@ def prepare_training_data(config):
       torch.utils.data.DataLoader(
           dataset=train_set,
           batch_size=config['train_batchSize'],
-          shuffle=True,
+          # Shuffle with a sampler seeded per epoch, resumed at the sample of the last checkpoint
+          sampler=ResumableSampler(len(train_set), seed=config['manualSeed']),
           num_workers=int(config['workers']),
           collate_fn=train_set.collate_fn,
+          pin_memory=torch.cuda.is_available(),
           )
   return train_data_loader
 
@@ -80,7 +98,9 @@ def prepare_testing_data(config):
       # update the config dictionary with the specific testing dataset
       config = config.copy()  # create a copy of config to avoid altering the original one
       config['test_dataset'] = test_name  # specify the current test dataset
-      test_set = DeepfakeAbstractBaseDataset(
+      # Random access into the packed shards if they are configured
+      dataset_class = ShardedDeepfakeDataset if config.get('shard_folder') else DeepfakeAbstractBaseDataset
+      test_set = dataset_class(
               config=config,
               mode='test',
           )
@@ -91,6 +111,7 @@ def prepare_testing_data(config):
               shuffle=False,
               num_workers=int(config['workers']),
               collate_fn=test_set.collate_fn,
+              pin_memory=torch.cuda.is_available(),
           )
       return test_data_loader
 
@@ -216,17 +237,27 @@ def main():
     trainer = Trainer(config, model, optimizer, scheduler, logger, metric_scoring)
 
     # Load the last saved ckpt
-    start_epoch, start_iteration = trainer.load_ckpt(os.path.join('./training/logs_final/efficientnetb4/', 'efficientnetb4_2024-05-14-01-50-06', 'train_saved_ckpt', 'ffpp'))
+    # The resumable sampler restarts right after the last trained batch
+    train_sampler = train_data_loader.sampler if isinstance(train_data_loader.sampler, ResumableSampler) else None
+    start_epoch, start_iteration = trainer.load_ckpt(os.path.join('./training/logs_final/efficientnetb4/', 'efficientnetb4_2024-05-14-01-50-06', 'train_saved_ckpt', 'ffpp'), train_sampler=train_sampler)
     config['start_epoch'] = start_epoch
 
     # start training
     for epoch in range(config['start_epoch'], config['nEpochs'] + 1):
+      # Reshuffle the shards of a streamed training set
+      if hasattr(train_data_loader.dataset, 'set_epoch'):
+        train_data_loader.dataset.set_epoch(epoch)
+      # Draw the permutation of the epoch, the resumed epoch keeps its position
+      if train_sampler is not None:
+        train_sampler.set_epoch(epoch)
       best_metric = trainer.train_epoch(
                   epoch=epoch,
                   train_data_loader=train_data_loader,
                   iteration_from_last_ckpt=start_iteration,
                   test_data_loaders=test_data_loaders
                 )
+      # Only the resumed epoch skips the trained iterations
+      start_iteration = 0
       if best_metric is not None:
         logger.info(f"===> Epoch[{epoch}] end with testing {metric_scoring}: {parse_metric_for_print(best_metric)}!")
     logger.info("Stop Training on best Testing metric {}".format(parse_metric_for_print(best_metric)))
@@ -0,0 +1,147 @@
+import time
+import queue
+import threading
+
+import torch
+
+
+class Prefetcher(object):
+    """
+    Wraps a DataLoader to overlap the loading and the host-to-device copies of the next batches with the compute.
+
+    A background thread pulls up to `depth` batches ahead, pins their tensors and copies them to the device with
+    non-blocking transfers on a side CUDA stream. On CPU-only hosts the thread still overlaps the collation with
+    the compute. `wait_time` accumulates the time the training loop spent waiting for a batch.
+    """
+    def __init__(self, data_loader, device, depth=2, skip_keys=('name',)):
+        """
+        Args:
+            data_loader: The DataLoader, yielding data dicts.
+            device (torch.device): The device of the model.
+            depth (int): Number of batches staged ahead, 0 loads them synchronously in the training loop.
+            skip_keys (tuple): The keys of the data dicts left on the host.
+        """
+        self.data_loader = data_loader
+        self.dataset = data_loader.dataset
+        self.device = torch.device(device)
+        self.depth = depth
+        self.skip_keys = skip_keys
+        self.use_cuda = self.device.type == 'cuda'
+        self.wait_time = 0.0
+        self.steps = 0
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def reset_wait_time(self):
+        """
+        Clears the data wait time counter.
+        """
+        self.wait_time = 0.0
+        self.steps = 0
+
+    def data_wait_time(self):
+        """
+        Returns the average time in seconds the training loop waited for a batch since the last reset.
+        """
+        return self.wait_time / self.steps if self.steps else 0.0
+
+    def to_device(self, data_dict, stream=None):
+        """
+        Copies the tensors of a data dict to the device, non-blocking from pinned memory on CUDA.
+
+        Returns:
+            dict: The data dict on the device.
+            torch.cuda.Event: The event recorded after the copies, None on CPU.
+        """
+        if not self.use_cuda:
+            return data_dict, None
+        with torch.cuda.stream(stream):
+            for key, value in data_dict.items():
+                if isinstance(value, torch.Tensor) and key not in self.skip_keys:
+                    if not value.is_pinned():
+                        value = value.pin_memory()
+                    data_dict[key] = value.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return data_dict, event
+
+    def wait(self, data_dict, event):
+        """
+        Makes the current stream wait for the copies of a batch, and marks its tensors as used by it.
+        """
+        if event is None:
+            return data_dict
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(event)
+        for key, value in data_dict.items():
+            if isinstance(value, torch.Tensor) and value.is_cuda:
+                # The memory was allocated on the side stream, keep it until the current stream is done with it
+                value.record_stream(current_stream)
+        return data_dict
+
+    def __iter__(self):
+        if self.depth <= 0:
+            yield from self.iter_sync()
+        else:
+            yield from self.iter_background()
+
+    def iter_sync(self):
+        iterator = iter(self.data_loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                data_dict = next(iterator)
+            except StopIteration:
+                return
+            data_dict = self.wait(*self.to_device(data_dict, torch.cuda.current_stream(self.device) if self.use_cuda else None))
+            self.wait_time += time.perf_counter() - start
+            self.steps += 1
+            yield data_dict
+
+    def iter_background(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            # Give up when the training loop stopped iterating
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker():
+            if self.use_cuda:
+                torch.cuda.set_device(self.device)
+            stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+            try:
+                for data_dict in self.data_loader:
+                    if not put(self.to_device(data_dict, stream)):
+                        return
+            except Exception as e:
+                # Raised again in the training loop
+                put(e)
+                return
+            put(end)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                if item is end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                data_dict = self.wait(*item)
+                self.wait_time += time.perf_counter() - start
+                self.steps += 1
+                yield data_dict
+        finally:
+            stop.set()
+            thread.join()
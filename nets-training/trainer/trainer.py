@@ -16,6 +16,9 @@ import torch.optim as optim
 from torch.utils.tensorboard import SummaryWriter
 from metrics.base_metrics_class import Recorder
 from metrics.utils import get_test_metrics
+from dataset.batch_aug import BatchAugmentation, normalize_batch
+from trainer.prefetcher import Prefetcher
+from dataset.resumable_sampler import ResumableSampler
 
 from sklearn import metrics
 
@@ -48,6 +51,14 @@ class Trainer(object):
             if self.metric_scoring != 'eer' else float('inf'))
         ) 
         self.speed_up()  # move model to GPU
+        # Sampler of the training DataLoader, saved in the checkpoints when it can resume
+        self.train_sampler = None
+        # Sampler positioned by load_ckpt at the resumed iteration
+        self.resumed_sampler = None
+        # Augmentation of the uint8 training batches on the device, if enabled
+        self.batch_augmentation = None
+        if config.get('use_data_augmentation') and config.get('batch_augmentation'):
+            self.batch_augmentation = BatchAugmentation(config)
 
         # get current time
         self.timenow = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
@@ -77,6 +88,8 @@ class Trainer(object):
         # if self.config['ngpu'] > 1:
         #     self.model = DataParallel(self.model)
         self.model.to(device)
+        if self.config.get('channels_last'):
+            self.model.to(memory_format=torch.channels_last)
     
     def setTrain(self):
         self.model.train()
@@ -86,11 +99,14 @@ class Trainer(object):
         self.model.eval()
         self.train = False
 
-    def load_ckpt(self, checkpoint_dir):
+    def load_ckpt(self, checkpoint_dir, train_sampler=None):
         """
         Loads the latest checkpoint from the specified directory.
         Args: 
             checkpoint_dir (str): Path to the directory containing checkpoint files.
+            train_sampler (ResumableSampler): The sampler of the training DataLoader, restored to start
+                right after the last trained batch of the checkpoint. A checkpoint saved without the sampler
+                state starts it at the saved iteration of the saved epoch, where the skip loop resumed.
         Returns:
             tuple: (epoch, iteration) indicating the epoch and iteration of the loaded checkpoint.
         """
@@ -105,6 +121,14 @@ class Trainer(object):
         self.optimizer.load_state_dict(saved['optimizer'])
         epoch = saved['epoch']
         iteration = saved['iteration']
+        if train_sampler is not None:
+            if 'sampler' in saved:
+                train_sampler.load_state_dict(saved['sampler'])
+            else:
+                train_sampler.load_state_dict({'seed': train_sampler.seed, 'epoch': epoch, 'num_samples': train_sampler.num_samples,
+                                               'position': iteration * self.config['train_batchSize']})
+            # The sampler skips the trained batches, instead of the skip loop of train_epoch
+            self.resumed_sampler = train_sampler
         self.logger.info(f"Model loaded from {latest_ckpt}")
         
         return epoch, iteration
@@ -129,6 +153,9 @@ class Trainer(object):
             'state_dict': self.model.state_dict(),
             'optimizer': self.optimizer.state_dict(),
         }
+        if self.train_sampler is not None:
+            # The samples of the epoch up to this iteration are trained
+            last_state['sampler'] = self.train_sampler.state_dict(position=(iteration + 1) * self.train_batch_size)
         torch.save(last_state, save_path)
         self.logger.info(f"Checkpoint saved to {save_path}, current ckpt is {epoch}+{iteration}")
     
@@ -165,6 +192,19 @@ class Trainer(object):
             pickle.dump(metric_one_dataset, file)
         self.logger.info(f"Metrics saved to {file_path}")
     
+    def prepare_images(self, data_dict, train):
+        """
+        Augments and normalizes the uint8 image batches on the device, in place in the data dict.
+        The batches already normalized by the dataset are left as they are.
+        """
+        if data_dict['image'].dtype != torch.uint8:
+            return
+        if train and self.batch_augmentation is not None:
+            data_dict['image'], data_dict['mask'] = self.batch_augmentation(data_dict['image'], data_dict['mask'])
+        else:
+            data_dict['image'] = normalize_batch(data_dict['image'], self.config['mean'], self.config['std'],
+                                                 self.config.get('channels_last', False))
+
     def train_step(self,data_dict):
         if self.config['optimizer']['type']=='sam':
             for i in range(2):
@@ -198,9 +238,21 @@ class Trainer(object):
         ):
 
         self.logger.info("===> Epoch[{}] start!".format(epoch))
+        # A resumable sampler starts the epoch right after the last checkpoint, without loading the skipped batches
+        first_iteration = 0
+        if isinstance(train_data_loader.sampler, ResumableSampler):
+            self.train_sampler = train_data_loader.sampler
+            self.train_batch_size = train_data_loader.batch_size
+            first_iteration = self.train_sampler.start // self.train_batch_size
+            # Only a sampler positioned by load_ckpt replaces the skip loop
+            if self.train_sampler is self.resumed_sampler:
+                iteration_from_last_ckpt = 0
+        if iteration_from_last_ckpt > first_iteration:
+            self.logger.info(f"Skipping {iteration_from_last_ckpt - first_iteration} batches to resume at iteration {iteration_from_last_ckpt}")
+        num_batches = first_iteration + len(train_data_loader)
         times_per_epoch = 10
-        test_step = len(train_data_loader) // times_per_epoch  # test 2 times per epoch
-        step_cnt = epoch * len(train_data_loader)
+        test_step = num_batches // times_per_epoch  # test 2 times per epoch
+        step_cnt = epoch * num_batches + first_iteration
 
         # save the training data_dict
         data_dict = train_data_loader.dataset.data_dict
@@ -210,17 +262,16 @@ class Trainer(object):
         train_recorder_loss = defaultdict(Recorder)
         train_recorder_metric = defaultdict(Recorder)
 
-        for iteration, data_dict in tqdm(enumerate(train_data_loader), total=len(train_data_loader)):
+        # Load and move the next batches to the device in the background
+        train_batches = Prefetcher(train_data_loader, device, depth=self.config.get('prefetch_batches', 2))
+        for iteration, data_dict in tqdm(enumerate(train_batches, start=first_iteration), total=num_batches,
+                                         initial=first_iteration):
             # Skip the training until last saved iteration 
             if iteration < iteration_from_last_ckpt:
-                print("Here")
                 continue
             
             self.setTrain()
-            # Move data to GPU
-            for key in data_dict.keys():
-                if data_dict[key]!=None and key!='name':
-                    data_dict[key]=data_dict[key].cuda()
+            self.prepare_images(data_dict, train=True)
 
             losses,predictions = self.train_step(data_dict)
             
@@ -269,6 +320,13 @@ class Trainer(object):
                     writer.add_scalar(f'train_metric/{k}', v_avg, global_step=step_cnt)
                 self.logger.info(metric_str)
 
+                # Time spent waiting for the input pipeline, high values mean the training is input-bound
+                data_wait_time = train_batches.data_wait_time()
+                self.logger.info(f"Iter: {step_cnt}    data wait time per step: {data_wait_time * 1000:.1f} ms")
+                writer = self.get_writer('train', ','.join(self.config['train_dataset']), 'data_wait_time')
+                writer.add_scalar('train_data/wait_time', data_wait_time, global_step=step_cnt)
+                train_batches.reset_wait_time()
+
                 # Clear recorders for the next logging interval
                 for name, recorder in train_recorder_loss.items():  # clear loss recorder
                     recorder.clear()
@@ -289,6 +347,14 @@ class Trainer(object):
                 )
                 
             step_cnt += 1
+
+        # Report the shared frame cache of the DataLoader workers, if enabled
+        shared_cache = getattr(train_data_loader.dataset, 'shared_cache', None)
+        if shared_cache is not None:
+            stats = shared_cache.stats()
+            self.logger.info(f"Shared frame cache: hit rate {stats['hit_rate']:.1%}, "
+                             f"{stats['resident_bytes'] / 2**30:.2f}/{stats['capacity_bytes'] / 2**30:.2f} GiB resident "
+                             f"({stats['resident_items']} frames), {stats['evictions']} evictions, {stats['bypassed']} bypassed")
             
         return test_best_metric
     
@@ -306,15 +372,14 @@ class Trainer(object):
         prediction_lists = []
         feature_lists = []
         label_lists = []
-        for i, data_dict in tqdm(enumerate(data_loader),total=len(data_loader)):
+        # Load and move the next batches to the device in the background
+        test_batches = Prefetcher(data_loader, device, depth=self.config.get('prefetch_batches', 2))
+        for i, data_dict in tqdm(enumerate(test_batches),total=len(test_batches)):
             # get data
             if 'label_spe' in data_dict:
                 data_dict.pop('label_spe')  # remove the specific label
             data_dict['label'] = torch.where(data_dict['label']!=0, 1, 0)  # fix the label to 0 and 1 only
-            # move data to GPU elegantly
-            for key in data_dict.keys():
-                if data_dict[key]!=None:
-                    data_dict[key]=data_dict[key].cuda()
+            self.prepare_images(data_dict, train=False)
             # model forward without considering gradient computation
             predictions = self.inference(data_dict)
             label_lists += list(data_dict['label'].cpu().detach().numpy())
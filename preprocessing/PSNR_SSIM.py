@@ -1,30 +1,269 @@
+"""
+PSNR and SSIM between the original frames and their compressed versions.
+
+Frames are paired by relative path (`.png` originals, `.jpg` compressed frames), grouped by video and
+evaluated in batches: the Gaussian window of SSIM is applied with separable convolutions over the
+stacked frames of a video, and the videos are spread over worker processes. The results are written
+as per-video and per-quality aggregates in CSV or Parquet.
+"""
+
+import os
+import csv
+import logging
+import argparse
+import concurrent.futures
 import cv2
 import numpy as np
+from scipy.ndimage import correlate1d
 from skimage.metrics import structural_similarity as ssim
+from tqdm import tqdm
+
+# Value reported for identical frames, where the PSNR is infinite
+MAX_PSNR = 100
+
 
 def calculate_psnr(original, compressed):
-    mse = np.mean((original - compressed) ** 2)
+    mse = np.mean((original.astype(np.float64) - compressed.astype(np.float64)) ** 2)
     if mse == 0:
-        return 100
+        return MAX_PSNR
     max_pixel = 255.0
     psnr = 20 * np.log10(max_pixel / np.sqrt(mse))
     return psnr
 
+
 def calculate_ssim(original, compressed):
     return ssim(original, compressed, data_range=compressed.max() - compressed.min(), multichannel=True)
 
-# Load images
-original = cv2.imread('./datasets/FaceForensics++/manipulated_sequences/Face2Face/c23/frames/000_003/000.png')
-# compressed = cv2.imread('./datasets/FaceForensics++/manipulated_sequences/Deepfakes/c40/frames/000_003/000.png')
-compressed = cv2.imread('./datasets/ff++_compressed/manipulated_sequences/Face2Face/c85/frames/000_003/000.jpg')
 
-# Convert images to grayscale for SSIM
-original_gray = cv2.cvtColor(original, cv2.COLOR_BGR2GRAY)
-compressed_gray = cv2.cvtColor(compressed, cv2.COLOR_BGR2GRAY)
+def batch_psnr(originals, compressed, max_pixel=255.0):
+    """
+    Computes the PSNR of a batch of frames.
+
+    Args:
+        originals (np.ndarray): The original frames, [B, H, W].
+        compressed (np.ndarray): The compressed frames, [B, H, W].
+        max_pixel (float): The maximum pixel value.
+
+    Returns:
+        np.ndarray: The PSNR of each frame, [B].
+    """
+    diff = originals.astype(np.float32) - compressed.astype(np.float32)
+    mse = np.mean(diff.reshape(len(diff), -1) ** 2, axis=1)
+    with np.errstate(divide='ignore'):
+        psnr = 20 * np.log10(max_pixel / np.sqrt(mse))
+    return np.where(mse == 0, MAX_PSNR, psnr)
+
+
+def gaussian_kernel(sigma=1.5, truncate=3.5):
+    """
+    Returns the normalized 1D Gaussian window of SSIM (11 taps for sigma=1.5, as in skimage).
+    """
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float32)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def batch_ssim(originals, compressed, data_range=255.0, sigma=1.5, k1=0.01, k2=0.03):
+    """
+    Computes the Gaussian-window SSIM of a batch of grayscale frames. Equivalent to skimage's
+    `structural_similarity(gaussian_weights=True, sigma=1.5, use_sample_covariance=False)`.
+
+    Args:
+        originals (np.ndarray): The original frames, [B, H, W].
+        compressed (np.ndarray): The compressed frames, [B, H, W].
+        data_range (float): The dynamic range of the pixel values.
+        sigma (float): The standard deviation of the Gaussian window.
+        k1 (float): The luminance constant.
+        k2 (float): The contrast constant.
+
+    Returns:
+        np.ndarray: The mean SSIM of each frame, [B].
+    """
+    x = originals.astype(np.float32)
+    y = compressed.astype(np.float32)
+    kernel = gaussian_kernel(sigma)
+
+    def filt(img):
+        # The 2D Gaussian window is separable: filter the rows then the columns of every frame at once
+        return correlate1d(correlate1d(img, kernel, axis=1, mode='reflect'), kernel, axis=2, mode='reflect')
+
+    mu_x, mu_y = filt(x), filt(y)
+    sigma_xx = filt(x * x) - mu_x * mu_x
+    sigma_yy = filt(y * y) - mu_y * mu_y
+    sigma_xy = filt(x * y) - mu_x * mu_y
+
+    c1, c2 = (k1 * data_range) ** 2, (k2 * data_range) ** 2
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / \
+               ((mu_x ** 2 + mu_y ** 2 + c1) * (sigma_xx + sigma_yy + c2))
+
+    # Ignore the borders where the window leaves the frame, as skimage does
+    pad = len(kernel) // 2
+    return ssim_map[:, pad:-pad, pad:-pad].reshape(len(ssim_map), -1).mean(axis=1, dtype=np.float64)
+
+
+def list_frame_pairs(original_root, compressed_root, qualities):
+    """
+    Pairs the original frames with their compressed versions by relative path.
+
+    Args:
+        original_root (str): The root folder of the original PNG frames.
+        compressed_root (str): The root folder of the compressed JPG frames, with a `{quality}` placeholder.
+        qualities (list): The JPEG quality levels.
+
+    Returns:
+        dict: For each (quality, video), the list of (original path, compressed path) pairs.
+    """
+    pairs = {}
+    for root, dirs, files in os.walk(original_root):
+        video = os.path.relpath(root, original_root)
+        for file in sorted(files):
+            if not file.endswith('.png'):
+                continue
+            for quality in qualities:
+                compressed_path = os.path.join(compressed_root.format(quality=quality), video, file.replace('.png', '.jpg'))
+                if os.path.exists(compressed_path):
+                    pairs.setdefault((quality, video), []).append((os.path.join(root, file), compressed_path))
+    return pairs
+
+
+def evaluate_video(task):
+    """
+    Computes the PSNR and SSIM of the frames of one video at one quality level.
+
+    Args:
+        task (tuple): The quality, the video, its frame pairs and the batch size.
+
+    Returns:
+        dict: The per-video aggregate.
+    """
+    quality, video, frame_pairs, batch_size = task
+    psnrs, ssims = [], []
+    for start in range(0, len(frame_pairs), batch_size):
+        originals, compressed = [], []
+        for original_path, compressed_path in frame_pairs[start:start + batch_size]:
+            # Grayscale, as for the single-pair comparison
+            original = cv2.imread(original_path, cv2.IMREAD_GRAYSCALE)
+            compressed_frame = cv2.imread(compressed_path, cv2.IMREAD_GRAYSCALE)
+            if original is None or compressed_frame is None or original.shape != compressed_frame.shape:
+                logging.warning(f"Skipping the pair {original_path}, {compressed_path}")
+                continue
+            originals.append(original)
+            compressed.append(compressed_frame)
+        if not originals:
+            continue
+        # The aligned crops of a video share the same size, otherwise evaluate them one by one
+        if len({frame.shape for frame in originals}) == 1:
+            groups = [(np.stack(originals), np.stack(compressed))]
+        else:
+            groups = [(original[None], compressed_frame[None]) for original, compressed_frame in zip(originals, compressed)]
+        for original_batch, compressed_batch in groups:
+            psnrs.extend(batch_psnr(original_batch, compressed_batch))
+            ssims.extend(batch_ssim(original_batch, compressed_batch))
+    return {
+        'quality': quality,
+        'video': video,
+        'num_frames': len(psnrs),
+        'psnr': float(np.mean(psnrs)) if psnrs else float('nan'),
+        'ssim': float(np.mean(ssims)) if ssims else float('nan'),
+    }
+
+
+def aggregate_qualities(video_rows):
+    """
+    Aggregates the per-video results for each quality level, weighting the videos by their number of frames.
+    """
+    rows = []
+    for quality in sorted({row['quality'] for row in video_rows}):
+        videos = [row for row in video_rows if row['quality'] == quality and row['num_frames'] > 0]
+        weights = np.array([row['num_frames'] for row in videos], dtype=np.float64)
+        psnrs = np.array([row['psnr'] for row in videos])
+        ssims = np.array([row['ssim'] for row in videos])
+        rows.append({
+            'quality': quality,
+            'num_videos': len(videos),
+            'num_frames': int(weights.sum()),
+            'psnr': float(np.average(psnrs, weights=weights)) if videos else float('nan'),
+            'psnr_std': float(psnrs.std()) if videos else float('nan'),
+            'ssim': float(np.average(ssims, weights=weights)) if videos else float('nan'),
+            'ssim_std': float(ssims.std()) if videos else float('nan'),
+        })
+    return rows
+
+
+def write_rows(rows, path):
+    """
+    Writes a list of dicts as CSV, or as Parquet (requires pandas and pyarrow) when the path ends with '.parquet'.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if path.endswith('.parquet'):
+        import pandas as pd
+        pd.DataFrame(rows).to_parquet(path, index=False)
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else [])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def evaluate_dataset(original_root, compressed_root, qualities, output_dir, output_format='csv',
+                     num_workers=None, batch_size=32):
+    """
+    Computes the PSNR and SSIM of every compressed frame of a dataset and writes the aggregates.
+
+    Args:
+        original_root (str): The root folder of the original PNG frames.
+        compressed_root (str): The root folder of the compressed JPG frames, with a `{quality}` placeholder.
+        qualities (list): The JPEG quality levels.
+        output_dir (str): The folder of `psnr_ssim_per_video` and `psnr_ssim_per_quality`.
+        output_format (str): 'csv' or 'parquet'.
+        num_workers (int): Number of worker processes, all the CPUs by default.
+        batch_size (int): Number of frames evaluated at once.
+
+    Returns:
+        list: The per-quality aggregates.
+    """
+    if len(qualities) > 1 and '{quality}' not in compressed_root:
+        raise ValueError("compressed_root needs a {quality} placeholder to evaluate several quality levels")
+
+    pairs = list_frame_pairs(original_root, compressed_root, qualities)
+    tasks = [(quality, video, frame_pairs, batch_size) for (quality, video), frame_pairs in sorted(pairs.items())]
+    logging.info(f"Evaluating {sum(len(task[2]) for task in tasks)} frame pairs of {len(tasks)} videos")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+        video_rows = list(tqdm(executor.map(evaluate_video, tasks), total=len(tasks), desc="Evaluating videos"))
+
+    quality_rows = aggregate_qualities(video_rows)
+    write_rows(video_rows, os.path.join(output_dir, f'psnr_ssim_per_video.{output_format}'))
+    write_rows(quality_rows, os.path.join(output_dir, f'psnr_ssim_per_quality.{output_format}'))
+    for row in quality_rows:
+        logging.info(f"Quality {row['quality']}: PSNR {row['psnr']:.2f} dB, SSIM {row['ssim']:.4f} "
+                     f"({row['num_videos']} videos, {row['num_frames']} frames)")
+    return quality_rows
+
 
-# Calculate metrics
-psnr_value = calculate_psnr(original_gray, compressed_gray)
-ssim_value = calculate_ssim(original_gray, compressed_gray)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the PSNR and SSIM of compressed frames.')
+    parser.add_argument('--original', type=str, default='./datasets/FaceForensics++/manipulated_sequences/Face2Face/c23/frames',
+                        help='root folder of the original PNG frames')
+    parser.add_argument('--compressed', type=str, default='./datasets/ff++_compressed/manipulated_sequences/Face2Face/c{quality}/frames',
+                        help='root folder of the compressed frames, {quality} is replaced by each quality level')
+    parser.add_argument('--quality', type=int, nargs='+', default=[10, 15, 85, 100], help='JPEG quality levels')
+    parser.add_argument('--output', type=str, default='./analysis/psnr_ssim', help='output folder of the aggregates')
+    parser.add_argument('--format', type=str, default='csv', choices=['csv', 'parquet'], help='output format')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--batch-size', type=int, default=32, help='number of frames evaluated at once')
+    parser.add_argument('--pair', type=str, nargs=2, metavar=('ORIGINAL', 'COMPRESSED'),
+                        help='compare a single pair of images instead of a dataset')
+    args = parser.parse_args()
 
-print(f"PSNR: {psnr_value}")
-print(f"SSIM: {ssim_value}")
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.pair:
+        # Convert images to grayscale for SSIM
+        original_gray = cv2.imread(args.pair[0], cv2.IMREAD_GRAYSCALE)
+        compressed_gray = cv2.imread(args.pair[1], cv2.IMREAD_GRAYSCALE)
+        print(f"PSNR: {calculate_psnr(original_gray, compressed_gray)}")
+        print(f"SSIM: {batch_ssim(original_gray[None], compressed_gray[None])[0]}")
+    else:
+        evaluate_dataset(args.original, args.compressed, args.quality, args.output, output_format=args.format,
+                         num_workers=args.workers, batch_size=args.batch_size)
@@ -1,50 +1,344 @@
 import subprocess
 import os
+import io
+import time
+import shutil
 import logging
+import argparse
+import concurrent.futures
+import cv2
+import numpy as np
 from tqdm import tqdm
 
-# from PIL import Image
+from PIL import Image
 
-def compress_images(input_folder, output_root, quality):
+
+def list_images(input_folder):
+    """
+    Lists the PNG frames of a folder recursively.
+
+    Args:
+        input_folder (str): The root folder of the frames.
+
+    Returns:
+        list: The (root, file) pairs of the frames.
+    """
     all_files = []
     for root, dirs, files in os.walk(input_folder):
         for file in files:
             if file.endswith(".png"):
                 all_files.append((root, file))
+    return all_files
+
+
+def get_output_path(output_root, input_folder, root, file, quality):
+    """
+    Returns the path of the compressed frame, keeping the structure of the input folder.
+    `output_root` may contain a `{quality}` placeholder, e.g. './ff++_compressed/Face2Face/c{quality}/frames'.
+    """
+    relative_path = os.path.relpath(root, input_folder)  # Get relative path to maintain structure
+    output_folder = os.path.join(output_root.format(quality=quality), relative_path)
+    return os.path.join(output_folder, file.replace('.png', '.jpg'))
+
+
+def is_up_to_date(input_path, output_path):
+    """
+    Checks whether the compressed frame exists and is newer than its source.
+    """
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+
+
+class JPEGEncoder:
+    """
+    Base class of the JPEG encoders. Every encoder writes the given quality with 4:2:0 chroma subsampling,
+    progressive scans and optimized Huffman tables. Only mozjpeg (cjpeg, or turbojpeg loading the libturbojpeg
+    of a mozjpeg build) also applies trellis quantization and its own quantization tables: the stock
+    libjpeg-turbo and Pillow use the Annex K tables, so the same quality gives different files, sizes and PSNR.
+    """
+    name = None
+
+    def encode(self, img, quality):
+        """
+        Encodes an image.
+
+        Args:
+            img (np.ndarray): The decoded image, in BGR order.
+            quality (int): The JPEG quality (1-100, where 100 means full quality).
+
+        Returns:
+            bytes: The JPEG file.
+        """
+        raise NotImplementedError
+
+
+class CJpegEncoder(JPEGEncoder):
+    """
+    The `cjpeg` binary of mozjpeg, one process per image. Kept for compatibility with the previous runs.
+    """
+    name = 'cjpeg'
+
+    def __init__(self):
+        if shutil.which('cjpeg') is None:
+            raise FileNotFoundError("cjpeg is not in the PATH")
+
+    def encode(self, img, quality):
+        # Pipe the decoded image as a binary PPM, mozjpeg's defaults are progressive and optimized
+        ppm_bytes = cv2.imencode('.ppm', img)[1].tobytes()
+        command = ['cjpeg', '-quality', str(quality)]
+        return subprocess.run(command, input=ppm_bytes, stdout=subprocess.PIPE, check=True).stdout
+
+
+class TurboJPEGEncoder(JPEGEncoder):
+    """
+    In-process libjpeg-turbo through PyTurboJPEG. Only equivalent to cjpeg when `lib_path` points to the
+    libturbojpeg of a mozjpeg build, which applies the trellis quantization and the tables of cjpeg.
+    """
+    name = 'turbojpeg'
+
+    def __init__(self, lib_path=None):
+        from turbojpeg import TurboJPEG, TJSAMP_420, TJFLAG_PROGRESSIVE
+        self.jpeg = TurboJPEG(lib_path) if lib_path else TurboJPEG()
+        self.subsample = TJSAMP_420
+        self.flags = TJFLAG_PROGRESSIVE
+
+    def encode(self, img, quality):
+        # Progressive scans always come with optimized Huffman tables in libjpeg-turbo
+        return self.jpeg.encode(img, quality=quality, jpeg_subsample=self.subsample, flags=self.flags)
+
+
+class PillowEncoder(JPEGEncoder):
+    """
+    In-process encoder of Pillow, with the Annex K tables: not equivalent to cjpeg at the same quality.
+    """
+    name = 'pillow'
+
+    def encode(self, img, quality):
+        buffer = io.BytesIO()
+        Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)).save(
+            buffer, format='JPEG', quality=quality, optimize=True, progressive=True, subsampling=2)
+        return buffer.getvalue()
+
+
+ENCODERS = {
+    CJpegEncoder.name: CJpegEncoder,
+    TurboJPEGEncoder.name: TurboJPEGEncoder,
+    PillowEncoder.name: PillowEncoder,
+}
+
+
+def build_encoder(name='cjpeg', lib_path=None):
+    """
+    Builds a JPEG encoder. cjpeg is the reference, the in-process encoders are opt-in as they only give the
+    same output with the libturbojpeg of mozjpeg.
+
+    Args:
+        name (str): 'cjpeg', 'turbojpeg' or 'pillow'.
+        lib_path (str): The libturbojpeg loaded by the turbojpeg encoder, e.g. the one of a mozjpeg build.
 
-    for root, file in tqdm(all_files, desc="Compressing images", unit="file"):
-        input_path = os.path.join(root, file)
-        relative_path = os.path.relpath(root, input_folder)  # Get relative path to maintain structure
-        output_folder = os.path.join(output_root, relative_path)
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
-        output_path = os.path.join(output_folder, file.replace('.png', '.jpg'))
-        
-        # # Skip processing if the output file already exists
-        # if os.path.exists(output_path):
-        #     logging.info(f"Skipping {output_path} as it already exists.")
-        #     continue
-        
-        # Command to compress images using mozjpeg
-        command = [
-            'cjpeg',
-            '-quality', str(quality),
-            '-outfile', output_path, input_path
-        ]
+    Returns:
+        JPEGEncoder: The encoder.
+    """
+    if name not in ENCODERS:
+        raise NotImplementedError(f"Encoder {name} is not implemented")
+    if name == TurboJPEGEncoder.name:
+        return TurboJPEGEncoder(lib_path)
+    return ENCODERS[name]()
+
+
+# Per-process encoder, built once by `init_worker`
+encoder = None
+
+
+def init_worker(encoder_name, lib_path=None):
+    """
+    Initializer of the process pool: builds the encoder a single time per worker.
+    """
+    global encoder
+    encoder = build_encoder(encoder_name, lib_path)
+
+
+def compress_one_image(input_path, output_paths, force=False):
+    """
+    Compresses one frame at several quality levels, decoding the PNG only once.
+
+    Args:
+        input_path (str): The path to the PNG frame.
+        output_paths (dict): The output path for each quality level.
+        force (bool): Whether to compress again the outputs that are up to date.
+
+    Returns:
+        tuple: Number of outputs written, bytes of the input times the outputs written, bytes of the outputs written.
+    """
+    todo = {quality: path for quality, path in output_paths.items() if force or not is_up_to_date(input_path, path)}
+    if not todo:
+        return 0, 0, 0
+
+    # Decode the PNG once and reuse it for all the quality levels
+    img = cv2.imread(input_path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Failed to read {input_path}")
+    input_size = os.path.getsize(input_path)
+
+    num_written, output_size = 0, 0
+    for quality, output_path in todo.items():
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        jpeg_bytes = encoder.encode(img, quality)
+        # Write under a temporary name then rename, a truncated file would look up to date after a crash
+        tmp_path = f'{output_path}.tmp{os.getpid()}'
+        with open(tmp_path, 'wb') as f:
+            f.write(jpeg_bytes)
+        os.replace(tmp_path, output_path)
+        num_written += 1
+        output_size += len(jpeg_bytes)
+    return num_written, input_size * num_written, output_size
+
+
+def compress_task(task):
+    """
+    Worker entry point: compresses one frame and reports the error instead of raising it.
+    """
+    input_path, output_paths, force = task
+    try:
+        return input_path, compress_one_image(input_path, output_paths, force), None
+    except (subprocess.CalledProcessError, ValueError, OSError) as e:
+        return input_path, (0, 0, 0), e
+
+
+def compress_dataset(input_folder, output_root, qualities, num_workers=None, force=False, chunksize=64,
+                     encoder_name='cjpeg', lib_path=None):
+    """
+    Compresses every frame of a folder at several quality levels in parallel processes.
+
+    Args:
+        input_folder (str): The root folder of the PNG frames.
+        output_root (str): The output folder, with a `{quality}` placeholder when several qualities are produced.
+        qualities (list): The JPEG quality levels.
+        num_workers (int): Number of worker processes, defaults to the number of CPUs.
+        force (bool): Whether to compress again the outputs that are up to date.
+        chunksize (int): Number of frames sent to a worker at once.
+        encoder_name (str): The JPEG encoder, see `build_encoder`.
+        lib_path (str): The libturbojpeg of the turbojpeg encoder.
+
+    Returns:
+        dict: The summary of the run (files, outputs, bytes saved, files/s).
+    """
+    if len(qualities) > 1 and '{quality}' not in output_root:
+        raise ValueError("output_root needs a {quality} placeholder to compress several quality levels")
+    all_files = list_images(input_folder)
+    tasks = (
+        (os.path.join(root, file),
+         {quality: get_output_path(output_root, input_folder, root, file, quality) for quality in qualities},
+         force)
+        for root, file in all_files
+    )
+
+    logging.info(f"Compressing {len(all_files)} files at qualities {qualities} with the {build_encoder(encoder_name, lib_path).name} encoder")
+    start_time = time.monotonic()
+    num_files, num_outputs, input_bytes, output_bytes, num_errors = 0, 0, 0, 0, 0
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers or os.cpu_count(), initializer=init_worker, initargs=(encoder_name, lib_path)) as executor:
+        results = executor.map(compress_task, tasks, chunksize=chunksize)
+        for input_path, (written, in_bytes, out_bytes), error in tqdm(results, total=len(all_files), desc="Compressing images", unit="file"):
+            if error is not None:
+                num_errors += 1
+                logging.error(f"Error processing {input_path}: {error}")
+                continue
+            num_files += 1
+            num_outputs += written
+            input_bytes += in_bytes
+            output_bytes += out_bytes
+            logging.debug(f"Compressed {input_path} to {written} quality levels")
+
+    duration = max(time.monotonic() - start_time, 1e-6)
+    summary = {
+        'files': num_files,
+        'errors': num_errors,
+        'outputs': num_outputs,
+        'input_bytes': input_bytes,
+        'output_bytes': output_bytes,
+        'bytes_saved': input_bytes - output_bytes,
+        'files_per_second': num_files / duration,
+    }
+    logging.info(f"Compressed {num_files} files into {num_outputs} outputs ({num_errors} errors) "
+                 f"in {duration:.1f} s, {summary['files_per_second']:.1f} files/s, "
+                 f"{summary['bytes_saved'] / 2**20:.1f} MiB saved")
+    return summary
+
+
+def compress_images(input_folder, output_root, quality, encoder_name='cjpeg'):
+    """
+    Compresses every frame of a folder at one quality level.
+    """
+    return compress_dataset(input_folder, output_root, [quality], encoder_name=encoder_name)
+
+
+def benchmark_encoders(input_folder, qualities, num_images=100, encoder_names=('cjpeg', 'turbojpeg', 'pillow'), lib_path=None):
+    """
+    Compares the speed, size and PSNR of the available encoders on a sample of frames, on a single core.
+
+    Args:
+        input_folder (str): The root folder of the PNG frames.
+        qualities (list): The JPEG quality levels.
+        num_images (int): Number of frames of the sample.
+        encoder_names (tuple): The encoders to compare, the unavailable ones are skipped.
+        lib_path (str): The libturbojpeg of the turbojpeg encoder.
+
+    Returns:
+        dict: For each encoder and quality, the images/s, mean bytes and mean PSNR.
+    """
+    images = []
+    for root, file in list_images(input_folder)[:num_images]:
+        img = cv2.imread(os.path.join(root, file), cv2.IMREAD_COLOR)
+        if img is not None:
+            images.append(img)
+    if not images:
+        raise ValueError(f"No frames found in {input_folder}")
+
+    results = {}
+    for name in encoder_names:
         try:
-            subprocess.run(command, check=True)
-            logging.info(f"Compressed {input_path} to {output_path}")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error processing {input_path}: {e}")
-                    
-                
+            bench_encoder = build_encoder(name, lib_path)
+        except (ImportError, RuntimeError, OSError) as e:
+            logging.warning(f"Skipping the {name} encoder: {e}")
+            continue
+        for quality in qualities:
+            start_time = time.monotonic()
+            outputs = [bench_encoder.encode(img, quality) for img in images]
+            duration = max(time.monotonic() - start_time, 1e-6)
+            psnrs = [cv2.PSNR(img, cv2.imdecode(np.frombuffer(jpeg_bytes, np.uint8), cv2.IMREAD_COLOR))
+                     for img, jpeg_bytes in zip(images, outputs)]
+            results[(name, quality)] = {
+                'images_per_second': len(images) / duration,
+                'mean_bytes': float(np.mean([len(jpeg_bytes) for jpeg_bytes in outputs])),
+                'mean_psnr': float(np.mean(psnrs)),
+            }
+            logging.info(f"{name:>9} q{quality:<3}: {results[(name, quality)]['images_per_second']:8.1f} images/s, "
+                         f"{results[(name, quality)]['mean_bytes']:8.0f} bytes, "
+                         f"PSNR {results[(name, quality)]['mean_psnr']:.2f} dB")
+    return results
+
+
 if __name__ == '__main__':
-     
-    input_folder = './datasets/FaceForensics++/original_sequences/youtube/c23/frames'
-    output_root = './datasets/FaceForensics++_JPG/manipulated_sequences/Deepfakes/c23/frames'
+    parser = argparse.ArgumentParser(description='Compress PNG frames with mozjpeg at several quality levels.')
+    parser.add_argument('--input', type=str, default='./datasets/FaceForensics++/original_sequences/youtube/c23/frames',
+                        help='root folder of the PNG frames')
+    parser.add_argument('--output', type=str, default='./datasets/FaceForensics++_JPG/original_sequences/youtube/c{quality}/frames',
+                        help='output folder, {quality} is replaced by each quality level')
     # Adjust the quality according to the compression desired (1-100, where 100 means full quality)
-    # quality_level = 15
-    # quality_level = 10
-    quality_level = 100
-    compress_images(input_folder, output_root, quality_level)
+    parser.add_argument('--quality', type=int, nargs='+', default=[10, 15, 85, 100], help='JPEG quality levels')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--force', action='store_true', help='compress again the outputs that are up to date')
+    parser.add_argument('--encoder', type=str, default='cjpeg', choices=list(ENCODERS),
+                        help='JPEG encoder, turbojpeg and pillow are faster but only match cjpeg with --turbojpeg_lib of mozjpeg')
+    parser.add_argument('--turbojpeg_lib', type=str, default=None,
+                        help='libturbojpeg loaded by the turbojpeg encoder, e.g. /opt/mozjpeg/lib64/libturbojpeg.so')
+    parser.add_argument('--benchmark', type=int, default=0, metavar='N',
+                        help='compare the encoders on N frames of the input instead of compressing')
+    args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.benchmark:
+        benchmark_encoders(args.input, args.quality, num_images=args.benchmark, lib_path=args.turbojpeg_lib)
+    else:
+        compress_dataset(args.input, args.output, args.quality, num_workers=args.workers, force=args.force,
+                         encoder_name=args.encoder, lib_path=args.turbojpeg_lib)
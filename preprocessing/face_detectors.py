@@ -0,0 +1,170 @@
+"""
+Face detector backends for the preprocessing.
+
+Every backend returns the face boxes of a frame as dlib rectangles, so the 81-point dlib
+shape predictor can run on them whatever the detector. Backends that support batching
+receive the sampled frames of a video in a single `detect_batch` call.
+"""
+
+import cv2
+import dlib
+import numpy as np
+
+
+class FaceDetectorBackend:
+    """
+    Base class of the face detector backends.
+    """
+    name = None
+    supports_batching = False
+
+    def detect(self, rgb):
+        """
+        Detects the faces of one RGB frame.
+
+        Args:
+            rgb (np.ndarray): The frame in RGB order.
+
+        Returns:
+            list: The face boxes as dlib rectangles.
+        """
+        raise NotImplementedError
+
+    def detect_batch(self, rgb_frames):
+        """
+        Detects the faces of several RGB frames of the same size.
+
+        Args:
+            rgb_frames (list): The frames in RGB order.
+
+        Returns:
+            list: For each frame, the list of face boxes as dlib rectangles.
+        """
+        return [self.detect(rgb) for rgb in rgb_frames]
+
+
+def to_dlib_rect(x1, y1, x2, y2, width, height):
+    """
+    Converts a box in pixels to a dlib rectangle clipped to the frame.
+    """
+    x1, y1 = max(0, int(round(x1))), max(0, int(round(y1)))
+    x2, y2 = min(width - 1, int(round(x2))), min(height - 1, int(round(y2)))
+    return dlib.rectangle(x1, y1, x2, y2)
+
+
+class DlibHOGDetector(FaceDetectorBackend):
+    """
+    The dlib HOG frontal face detector, one frame at a time.
+    """
+    name = 'dlib'
+
+    def __init__(self, upsample=1, face_detector=None, **kwargs):
+        self.upsample = upsample
+        self.face_detector = face_detector if face_detector is not None else dlib.get_frontal_face_detector()
+
+    def detect(self, rgb):
+        return list(self.face_detector(rgb, self.upsample))
+
+
+class MTCNNDetector(FaceDetectorBackend):
+    """
+    The MTCNN detector, batched with facenet-pytorch or one frame at a time with the mtcnn package.
+    """
+    name = 'mtcnn'
+
+    def __init__(self, min_confidence=0.9, device='cpu', **kwargs):
+        self.min_confidence = min_confidence
+        try:
+            from facenet_pytorch import MTCNN
+            self.mtcnn = MTCNN(keep_all=True, device=device)
+            self.supports_batching = True
+        except ImportError:
+            try:
+                from mtcnn.mtcnn import MTCNN
+            except ImportError as e:
+                raise ImportError("The mtcnn backend requires the facenet-pytorch or the mtcnn package") from e
+            self.mtcnn = MTCNN()
+            self.supports_batching = False
+
+    def detect(self, rgb):
+        if self.supports_batching:
+            return self.detect_batch([rgb])[0]
+        height, width = rgb.shape[:2]
+        faces = []
+        for face in self.mtcnn.detect_faces(rgb):
+            if face['confidence'] < self.min_confidence:
+                continue
+            x, y, w, h = face['box']
+            faces.append(to_dlib_rect(x, y, x + w, y + h, width, height))
+        return faces
+
+    def detect_batch(self, rgb_frames):
+        if not self.supports_batching:
+            return super().detect_batch(rgb_frames)
+        height, width = rgb_frames[0].shape[:2]
+        batch_boxes, batch_probs = self.mtcnn.detect(np.stack(rgb_frames))
+        results = []
+        for boxes, probs in zip(batch_boxes, batch_probs):
+            faces = []
+            if boxes is not None:
+                for box, prob in zip(boxes, probs):
+                    if prob >= self.min_confidence:
+                        faces.append(to_dlib_rect(*box, width, height))
+            results.append(faces)
+        return results
+
+
+class OpenCVDNNDetector(FaceDetectorBackend):
+    """
+    The OpenCV DNN res10 SSD face detector, batched through `cv2.dnn.blobFromImages`.
+    """
+    name = 'opencv_dnn'
+    supports_batching = True
+
+    def __init__(self, dnn_prototxt, dnn_model, min_confidence=0.9, input_size=300, **kwargs):
+        self.net = cv2.dnn.readNetFromCaffe(dnn_prototxt, dnn_model)
+        self.min_confidence = min_confidence
+        self.input_size = input_size
+
+    def detect(self, rgb):
+        return self.detect_batch([rgb])[0]
+
+    def detect_batch(self, rgb_frames):
+        height, width = rgb_frames[0].shape[:2]
+        # The model is trained on BGR frames
+        blob = cv2.dnn.blobFromImages(
+            rgb_frames, 1.0, (self.input_size, self.input_size), (104.0, 177.0, 123.0), swapRB=True)
+        self.net.setInput(blob)
+        # Rows of [image id, class, confidence, x1, y1, x2, y2] with coordinates relative to the frame size
+        detections = self.net.forward().reshape(-1, 7)
+        results = [[] for _ in rgb_frames]
+        for image_id, _, confidence, x1, y1, x2, y2 in detections:
+            if confidence < self.min_confidence or image_id < 0:
+                continue
+            results[int(image_id)].append(to_dlib_rect(x1 * width, y1 * height, x2 * width, y2 * height, width, height))
+        return results
+
+
+DETECTOR_BACKENDS = {
+    DlibHOGDetector.name: DlibHOGDetector,
+    MTCNNDetector.name: MTCNNDetector,
+    OpenCVDNNDetector.name: OpenCVDNNDetector,
+}
+
+
+def build_detector_backend(options, face_detector=None):
+    """
+    Builds the face detector backend selected in the configuration.
+
+    Args:
+        options (dict): The detector options, 'backend' is the name of the backend and the others are passed to it.
+        face_detector: An already loaded dlib HOG detector, reused by the dlib backend.
+
+    Returns:
+        FaceDetectorBackend: The backend.
+    """
+    options = dict(options or {})
+    name = options.pop('backend', DlibHOGDetector.name)
+    if name not in DETECTOR_BACKENDS:
+        raise NotImplementedError(f"Detector backend {name} is not implemented")
+    return DETECTOR_BACKENDS[name](face_detector=face_detector, **options)
@@ -7,6 +7,7 @@ import yaml
 import logging
 import datetime
 import glob
+import json
 import concurrent.futures
 import numpy as np
 from tqdm import tqdm
@@ -14,6 +15,8 @@ from pathlib import Path
 from imutils import face_utils
 from skimage import transform as trans
 
+from face_detectors import build_detector_backend
+
 
 def create_logger(log_path):
     """
@@ -45,6 +48,52 @@ def create_logger(log_path):
     return logger
 
 
+# Per-process dlib models and detector backend, loaded once by `init_worker` and reused
+# for every video handled by that worker.
+face_detector = None
+face_predictor = None
+detector_backend = None
+
+
+def load_dlib_models(predictor_path):
+    """
+    Loads the dlib frontal face detector and the 81-point shape predictor.
+
+    Args:
+        predictor_path (str): The path to the shape predictor model file.
+
+    Returns:
+        tuple: The face detector and the shape predictor.
+    """
+    ## Check if predictor path exists
+    if not os.path.exists(predictor_path):
+        logger.error(f"Predictor path does not exist: {predictor_path}")
+        sys.exit()
+    return dlib.get_frontal_face_detector(), dlib.shape_predictor(predictor_path)
+
+
+def init_worker(predictor_path, log_path, detector_options=None):
+    """
+    Initializer of the process pool: loads the dlib models and the detector backend a single time per worker.
+
+    Args:
+        predictor_path (str): The path to the shape predictor model file.
+        log_path (str): The path to the log file, used when the worker does not inherit the logger.
+        detector_options (dict): The options of the face detector backend, see `build_detector_backend`.
+    """
+    global logger, face_detector, face_predictor, detector_backend
+    # Forked workers inherit the handlers of the main process, spawned ones start empty
+    logger = logging.getLogger()
+    if not logger.handlers and log_path is not None:
+        logger = create_logger(log_path)
+    face_detector, face_predictor = load_dlib_models(predictor_path)
+    detector_backend = build_detector_backend(detector_options, face_detector)
+
+
+# Indices of the eyes, nose and mouth corners in the 81-point landmarks, used for the alignment
+KEYPTS_IDXS = [37, 44, 30, 49, 55]
+
+
 def get_keypts(image, face, predictor, face_detector):
     # detect the facial landmarks for the selected face
     shape = predictor(image, face)
@@ -61,7 +110,123 @@ def get_keypts(image, face, predictor, face_detector):
     return pts
 
 
-def extract_aligned_face_dlib(face_detector, predictor, image, res=256, mask=None):
+def transform_landmarks(landmarks, M):
+    """
+    Maps landmarks through a 2x3 affine matrix.
+
+    Args:
+        landmarks (np.ndarray): The (N, 2) landmarks in the original frame.
+        M (np.ndarray): The 2x3 affine matrix used to align and crop the face.
+
+    Returns:
+        np.ndarray: The (N, 2) landmarks in the coordinates of the cropped face, as integers.
+    """
+    landmarks = landmarks.astype(np.float64)
+    aligned = landmarks @ M[:, :2].T + M[:, 2]
+    return np.rint(aligned).astype(int)
+
+
+def rect_iou(rect_a, rect_b):
+    """
+    Computes the intersection over union of two dlib rectangles.
+    """
+    inter = rect_a.intersect(rect_b)
+    inter_area = inter.area() if not inter.is_empty() else 0
+    union_area = rect_a.area() + rect_b.area() - inter_area
+    return inter_area / union_area if union_area > 0 else 0.
+
+
+class FaceTracker:
+    """
+    Tracks the face box across the sampled frames of a video to avoid a full-frame detection per frame.
+
+    A full HOG pyramid runs on a keyframe, the following frames are only searched in a small window
+    around the previous box. The tracker falls back to a full-frame detection when the window detection
+    is missing, its score is below `min_score`, its overlap with the previous box is below `min_iou`,
+    or `keyframe_interval` frames have been tracked since the last keyframe.
+    """
+    def __init__(self, face_detector, search_margin=0.5, min_score=0.0, min_iou=0.5, keyframe_interval=8):
+        self.face_detector = face_detector
+        self.search_margin = search_margin
+        self.min_score = min_score
+        self.min_iou = min_iou
+        self.keyframe_interval = keyframe_interval
+        self.num_detections = 0
+        self.num_skipped = 0
+        self.detect_time = 0.
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the previous box, the next frame is a keyframe.
+        """
+        self.prev_face = None
+        self.num_tracked = 0
+
+    def detect_full(self, rgb):
+        """
+        Runs the full-frame detection and keeps the biggest face.
+        """
+        self.num_detections += 1
+        faces = self.face_detector(rgb, 1)
+        if len(faces) == 0:
+            return None
+        return max(faces, key=lambda rect: rect.width() * rect.height())
+
+    def track(self, rgb):
+        """
+        Searches the face in a window around the previous box, returns None if the tracking is lost.
+        """
+        height, width = rgb.shape[:2]
+        prev = self.prev_face
+        margin_x = int(prev.width() * self.search_margin)
+        margin_y = int(prev.height() * self.search_margin)
+        left, top = max(0, prev.left() - margin_x), max(0, prev.top() - margin_y)
+        right, bottom = min(width, prev.right() + margin_x), min(height, prev.bottom() + margin_y)
+        if right <= left or bottom <= top:
+            return None
+
+        # The face fills most of the window, so no upsampling is needed
+        faces, scores, _ = self.face_detector.run(np.ascontiguousarray(rgb[top:bottom, left:right]), 0, self.min_score)
+        if len(faces) == 0:
+            return None
+        best = int(np.argmax(scores))
+        face = faces[best]
+        face = dlib.rectangle(face.left() + left, face.top() + top, face.right() + left, face.bottom() + top)
+        if rect_iou(face, prev) < self.min_iou:
+            return None
+        return face
+
+    def __call__(self, rgb):
+        """
+        Returns the face box of the frame, or None if no face was found.
+        """
+        start_time = time.monotonic()
+        face = None
+        if self.prev_face is not None and self.num_tracked < self.keyframe_interval:
+            face = self.track(rgb)
+            if face is not None:
+                self.num_skipped += 1
+                self.num_tracked += 1
+        if face is None:
+            face = self.detect_full(rgb)
+            self.num_tracked = 0
+        self.prev_face = face
+        self.detect_time += time.monotonic() - start_time
+        return face
+
+
+def extract_aligned_face_dlib(face_detector, predictor, image, res=256, mask=None, refine=False, tracker=None,
+                              faces=None):
+    """
+    Detects the biggest face of the frame, aligns and crops it, and extracts its 81 landmarks.
+
+    By default the predictor runs once on the original frame and the landmarks are mapped into
+    the crop with the alignment matrix. With `refine`, the face is detected again on the crop and
+    the landmarks are predicted there, which costs a second HOG pass and drops the frame when the
+    re-detection fails. With a `FaceTracker`, the face box is tracked from the previous frame.
+    The boxes of `faces`, computed by a detector backend, skip the detection altogether.
+    """
     def img_align_crop(img, landmark=None, outsize=None, scale=1.3, mask=None):
         """ 
         align and crop the face according to the given bbox and landmarks
@@ -115,9 +280,9 @@ def extract_aligned_face_dlib(face_detector, predictor, image, res=256, mask=Non
         if mask is not None:
             mask = cv2.warpAffine(mask, M, (target_size[1], target_size[0]))
             mask = cv2.resize(mask, (outsize[1], outsize[0]))
-            return img, mask
+            return img, mask, M
         else:
-            return img, None
+            return img, None, M
 
     # Image size
     height, width = image.shape[:2]
@@ -125,31 +290,131 @@ def extract_aligned_face_dlib(face_detector, predictor, image, res=256, mask=Non
     # Convert to rgb
     rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
-    # Detect with dlib
-    faces = face_detector(rgb, 1)
+    # Detect with dlib, unless the faces are given
+    if faces is None:
+        if tracker is not None:
+            face = tracker(rgb)
+            faces = [face] if face is not None else []
+        else:
+            faces = face_detector(rgb, 1)
     if len(faces):
         # For now only take the biggest face
         face = max(faces, key=lambda rect: rect.width() * rect.height())
         
-        # Get the landmarks/parts for the face in box d only with the five key points
-        landmarks = get_keypts(rgb, face, predictor, face_detector)
+        # Get all the landmarks/parts for the face in box d, the five key points are used for the alignment
+        shape = face_utils.shape_to_np(predictor(rgb, face))
+        landmarks = shape[KEYPTS_IDXS]
 
         # Align and crop the face
-        cropped_face, mask_face = img_align_crop(rgb, landmarks, outsize=(res, res), mask=mask)
+        cropped_face, mask_face, M = img_align_crop(rgb, landmarks, outsize=(res, res), mask=mask)
         cropped_face = cv2.cvtColor(cropped_face, cv2.COLOR_RGB2BGR)
         
-        # Extract the all landmarks from the aligned face
-        face_align = face_detector(cropped_face, 1)
-        if len(face_align) == 0:
-            return None, None, None
-        landmark = predictor(cropped_face, face_align[0])
-        landmark = face_utils.shape_to_np(landmark)
+        if refine:
+            # Extract the all landmarks from the aligned face
+            face_align = face_detector(cropped_face, 1)
+            if len(face_align) == 0:
+                return None, None, None
+            landmark = predictor(cropped_face, face_align[0])
+            landmark = face_utils.shape_to_np(landmark)
+        else:
+            # Map the landmarks of the original frame into the aligned face
+            landmark = transform_landmarks(shape, M)
 
         return cropped_face, landmark, mask_face
     
     else:
         return None, None, None
 
+def iter_selected_frames(cap, frame_idxs, seek=False, min_seek_gap=32):
+    """
+    Iterates over the selected frames of a video, decoding only those frames.
+
+    The frames in between are skipped with `grab()`, which demuxes the packet without
+    converting it to an image. With `seek`, large gaps are jumped over by setting the
+    frame position when the container reports an accurate position, otherwise grabbing is used.
+
+    Args:
+        cap (cv2.VideoCapture): The opened video.
+        frame_idxs (list): Sorted, unique indices of the frames to decode.
+        seek (bool): Whether to seek over gaps of at least `min_seek_gap` frames.
+        min_seek_gap (int): Smallest gap for which seeking is cheaper than grabbing.
+
+    Yields:
+        tuple: (frame index, success flag, frame). Iteration stops after the first failed read.
+    """
+    pos = 0
+    for idx in frame_idxs:
+        # Jump over large gaps when the container supports accurate seeking
+        if seek and idx - pos >= min_seek_gap:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == idx:
+                pos = idx
+            else:
+                # Inaccurate seek, go back to the last known position and grab from there
+                seek = False
+                cap.set(cv2.CAP_PROP_POS_FRAMES, pos)
+
+        # Skip the frames in between without decoding them
+        while pos < idx:
+            if not cap.grab():
+                yield idx, False, None
+                return
+            pos += 1
+
+        # Decode the selected frame
+        ret, frame = cap.read()
+        pos += 1
+        yield idx, ret, frame
+        if not ret:
+            return
+
+
+def get_manifest_path(save_path, video_name):
+    """
+    Returns the path of the manifest recording the progress of one video.
+    """
+    return Path(save_path) / 'manifests' / f"{video_name}.json"
+
+
+def load_manifest(manifest_path):
+    """
+    Loads the manifest of a video.
+
+    Args:
+        manifest_path (Path): The path to the manifest file.
+
+    Returns:
+        dict: The manifest, or None if it does not exist or cannot be read.
+    """
+    if not manifest_path.is_file():
+        return None
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable manifest {manifest_path}: {e}")
+        return None
+
+
+def save_manifest(manifest_path, manifest):
+    """
+    Atomically writes the manifest of a video, so an interrupted run never leaves a truncated file.
+    """
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = manifest_path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def is_video_done(manifest, mode, num_frames, stride):
+    """
+    Checks whether a manifest records a finished video extracted with the same sampling parameters.
+    """
+    return manifest is not None and manifest.get('status') == 'done' and \
+        manifest.get('mode') == mode and manifest.get('num_frames') == num_frames and manifest.get('stride') == stride
+
+
 def video_manipulate(
     movie_path: Path,
     mask_path: Path,
@@ -157,7 +422,13 @@ def video_manipulate(
     mode: str,
     num_frames: int, 
     stride: int, 
-    ) -> None:
+    predictor_path: str = './dlib_tools/shape_predictor_81_face_landmarks.dat',
+    decode: str = 'grab',
+    refine: bool = False,
+    tracking: dict = None,
+    resume: bool = True,
+    detector_options: dict = None,
+    ) -> tuple:
     """
     Processes a single video file by detecting and cropping the largest face in each frame and saving the results.
 
@@ -168,21 +439,24 @@ def video_manipulate(
         mode (str): Either 'fixed_num_frames' or 'fixed_stride'.
         num_frames (int): Number of frames to extract from the video.
         stride (int): Number of frames to skip between each frame extracted.
-        margin (float): Amount to increase the size of the face bounding box by.
-        visualization (bool): Whether to save visualization images.
+        predictor_path (str): Path to the dlib shape predictor, only loaded when the worker has no models yet.
+        decode (str): Either 'grab' (grab skipped frames without decoding them) or 'seek' (seek to the selected frames).
+        refine (bool): Whether to re-detect the face on the crop to predict the landmarks.
+        tracking (dict): Options of the `FaceTracker` ('enabled', 'search_margin', 'min_score', 'min_iou', 'keyframe_interval').
+        resume (bool): Whether to only process the frames missing from the manifest of a previous run.
+        detector_options (dict): Options of the face detector backend ('backend', 'batch_size', ...).
 
     Returns:
-        None
+        tuple: Number of frames extracted from the video, number of frames passed to the detector, detection time in seconds.
     """
 
-    # Define face detector and predictor models
-    face_detector = dlib.get_frontal_face_detector()
-    predictor_path = './dlib_tools/shape_predictor_81_face_landmarks.dat'
-    ## Check if predictor path exists
-    if not os.path.exists(predictor_path):
-        logger.error(f"Predictor path does not exist: {predictor_path}")
-        sys.exit()
-    face_predictor = dlib.shape_predictor(predictor_path)
+    # Reuse the face detector, predictor and detector backend loaded by `init_worker`, otherwise load them for this video
+    if face_detector is not None and face_predictor is not None and detector_backend is not None:
+        detector, predictor, backend = face_detector, face_predictor, detector_backend
+    else:
+        detector, predictor = load_dlib_models(predictor_path)
+        backend = build_detector_backend(detector_options, detector)
+    batch_size = (detector_options or {}).get('batch_size', 1)
     
     def facecrop(
         org_path: Path,
@@ -193,25 +467,41 @@ def video_manipulate(
         stride: int,
         face_predictor: dlib.shape_predictor, 
         face_detector: dlib.fhog_object_detector,
+        decode: str = 'grab',
+        refine: bool = False,
+        tracking: dict = None,
+        resume: bool = True,
+        backend=None,
+        batch_size: int = 1,
         margin: float = 0.5, 
         visualization: bool = False
-        ) -> None:
+        ) -> tuple:
         """
         Helper function for cropping face and extracting landmarks.
+        Returns the number of frames saved, the number of frames passed to the detector and the detection time.
         """
         
+        # The manifest records which of the selected frames are already written
+        manifest_path = get_manifest_path(save_path, org_path.stem)
+        manifest = {
+            'video': str(org_path), 'status': 'failed', 'mode': mode, 'num_frames': num_frames, 'stride': stride,
+            'frame_idxs': [], 'written': [], 'no_face': [], 'landmarks': True, 'masks': mask_path is not None,
+        }
+
         # Open the video file
         assert org_path.exists(), f"Video file {org_path} does not exist."
         cap_org = cv2.VideoCapture(str(org_path))
         if not cap_org.isOpened():
             logger.error(f"Failed to open {org_path}")
-            return
+            save_manifest(manifest_path, manifest)
+            return 0, 0, 0.
 
         if mask_path is not None:
             cap_mask = cv2.VideoCapture(str(mask_path))
             if not cap_mask.isOpened():
                 logger.error(f"Failed to open {mask_path}")
-                return
+                save_manifest(manifest_path, manifest)
+                return 0, 0, 0.
         
         # Get the number of frames in the video
         frame_count_org = int(cap_org.get(cv2.CAP_PROP_FRAME_COUNT))
@@ -223,43 +513,115 @@ def video_manipulate(
         elif mode == 'fixed_stride':
             # Get the frame rate of the video by dividing the number of frames by the duration (same interval between frames)
             frame_idxs = np.arange(0, frame_count_org, stride, dtype=int)
-
-        # Iterate through the frames
-        for cnt_frame in range(frame_count_org):
-            ret_org, frame_org = cap_org.read()
-            if mask_path is not None:
-                ret_mask, frame_mask = cap_mask.read()
+        # Sorted unique indices, consumed with a cursor instead of a membership test on every frame
+        frame_idxs = np.unique(frame_idxs).tolist()
+
+        # Only process the frames missing from a previous run
+        written, no_face = set(), set()
+        if resume:
+            previous = load_manifest(manifest_path)
+            if previous is not None and previous.get('mode') == mode and previous.get('num_frames') == num_frames \
+                    and previous.get('stride') == stride and previous.get('masks') == (mask_path is not None):
+                written = set(previous['written'])
+                no_face = set(previous['no_face'])
             else:
-                frame_mask = None
-            height, width = frame_org.shape[:-1]
-
-            # Check if the frame was successfully read
-            if not ret_org:
-                logger.warning(f"Failed to read frame {cnt_frame} of {org_path}")
-                break
-            
-            # Check if the mask was successfully read
-            if mask_path is not None and not ret_mask:
-                logger.warning(f"Failed to read mask {cnt_frame} of {mask_path}")
-                break
-            # Check if the frame is one of the frames to extract
-            if cnt_frame not in frame_idxs:
-                continue
-
+                # Frames written by a run without manifest
+                for idx in frame_idxs:
+                    if (save_path / 'frames' / org_path.stem / f"{idx:03d}.png").is_file() and \
+                            (save_path / 'landmarks' / org_path.stem / f"{idx:03d}.npy").is_file() and \
+                            (mask_path is None or (save_path / 'masks' / org_path.stem / f"{idx:03d}.png").is_file()):
+                        written.add(idx)
+        todo_idxs = [idx for idx in frame_idxs if idx not in written and idx not in no_face]
+        manifest['frame_idxs'] = frame_idxs
+        read_failed = False
+
+        # Track the face box between the sampled frames instead of detecting it on every frame
+        if tracking is not None and tracking.get('enabled', False) and backend.name == 'dlib':
+            tracker = FaceTracker(
+                face_detector,
+                search_margin=tracking.get('search_margin', 0.5),
+                min_score=tracking.get('min_score', 0.0),
+                min_iou=tracking.get('min_iou', 0.5),
+                keyframe_interval=tracking.get('keyframe_interval', 8),
+            )
+        else:
+            tracker = None
+        batch_size = batch_size if backend.supports_batching and tracker is None else 1
+
+        num_saved = 0
+        num_detected = 0
+        detect_time = 0.
+        # Only the selected frames are decoded, the others are grabbed (or seeked over)
+        frames_org = iter_selected_frames(cap_org, todo_idxs, seek=(decode == 'seek'))
+        if mask_path is not None:
+            frames_mask = iter_selected_frames(cap_mask, todo_idxs, seek=(decode == 'seek'))
+        else:
+            frames_mask = None
+
+        def detect_batch(batch):
+            """
+            Detects the faces of a batch of frames with the backend, unless the tracker does it frame by frame.
+            """
+            nonlocal num_detected, detect_time
+            num_detected += len(batch)
+            if tracker is not None:
+                return [(cnt_frame, frame_org, frame_mask, None) for cnt_frame, frame_org, frame_mask in batch]
+            start_time = time.monotonic()
+            batch_faces = backend.detect_batch([cv2.cvtColor(frame_org, cv2.COLOR_BGR2RGB) for _, frame_org, _ in batch])
+            detect_time += time.monotonic() - start_time
+            return [(*frame, faces) for frame, faces in zip(batch, batch_faces)]
+
+        def iter_detected_frames():
+            """
+            Reads the selected frames and yields them with their faces, detected by batches of `batch_size` frames.
+            """
+            nonlocal read_failed
+            batch = []
+            for cnt_frame, ret_org, frame_org in frames_org:
+                if frames_mask is not None:
+                    _, ret_mask, frame_mask = next(frames_mask, (cnt_frame, False, None))
+                else:
+                    frame_mask = None
+
+                # Check if the frame was successfully read
+                if not ret_org:
+                    logger.warning(f"Failed to read frame {cnt_frame} of {org_path}")
+                    read_failed = True
+                    break
+                
+                # Check if the mask was successfully read
+                if mask_path is not None and not ret_mask:
+                    logger.warning(f"Failed to read mask {cnt_frame} of {mask_path}")
+                    read_failed = True
+                    break
+
+                batch.append((cnt_frame, frame_org, frame_mask))
+                if len(batch) == batch_size:
+                    yield from detect_batch(batch)
+                    batch = []
+            if batch:
+                yield from detect_batch(batch)
+
+        # Iterate through the selected frames
+        for cnt_frame, frame_org, frame_mask, faces in iter_detected_frames():
             # Use the function to extract the aligned and cropped face
             if mask_path is not None:
-                cropped_face, landmarks, masks = extract_aligned_face_dlib(face_detector, face_predictor, frame_org, mask=frame_mask)
+                cropped_face, landmarks, masks = extract_aligned_face_dlib(face_detector, face_predictor, frame_org, mask=frame_mask, refine=refine, tracker=tracker, faces=faces)
             else:
-                cropped_face, landmarks, _ = extract_aligned_face_dlib(face_detector, face_predictor, frame_org, mask=frame_mask)
+                cropped_face, landmarks, _ = extract_aligned_face_dlib(face_detector, face_predictor, frame_org, mask=frame_mask, refine=refine, tracker=tracker, faces=faces)
             
             # Check if a face was detected and cropped
             if cropped_face is None:
                 logger.warning(f"No faces in frame {cnt_frame} of {org_path}")
+                if tracker is not None:
+                    tracker.reset()
+                no_face.add(cnt_frame)
                 continue
             
             # Check if the landmarks were detected
             if landmarks is None:
                 logger.warning(f"No landmarks in frame {cnt_frame} of {org_path}")
+                no_face.add(cnt_frame)
                 continue
 
             # Save cropped face, landmarks, and visualization image
@@ -270,6 +632,7 @@ def video_manipulate(
             image_path = save_path_ / f"{cnt_frame:03d}.png"
             if image_path.is_file():
                 logger.info(f"Skipping {image_path} as it already exists.")
+                written.add(cnt_frame)
                 continue
             
             if not image_path.is_file():
@@ -282,24 +645,64 @@ def video_manipulate(
 
             # Save mask
             if mask_path is not None:
-                mask_path = save_path / 'masks' / org_path.stem / f"{cnt_frame:03d}.png"
-                os.makedirs(os.path.dirname(mask_path), exist_ok=True)
+                mask_save_path = save_path / 'masks' / org_path.stem / f"{cnt_frame:03d}.png"
+                os.makedirs(os.path.dirname(mask_save_path), exist_ok=True)
                 _, binary_mask = cv2.threshold(masks, 1, 255, cv2.THRESH_BINARY)  # obtain binary mask only
-                cv2.imwrite(str(mask_path), binary_mask)
+                cv2.imwrite(str(mask_save_path), binary_mask)
+
+            written.add(cnt_frame)
+            num_saved += 1
 
         # Release the video capture
         cap_org.release()
         if mask_path is not None:
             cap_mask.release()
 
+        if tracker is not None:
+            logger.info(f"Tracking {org_path.stem}: {tracker.num_detections} full detections, "
+                        f"{tracker.num_skipped} skipped")
+            detect_time = tracker.detect_time
+
+        # Record the progress of the video
+        manifest['written'] = sorted(written)
+        manifest['no_face'] = sorted(no_face)
+        manifest['status'] = 'partial' if read_failed else 'done'
+        save_manifest(manifest_path, manifest)
+
+        return num_saved, num_detected, detect_time
+
     # Iterate through the videos in the dataset and extract faces
     try:
-        facecrop(movie_path, mask_path, dataset_path, mode, num_frames, stride, face_predictor, face_detector)
+        return facecrop(movie_path, mask_path, dataset_path, mode, num_frames, stride, predictor, detector, decode, refine,
+                        tracking, resume, backend, batch_size)
     except Exception as e:
         logger.error(f"Error processing video {movie_path}: {e}")
+        return 0, 0, 0.
+
 
+def preprocess(dataset_path, mask_path, mode, num_frames, stride, logger, executor='process', num_workers=None,
+               predictor_path='./dlib_tools/shape_predictor_81_face_landmarks.dat', log_path=None, decode='grab',
+               refine=False, tracking=None, resume=True, detector_options=None):
+    """
+    Extracts the faces of every video in the dataset in parallel.
 
-def preprocess(dataset_path, mask_path, mode, num_frames, stride, logger):
+    Args:
+        dataset_path (Path): Path to the directory containing the videos.
+        mask_path (Path): Path to the directory containing the mask videos, or None.
+        mode (str): Either 'fixed_num_frames' or 'fixed_stride'.
+        num_frames (int): Number of frames to extract from each video.
+        stride (int): Number of frames to skip between each frame extracted.
+        logger: The logger object.
+        executor (str): 'process' to run one dlib instance per core, 'thread' to keep the legacy thread pool.
+        num_workers (int): Number of workers, defaults to the number of CPUs.
+        predictor_path (str): Path to the dlib shape predictor.
+        log_path (str): Path of the log file, used by spawned worker processes.
+        decode (str): Either 'grab' or 'seek', see `iter_selected_frames`.
+        refine (bool): Whether to re-detect the face on the crop, see `extract_aligned_face_dlib`.
+        tracking (dict): Options of the face tracking, see `FaceTracker`.
+        resume (bool): Whether to skip the videos recorded as done in their manifest.
+        detector_options (dict): Options of the face detector backend, see `build_detector_backend`.
+    """
     # Define paths to videos in dataset
     movies_path_list = sorted([Path(p) for p in glob.glob(os.path.join(dataset_path, '**/*.mp4'), recursive=True)])
     if len(movies_path_list) == 0:
@@ -308,56 +711,102 @@ def preprocess(dataset_path, mask_path, mode, num_frames, stride, logger):
     logger.info(f"{len(movies_path_list)} videos found in {dataset_path}")
     
     # Define paths to masks in dataset
+    masks_by_stem = {}
     if mask_path is not None:
         masks_path_list = sorted([Path(p) for p in glob.glob(os.path.join(mask_path, '**/*.mp4'), recursive=True)])
         if len(masks_path_list) == 0:
             logger.error(f"No masks found in {mask_path}")
             # sys.exit()
         logger.info(f"{len(masks_path_list)} masks found in {mask_path}")    
+        # Match the masks to the videos by their stem
+        masks_by_stem = {path.stem: path for path in masks_path_list}
+
+    # Skip the videos finished by a previous run before opening them
+    if resume:
+        num_videos = len(movies_path_list)
+        movies_path_list = [
+            movie_path for movie_path in movies_path_list
+            if not is_video_done(load_manifest(get_manifest_path(dataset_path, movie_path.stem)), mode, num_frames, stride)
+        ]
+        logger.info(f"{num_videos - len(movies_path_list)} videos already done, {len(movies_path_list)} left")
     
     # Start timer
     start_time = time.monotonic()
 
     # Define the number of processes based on CPU capabilities
-    num_processes = os.cpu_count()
+    num_processes = num_workers or os.cpu_count()
+
+    # Use multiprocessing to process videos in parallel, each process loads the dlib models only once
+    if executor == 'process':
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_processes, initializer=init_worker, initargs=(predictor_path, log_path, detector_options))
+    elif executor == 'thread':
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=num_processes)
+    else:
+        raise NotImplementedError(f"Executor {executor} is not implemented")
+    backend_name = (detector_options or {}).get('backend', 'dlib')
+    if tracking is not None and tracking.get('enabled', False) and backend_name != 'dlib':
+        logger.warning(f"Face tracking only works with the dlib backend, it is disabled for {backend_name}")
+    logger.info(f"Processing with {num_processes} {executor} workers and the {backend_name} detector")
 
-    # Use multiprocessing to process videos in parallel
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_processes) as executor:
+    with pool as executor:
         futures = []
         for movie_path in movies_path_list:
             # Check if there is a mask for the video
+            video_mask_path = None
             if mask_path is not None:
-                if movie_path.stem not in [path.stem for path in masks_path_list]:
-                    logger.error(f"No mask for video {movie_path}")
-                # Define the mask path
-                mask_path = next((path for path in masks_path_list if path.stem == movie_path.stem), None)
-                if mask_path is None:
+                video_mask_path = masks_by_stem.get(movie_path.stem)
+                if video_mask_path is None:
                     logger.error(f"Mask path not found for video {movie_path}")
             # Create a future for each video and submit it for processing
             futures.append(
                 executor.submit(
                 video_manipulate,
                 movie_path,
-                mask_path,
+                video_mask_path,
                 dataset_path,
                 mode,
                 num_frames,
                 stride,
+                predictor_path,
+                decode,
+                refine,
+                tracking,
+                resume,
+                detector_options,
                 )
             )
         # Wait for all futures to complete and log any errors
-        for future in tqdm(concurrent.futures.as_completed(futures), total=len(movies_path_list)):
+        num_videos_done, num_frames_done = 0, 0
+        num_frames_detected, detect_time = 0, 0.
+        progress = tqdm(concurrent.futures.as_completed(futures), total=len(movies_path_list))
+        for future in progress:
             # Print the current time
             logger.info(f"Current time: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
             try:
-                future.result()
+                num_saved, num_detected, video_detect_time = future.result()
+                num_frames_done += num_saved
+                num_frames_detected += num_detected
+                detect_time += video_detect_time
             except Exception as e:
                 logger.error(f"Error processing video: {e}")
+            num_videos_done += 1
+
+            # Report the throughput of the run so far
+            elapsed = max(time.monotonic() - start_time, 1e-6)
+            progress.set_postfix(videos_s=f"{num_videos_done / elapsed:.2f}", frames_s=f"{num_frames_done / elapsed:.1f}")
+            logger.info(f"Throughput: {num_videos_done / elapsed:.2f} videos/s, {num_frames_done / elapsed:.1f} frames/s")
             
         # End timer
         end_time = time.monotonic()
         duration_minutes = (end_time - start_time) / 60
         logger.info(f"Total time taken: {duration_minutes:.2f} minutes")
+        logger.info(f"Processed {num_videos_done} videos and {num_frames_done} frames "
+                    f"({num_videos_done / max(end_time - start_time, 1e-6):.2f} videos/s, "
+                    f"{num_frames_done / max(end_time - start_time, 1e-6):.1f} frames/s)")
+        # Detection speed of the backend, per worker
+        logger.info(f"Detector {backend_name}: {num_frames_detected} frames in {detect_time:.1f} s of detection "
+                    f"({num_frames_detected / max(detect_time, 1e-6):.1f} frames/s per worker)")
 
 if __name__ == '__main__':
     # from config.yaml load parameters
@@ -376,6 +825,13 @@ if __name__ == '__main__':
     mode = config['preprocess']['mode']['default']
     stride = config['preprocess']['stride']['default']
     num_frames = config['preprocess']['num_frames']['default']
+    executor = config['preprocess']['executor']['default']
+    num_workers = config['preprocess']['num_workers']['default']
+    decode = config['preprocess']['decode']['default']
+    refine = config['preprocess']['refine_landmarks']['default']
+    tracking = {key: value['default'] for key, value in config['preprocess']['tracking'].items()}
+    resume = config['preprocess']['resume']['default']
+    detector_options = {key: value['default'] for key, value in config['preprocess']['detector'].items()}
     
     # use dataset_name and dataset_root_path to get dataset_path
     dataset_path = Path(os.path.join(dataset_root_path, dataset_name))
@@ -394,7 +850,9 @@ if __name__ == '__main__':
             logger.error(f"Sub Dataset path does not exist: {sub_dataset_path}")
             sys.exit()
 
-        preprocess(sub_dataset_path, mask_dataset_path, mode, num_frames, stride, logger)
+        preprocess(sub_dataset_path, mask_dataset_path, mode, num_frames, stride, logger,
+                   executor=executor, num_workers=num_workers, log_path=log_path, decode=decode, refine=refine, tracking=tracking, resume=resume,
+                   detector_options=detector_options)
     else:
         logger.error(f"Dataset {dataset_name} not recognized")
         sys.exit()
@@ -57,6 +57,7 @@ After running this code, it will generates a json file looks like the below stru
 import os
 import glob
 import re
+import concurrent.futures
 import cv2
 import json
 import yaml
@@ -64,7 +65,111 @@ import pandas as pd
 from pathlib import Path
 
 
-def generate_dataset_file(dataset_name, dataset_root_path, output_file_path, compression_level='c23', perturbation = 'end_to_end'):
+# Name of the cache of the directory listings, kept next to the JSON files
+SCAN_CACHE_NAME = 'scan_cache.json'
+
+
+def load_scan_cache(path):
+    """
+    Loads the cached directory listings, {path: [mtime_ns, entry names]}.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError):
+        return {}
+
+
+def save_scan_cache(path, cache):
+    """
+    Saves the cached directory listings atomically.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def list_dir(path, cache, updates, dirs_only=False):
+    """
+    Lists a directory, reusing the cached listing when its mtime did not change.
+    Adding or removing an entry updates the mtime of its parent directory only.
+
+    Args:
+        path (str): The directory.
+        cache (dict): The listings of the last index.
+        updates (dict): Receives the new listings.
+        dirs_only (bool): Whether to list the sub-directories only.
+
+    Returns:
+        tuple: The entry names and whether the directory was rescanned.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    entry = cache.get(path)
+    if entry is not None and entry[0] == mtime:
+        return entry[1], False
+    names = [e.name for e in os.scandir(path) if not dirs_only or e.is_dir()]
+    updates[path] = [mtime, names]
+    return names, True
+
+
+def scan_frames_dir(label, compression_level, frames_dir, mask_dir, cache):
+    """
+    Lists the frames, and the masks of the fake videos, of one (label, compression level) directory.
+
+    Args:
+        label (str): The manipulation method, or 'Real'.
+        compression_level (str): The compression level.
+        frames_dir (str): The directory of the video folders.
+        mask_dir (str): The directory of the mask folders, None for the real videos.
+        cache (dict): The listings of the last index.
+
+    Returns:
+        tuple: The label, the compression level, {video name: {'frames', 'masks'}}, the new listings
+            and the number of rescanned video folders.
+    """
+    updates = {}
+    videos = {}
+    num_rescanned = 0
+    if not os.path.isdir(frames_dir):
+        return label, compression_level, videos, updates, num_rescanned
+    video_names, rescanned = list_dir(frames_dir, cache, updates, dirs_only=True)
+    num_rescanned += rescanned
+    for video_name in video_names:
+        video_path = os.path.join(frames_dir, video_name)
+        frames, rescanned = list_dir(video_path, cache, updates)
+        num_rescanned += rescanned
+        videos[video_name] = {'frames': [os.path.join(video_path, frame) for frame in frames], 'masks': []}
+        if mask_dir is not None:
+            mask_paths = os.path.join(mask_dir, video_name)
+            if os.path.exists(mask_paths):
+                masks, rescanned = list_dir(mask_paths, cache, updates)
+                num_rescanned += rescanned
+                videos[video_name]['masks'] = [os.path.join(mask_paths, frame) for frame in masks]
+    return label, compression_level, videos, updates, num_rescanned
+
+
+def write_label_file(dataset_dict, label, output_file_path, force=True):
+    """
+    Writes the JSON file of one fake label of FaceForensics++, together with the real videos.
+    Without `force`, an existing file is kept since none of its videos changed.
+    """
+    label_path = os.path.join(output_file_path, f'{label}.json')
+    if not force and os.path.exists(label_path):
+        print(f"{label}.json is up to date")
+        return
+    with open(label_path, 'w') as f:
+        data = {label: {'FF-real': dataset_dict['FaceForensics++']['FF-real'],
+                        label: dataset_dict['FaceForensics++'][label],
+                        }}
+        json.dump(data, f)
+        print(f"Finish writing {label}.json")
+
+
+def generate_dataset_file(dataset_name, dataset_root_path, output_file_path, compression_level='c23', perturbation = 'end_to_end',
+                          num_workers=None, incremental=True):
     """
     Description:
         - Generate a JSON file containing information about the specified datasets' videos and frames.
@@ -73,11 +178,19 @@ def generate_dataset_file(dataset_name, dataset_root_path, output_file_path, com
         - dataset_path: The path to the dataset.
         - output_file_path: The path to the output JSON file.
         - compression_level: The compression level of the dataset.
+        - num_workers: The number of threads walking the directories, None for the default of the thread pool.
+        - incremental: Whether to rescan only the directories whose mtime changed since the last index.
     """
 
     # Initialize an empty dictionary to store dataset information.
     dataset_dict = {}
 
+    # Directory listings of the last index, only the changed directories are scanned again
+    os.makedirs(output_file_path, exist_ok=True)
+    scan_cache_path = os.path.join(output_file_path, SCAN_CACHE_NAME)
+    scan_cache = load_scan_cache(scan_cache_path) if incremental else {}
+    cache_updates = {}
+
 
     ## FaceForensics++ dataset or DeepfakeDetection dataset
     ## Note: DeepfakeDetection dataset is a subset of FaceForensics++ dataset
@@ -123,96 +236,73 @@ def generate_dataset_file(dataset_name, dataset_root_path, output_file_path, com
             video_to_mode[d2+'_'+d1] = 'test'
         
         
-        # FaceForensics++ real dataset
+        # One scan unit per (label, compression level) directory, walked in parallel
+        units = []
+        # Labels whose videos changed since the last index
+        changed_labels = set()
         if os.path.isdir(dataset_path) and os.path.isdir(os.path.join(dataset_path, 'original_sequences')):
-            label = 'Real'
-            dataset_dict['FaceForensics++'] = {}
-            dataset_dict['FaceForensics++']['FF-real'] = {}
-            # dataset_dict['FaceForensics++']['DFD_real'] = {}
-            
-            # Iterate over all compression levels: c23, c40, raw
-            dataset_dict['FaceForensics++']['FF-real']['train'] = {}
-            dataset_dict['FaceForensics++']['FF-real']['test'] = {}
-            dataset_dict['FaceForensics++']['FF-real']['val'] = {}
-            for compression_level in os.scandir(os.path.join(dataset_path, 'original_sequences', 'youtube')):
-                if compression_level.is_dir():
-                    compression_level = compression_level.name
-                    dataset_dict['FaceForensics++']['FF-real']['train'][compression_level] = {}
-                    dataset_dict['FaceForensics++']['FF-real']['test'][compression_level] = {}
-                    dataset_dict['FaceForensics++']['FF-real']['val'][compression_level] = {}
-            
-                # Iterate over all videos frames 
-                for video_path in os.scandir(os.path.join(dataset_path, 'original_sequences', 'youtube', compression_level, 'frames')):
-                    if video_path.is_dir():
-                        video_name = video_path.name
-                        mode = video_to_mode[video_name]
-                        frame_paths = [os.path.join(video_path, frame.name) for frame in os.scandir(video_path)]
-                        dataset_dict['FaceForensics++']['FF-real'][mode][compression_level][video_name] = {'label': ff_dict[label], 'frames': frame_paths}
-                        
-            # label = 'DFD_Real'  
-            # # Same operations for DeepfakeDetection real dataset
-            # dataset_dict['FaceForensics++']['DFD_real']['train'] = {}
-            # dataset_dict['FaceForensics++']['DFD_real']['test'] = {}
-            # dataset_dict['FaceForensics++']['DFD_real']['val'] = {}
-            # for compression_level in os.scandir(os.path.join(dataset_path, 'original_sequences', 'actors')):
-            #     if compression_level.is_dir() and compression_level.name in ["c23", "c40", "raw"]:
-            #         compression_level = compression_level.name
-            #         dataset_dict['FaceForensics++']['DFD_real']['train'][compression_level] = {}
-            #         dataset_dict['FaceForensics++']['DFD_real']['test'][compression_level] = {}
-            #         dataset_dict['FaceForensics++']['DFD_real']['val'][compression_level] = {}
-            #     # Iterate over all videos
-            #     for video_path in os.scandir(os.path.join(dataset_path, 'original_sequences', 'actors', compression_level, 'frames')):
-            #         if video_path.is_dir():
-            #             video_name = video_path.name
-            #             frame_paths = [os.path.join(video_path, frame.name) for frame in os.scandir(video_path)]
-            #             dataset_dict['FaceForensics++']['DFD_real']['train'][compression_level][video_name] = {'label': ff_dict[label], 'frames': frame_paths}
-            #             dataset_dict['FaceForensics++']['DFD_real']['test'][compression_level][video_name] = {'label': ff_dict[label], 'frames': frame_paths}
-            #             dataset_dict['FaceForensics++']['DFD_real']['val'][compression_level][video_name] = {'label': ff_dict[label], 'frames': frame_paths}
-        
-        # FaceForensics++ fake datasets
+            # FaceForensics++ real dataset, iterate over all compression levels: c23, c40, raw
+            youtube_path = os.path.join(dataset_path, 'original_sequences', 'youtube')
+            compression_levels, rescanned = list_dir(youtube_path, scan_cache, cache_updates, dirs_only=True)
+            if rescanned:
+                changed_labels.add('FF-real')
+            for compression_level in compression_levels:
+                units.append(('Real', compression_level, os.path.join(youtube_path, compression_level, 'frames'), None))
         if os.path.isdir(os.path.join(dataset_path, 'manipulated_sequences')):
-            for label_dir in os.scandir(os.path.join(dataset_path, 'manipulated_sequences')):
-                if label_dir.is_dir():
-                    label = label_dir.name
-                    dataset_dict['FaceForensics++'][ff_dict[label]] = {}
-                    dataset_dict['FaceForensics++'][ff_dict[label]]['train'] = {}
-                    dataset_dict['FaceForensics++'][ff_dict[label]]['test'] = {}
-                    dataset_dict['FaceForensics++'][ff_dict[label]]['val'] = {}
-                    
-                    # Iterate over all compression levels: c23, c40
-                    for compression_level in os.scandir(os.path.join(dataset_path, 'manipulated_sequences', label)):
-                        # if compression_level.is_dir() and compression_level.name in ["c23", "c40", "raw"]:
-                        if compression_level.is_dir() and compression_level.name in ["c23", "c40"]:
-                            compression_level = compression_level.name
-                            dataset_dict['FaceForensics++'][ff_dict[label]]['train'][compression_level] = {}
-                            dataset_dict['FaceForensics++'][ff_dict[label]]['test'][compression_level] = {}
-                            dataset_dict['FaceForensics++'][ff_dict[label]]['val'][compression_level] = {}
-                            # Iterate over all videos
-
-                            for video_path in os.scandir(os.path.join(dataset_path, 'manipulated_sequences', label, compression_level, 'frames')):
-                                if video_path.is_dir():
-                                    video_name = video_path.name
-                                    frame_paths = [os.path.join(video_path, frame.name) for frame in os.scandir(video_path)]
-                                    # if label != 'FaceShifter':
-                                    mask_paths = os.path.join(dataset_path, 'manipulated_sequences', label, 'c23','masks', video_name)
-                                    # mask is all the same for all compression levels
-                                    if os.path.exists(mask_paths):
-                                        mask_frames_paths = [os.path.join(mask_paths, frame.name) for frame in os.scandir(mask_paths)]
-                                    else:
-                                        mask_frames_paths = []
-                                    try:
-                                        mode = video_to_mode[video_name]
-                                        dataset_dict['FaceForensics++'][ff_dict[label]][mode][compression_level][video_name] = {'label': ff_dict[label], 'frames': frame_paths, 'masks': mask_frames_paths}
-                                    # DeepfakeDetection dataset
-                                    except:
-                                        dataset_dict['FaceForensics++'][ff_dict[label]]['train'][compression_level][video_name] = {'label': ff_dict[label], 'frames': frame_paths, 'masks': mask_frames_paths}
-                                        dataset_dict['FaceForensics++'][ff_dict[label]]['val'][compression_level][video_name] = {'label': ff_dict[label], 'frames': frame_paths, 'masks': mask_frames_paths}
-                                        dataset_dict['FaceForensics++'][ff_dict[label]]['test'][compression_level][video_name] = {'label': ff_dict[label], 'frames': frame_paths, 'masks': mask_frames_paths}
-                                    # # FaceShifter dataset
-                                    # else:
-                                    #     mode = video_to_mode[video_name]
-                                    #     dataset_dict['FaceForensics++'][ff_dict[label]][mode][compression_level][video_name] = {'label': ff_dict[label], 'frames': frame_paths}
-         
+            # FaceForensics++ fake datasets, iterate over the compression levels c23, c40
+            manipulated_path = os.path.join(dataset_path, 'manipulated_sequences')
+            for label in list_dir(manipulated_path, scan_cache, cache_updates, dirs_only=True)[0]:
+                compression_levels, rescanned = list_dir(os.path.join(manipulated_path, label), scan_cache, cache_updates, dirs_only=True)
+                if rescanned:
+                    changed_labels.add(ff_dict[label])
+                for compression_level in compression_levels:
+                    # if compression_level in ["c23", "c40", "raw"]:
+                    if compression_level in ["c23", "c40"]:
+                        # mask is all the same for all compression levels
+                        units.append((label, compression_level,
+                                      os.path.join(manipulated_path, label, compression_level, 'frames'),
+                                      os.path.join(manipulated_path, label, 'c23', 'masks')))
+
+        for label, compression_level, _, _ in units:
+            for mode in ['train', 'test', 'val']:
+                dataset_dict.setdefault('FaceForensics++', {}).setdefault(ff_dict[label], {}).setdefault(mode, {})[compression_level] = {}
+
+        # Scan units still running per label
+        pending_units = {}
+        for label, _, _, _ in units:
+            pending_units[ff_dict[label]] = pending_units.get(ff_dict[label], 0) + 1
+        num_rescanned = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(scan_frames_dir, *unit, scan_cache) for unit in units]
+            for future in concurrent.futures.as_completed(futures):
+                label, compression_level, videos, updates, rescanned = future.result()
+                cache_updates.update(updates)
+                num_rescanned += rescanned
+                if rescanned or not incremental:
+                    changed_labels.add(ff_dict[label])
+                for video_name, video_info in videos.items():
+                    entry = {'label': ff_dict[label], 'frames': video_info['frames']}
+                    if label == 'Real':
+                        mode = video_to_mode[video_name]
+                        dataset_dict['FaceForensics++']['FF-real'][mode][compression_level][video_name] = entry
+                        continue
+                    entry['masks'] = video_info['masks']
+                    if video_name in video_to_mode:
+                        dataset_dict['FaceForensics++'][ff_dict[label]][video_to_mode[video_name]][compression_level][video_name] = entry
+                    # DeepfakeDetection dataset
+                    else:
+                        for mode in ['train', 'val', 'test']:
+                            dataset_dict['FaceForensics++'][ff_dict[label]][mode][compression_level][video_name] = entry
+
+                # Stream out the label files as soon as their videos and the real videos are indexed
+                pending_units[ff_dict[label]] -= 1
+                if dataset_name == 'FaceForensics++' and 'FF-real' in dataset_dict['FaceForensics++'] \
+                        and pending_units.get('FF-real', 0) == 0:
+                    for ready_label in [l for l, count in pending_units.items() if count == 0 and l != 'FF-real']:
+                        write_label_file(dataset_dict, ready_label, output_file_path,
+                                         force='FF-real' in changed_labels or ready_label in changed_labels)
+                        del pending_units[ready_label]
+        print(f"Scanned {len(units)} directories, {num_rescanned} folders changed since the last index")
 
         # # get the DeepfakeDetection dataset from FaceForensics++ dataset
         # if dataset_name == 'FaceForensics++':
@@ -245,17 +335,6 @@ def generate_dataset_file(dataset_name, dataset_root_path, output_file_path, com
         # else:
         #     raise ValueError('Invalid dataset name: {}'.format(dataset_name))
 
-        # if FaceForensics++, based on label and generate the json
-        if dataset_name == 'FaceForensics++':
-            for label, value in dataset_dict['FaceForensics++'].items():
-                if label != 'FF-real':
-                    with open(os.path.join(output_file_path,f'{label}.json'), 'w') as f:
-                        data = {label: {'FF-real': dataset_dict['FaceForensics++']['FF-real'],
-                                        label: value,
-                                        }}
-                        json.dump(data, f)
-                        print(f"Finish writing {label}.json")
-    
     # ## Celeb-DF-v1 dataset
     # ## Note: videos in Celeb-DF-v1/2 are not in the same format as in FaceForensics++ dataset
     # elif dataset_name == 'Celeb-DF-v1':
@@ -497,6 +576,7 @@ def generate_dataset_file(dataset_name, dataset_root_path, output_file_path, com
     output_file_path = os.path.join(output_file_path, dataset_name + '.json')
     with open(output_file_path, 'w') as f:
         json.dump(dataset_dict, f)
+    save_scan_cache(scan_cache_path, {**scan_cache, **cache_updates})
     # print the successfully generated dataset dictionary
     print(f"{dataset_name}.json generated successfully.")
 
@@ -515,5 +595,8 @@ if __name__ == '__main__':
     output_file_path = config['rearrange']['output_file_path']['default']
     comp = config['rearrange']['comp']['default']
     perturbation = config['rearrange']['perturbation']['default']
+    num_workers = config['rearrange']['num_workers']['default']
+    incremental = config['rearrange']['incremental']['default']
     # Call the generate_dataset_file function
-    generate_dataset_file(dataset_name, dataset_root_path, output_file_path, comp, perturbation)
+    generate_dataset_file(dataset_name, dataset_root_path, output_file_path, comp, perturbation,
+                          num_workers=num_workers, incremental=incremental)